@@ -1,8 +1,14 @@
-from flask import Flask
+from flask import Flask, Response, g, request
 from api import bp
+from config import LOG_LEVEL
+from metrics import metrics
+import logging
 import os
+import time
 
 def create_app():
+    logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(levelname)s [%(process)d] %(name)s: %(message)s')
+
     app = Flask(__name__)
     
     # Register the blueprint
@@ -13,6 +19,26 @@ def create_app():
     def health():
         return {'status': 'healthy', 'message': 'Service is running'}, 200
     
+    # Prometheus metrics for every worker: stage timings, request counts,
+    # routing, cache and equation error counters
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    # Record request metrics and snapshot them for /metrics
+    @app.after_request
+    def record_request(response):
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.inc('http_requests_total', endpoint=endpoint, method=request.method, status=response.status_code)
+        if 'request_start' in g:
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - g.request_start, endpoint=endpoint)
+        metrics.flush()
+        return response
+    
     # Enable CORS for all routes
     @app.after_request
     def after_request(response):
@@ -0,0 +1,192 @@
+"""
+Local stand-in for an OSRM server, for benchmarks.
+
+Answers /route and /table requests with great-circle distance times a
+detour factor and a fixed average speed, after an optional delay, and fails
+a configurable share of requests with a 5xx so retries, backoff and the
+circuit breaker can be exercised. Points south of NO_ROAD_LATITUDE have no
+road, so routes to or from them are NoRoute and their table cells null.
+GET /_stats returns the request counts.
+
+    python -m benchmarks.fake_osrm --port 5050 --latency 0.05 --failure-rate 0.02
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import requests
+
+EARTH_RADIUS_M = 6371008.8
+DETOUR_FACTOR = 1.3
+SPEED_KMH = 70.0
+# Nothing south of this latitude can be routed
+NO_ROAD_LATITUDE = -60.0
+
+PATH_PATTERN = re.compile(r'^/(route|table)/v1/[^/]+/([^/?]+)$')
+
+
+def road_distance_m(lng1, lat1, lng2, lat2):
+    p1, p2 = math.radians(lat1), math.radians(lat2)
+    dlat, dlng = p2 - p1, math.radians(lng2 - lng1)
+    h = math.sin(dlat / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dlng / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(h))) * DETOUR_FACTOR
+
+
+def duration_s(distance_m):
+    return distance_m / (SPEED_KMH / 3.6)
+
+
+def has_road(lng, lat):
+    return lat >= NO_ROAD_LATITUDE
+
+
+class FakeOSRMServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, latency=0.0, failure_rate=0.0, failure_status=503, seed=0):
+        super().__init__(address, FakeOSRMHandler)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.failure_status = failure_status
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'failures': 0, 'route': 0, 'table': 0}
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.failure_rate
+
+
+class FakeOSRMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path == '/_stats':
+            with self.server.lock:
+                return self._send(200, dict(self.server.counts))
+
+        self.server.count('requests')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.should_fail():
+            self.server.count('failures')
+            return self._send(self.server.failure_status, {'code': 'Unavailable'})
+
+        match = PATH_PATTERN.match(url.path)
+        if match is None:
+            return self._send(400, {'code': 'InvalidUrl'})
+        service, coordinate_text = match.groups()
+        try:
+            coordinates = [tuple(map(float, c.split(','))) for c in coordinate_text.split(';')]
+        except ValueError:
+            return self._send(400, {'code': 'InvalidQuery'})
+        self.server.count(service)
+
+        if service == 'route':
+            if len(coordinates) != 2:
+                return self._send(400, {'code': 'InvalidQuery'})
+            if not all(has_road(*coordinate) for coordinate in coordinates):
+                return self._send(400, {'code': 'NoRoute'})
+            distance = road_distance_m(*coordinates[0], *coordinates[1])
+            return self._send(200, {'code': 'Ok', 'routes': [{'distance': distance, 'duration': duration_s(distance)}]})
+
+        query = parse_qs(url.query)
+        everything = ';'.join(str(i) for i in range(len(coordinates)))
+        sources = [int(i) for i in query.get('sources', [everything])[0].split(';')]
+        destinations = [int(i) for i in query.get('destinations', [everything])[0].split(';')]
+        distances = [
+            [road_distance_m(*coordinates[s], *coordinates[d])
+             if has_road(*coordinates[s]) and has_road(*coordinates[d]) else None for d in destinations]
+            for s in sources
+        ]
+        return self._send(200, {
+            'code': 'Ok',
+            'distances': distances,
+            'durations': [
+                [None if distance is None else duration_s(distance) for distance in row] for row in distances
+            ],
+        })
+
+
+def serve(port=0, latency=0.0, failure_rate=0.0, failure_status=503, seed=0, ready=None):
+    """Run the server until the process is stopped, reporting its port to ready (a queue) if given"""
+    server = FakeOSRMServer(('127.0.0.1', port), latency, failure_rate, failure_status, seed)
+    if ready is not None:
+        ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+class FakeOSRM:
+    """
+    The fake server in a child process, so it does not compete with the
+    code under test for the GIL. Use as a context manager; .url is the base
+    URL to set as OSRM_URL.
+    """
+
+    def __init__(self, latency=0.0, failure_rate=0.0, failure_status=503, seed=0):
+        self.settings = dict(latency=latency, failure_rate=failure_rate, failure_status=failure_status, seed=seed)
+        self.process = None
+        self.url = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        ready = context.Queue()
+        self.process = context.Process(target=serve, kwargs=dict(self.settings, ready=ready), daemon=True)
+        self.process.start()
+        self.url = f"http://127.0.0.1:{ready.get(timeout=30)}"
+        return self
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.join()
+            self.process = None
+
+    def stats(self):
+        return requests.get(f"{self.url}/_stats", timeout=5).json()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of requests answered with an error")
+    parser.add_argument('--failure-status', type=int, default=503)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    print(f"Fake OSRM listening on http://127.0.0.1:{args.port}")
+    serve(args.port, args.latency, args.failure_rate, args.failure_status, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+"""
+Synthetic community, clinic, charlie and costs CSVs for benchmarking.
+
+Communities and clinics are clustered around BC population centres with a
+rural scatter in between, and the files carry the same quirks as real
+uploads: a few rows without coordinates, community names with non-breaking
+spaces and en/em dashes, and encounter rows for only part of the communities.
+A road network for the 'local' routing backend can be generated too: a
+jittered grid over the province with winding, partly missing roads.
+
+    python -m benchmarks.generate_data --communities 10000 --out /tmp/bench
+    python -m benchmarks.generate_data --communities 10000 --out /tmp/bench --road-network
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+# Named dataset sizes, in communities
+SCALES = {'1k': 1_000, '10k': 10_000, '100k': 100_000}
+
+# (latitude, longitude, relative population) of the cluster centres
+POPULATION_CENTRES = [
+    (49.28, -123.12, 12), (48.43, -123.37, 5), (49.89, -119.50, 4), (50.67, -120.33, 3),
+    (53.92, -122.75, 3), (49.17, -123.94, 3), (56.25, -120.85, 1), (54.52, -128.60, 1),
+    (49.51, -115.77, 1), (52.14, -122.14, 1), (54.31, -130.32, 1), (55.76, -120.24, 1),
+]
+BC_BOUNDS = ((48.3, 59.9), (-139.0, -114.1))
+
+# Services priced for encounters with and without the program
+WITH_SERVICE = 'Virtual'
+WITHOUT_SERVICE = 'MD'
+AGE_GROUPS = ['0-14', '15-64', '65+']
+
+
+def parse_scale(value):
+    """'10k' or '2500' -> number of communities"""
+    return SCALES[value] if value in SCALES else int(value)
+
+
+def default_clinics(communities):
+    return max(20, communities // 50)
+
+
+def _points(rng, n, spread, rural_share):
+    centres = np.array([(lat, lng) for lat, lng, _ in POPULATION_CENTRES])
+    weights = np.array([w for _, _, w in POPULATION_CENTRES], dtype=float)
+    rural = rng.random(n) < rural_share
+    picks = rng.choice(len(centres), size=n, p=weights / weights.sum())
+    lat = centres[picks, 0] + rng.normal(0, spread, n)
+    lng = centres[picks, 1] + rng.normal(0, spread * 1.5, n)
+    (lat_min, lat_max), (lng_min, lng_max) = BC_BOUNDS
+    lat[rural] = rng.uniform(lat_min, lat_max, rural.sum())
+    lng[rural] = rng.uniform(lng_min, lng_max, rural.sum())
+    return np.clip(lat, lat_min, lat_max), np.clip(lng, lng_min, lng_max)
+
+
+def community_names(n):
+    names = np.array([f"Community {i}" for i in range(n)], dtype=object)
+    # Variants normalize_names has to reconcile with the charlie file
+    names[3::17] = [f"Community\u00a0{i}" for i in range(3, n, 17)]
+    names[5::23] = [f"Community \u2013 {i}" for i in range(5, n, 23)]
+    return names
+
+
+def charlie_names(n):
+    names = np.array([f" Community {i} " for i in range(n)], dtype=object)
+    names[5::23] = [f"Community \u2014 {i}" for i in range(5, n, 23)]
+    # Misspellings only fuzzy matching (NAME_MATCH_FUZZY_THRESHOLD) reconciles
+    names[7::29] = [f"Comunity {i}" for i in range(7, n, 29)]
+    return names
+
+
+def costs_equations():
+    """One row of equations in the layout the costs file uses"""
+    equations = {}
+    for prefix, service in (('WITH', WITH_SERVICE), ('WITHOUT', WITHOUT_SERVICE)):
+        for age_group in AGE_GROUPS:
+            encounters = f"Encounters {age_group}"
+            equations[f"{prefix}_Encounter_Costs_{age_group}"] = f"{encounters} * {service}_{age_group}_total_unit_cost"
+            for component in ('lost_productivity', 'out_of_pocket', 'informal_caregiving'):
+                equations[f"{component}_{prefix}_Encounter_{age_group}"] = (
+                    f"{encounters} * {service}_{age_group}_{component}"
+                )
+        # Only encounters without the program involve travel
+        travel = 0 if prefix == 'WITH' else 1
+        trips = "(Encounters 0-14 + Encounters 15-64 + Encounters 65+)"
+        equations[f"{prefix}_total_distance"] = f"{trips} * Round Trip Distance (km) * {travel}"
+        equations[f"{prefix}_total_duration"] = f"{trips} * Round Trip Duration (hours) * {travel}"
+        equations[f"{prefix}_total_CO2"] = f"{trips} * Estimated CO2 (kg) * 2 * {travel}"
+        equations[f"{prefix}_total_trips"] = f"{trips} * {travel}"
+    return equations
+
+
+def generate_dataset(directory, communities, clinics=None, seed=0):
+    """
+    Write community.csv, clinic.csv, charlie.csv and costs.csv into directory
+    and return their paths keyed by the API's form field names.
+    """
+    rng = np.random.default_rng(seed)
+    clinics = clinics if clinics is not None else default_clinics(communities)
+    os.makedirs(directory, exist_ok=True)
+
+    lat, lng = _points(rng, communities, spread=0.8, rural_share=0.25)
+    community_df = pd.DataFrame({
+        'Title': community_names(communities),
+        'Latitude': np.round(lat, 6),
+        'Longitude': np.round(lng, 6),
+    })
+    # A few rows without coordinates, which validation drops
+    missing = rng.random(communities) < 0.005
+    community_df.loc[missing, 'Latitude'] = np.nan
+
+    lat, lng = _points(rng, clinics, spread=0.5, rural_share=0.15)
+    clinic_df = pd.DataFrame({
+        'Facility': [f"Clinic {j}" for j in range(clinics)],
+        'latitude': np.round(lat, 6),
+        'longitude': np.round(lng, 6),
+    })
+
+    # Encounter counts for about 80% of communities
+    with_encounters = np.flatnonzero(rng.random(communities) < 0.8)
+    charlie_df = pd.DataFrame({
+        'community_name': charlie_names(communities)[with_encounters],
+        'Encounters 0-14': rng.poisson(12, len(with_encounters)),
+        'Encounters 15-64': rng.poisson(30, len(with_encounters)),
+        'Encounters 65+': rng.poisson(22, len(with_encounters)),
+    })
+
+    paths = {
+        'community_file': os.path.join(directory, 'community.csv'),
+        'clinic_file': os.path.join(directory, 'clinic.csv'),
+        'charlie_file': os.path.join(directory, 'charlie.csv'),
+        'costs_file': os.path.join(directory, 'costs.csv'),
+    }
+    community_df.to_csv(paths['community_file'], index=False)
+    clinic_df.to_csv(paths['clinic_file'], index=False)
+    charlie_df.to_csv(paths['charlie_file'], index=False)
+    pd.DataFrame([costs_equations()]).to_csv(paths['costs_file'], index=False)
+    return paths
+
+
+def generate_road_network(directory, spacing=0.05, seed=0):
+    """
+    Write a road network (road_network.py) with a node every spacing degrees
+    over BC_BOUNDS into directory and return its digest. Roads join grid
+    neighbours, wind 5-60% longer than the straight line, drive at 50, 80
+    or 100 km/h, and a tenth are missing.
+    """
+    # Backend modules read their settings when imported, so only import them here
+    from distance import haversine
+    from road_network import build_road_network
+
+    rng = np.random.default_rng(seed)
+    (lat_min, lat_max), (lng_min, lng_max) = BC_BOUNDS
+    rows = int((lat_max - lat_min) / spacing) + 1
+    columns = int((lng_max - lng_min) / (spacing * 1.5)) + 1
+    grid = np.arange(rows * columns).reshape(rows, columns)
+    lat = np.repeat(np.linspace(lat_min, lat_max, rows), columns) + rng.uniform(-0.3, 0.3, rows * columns) * spacing
+    lng = np.tile(np.linspace(lng_min, lng_max, columns), rows) + rng.uniform(-0.3, 0.3, rows * columns) * spacing * 1.5
+
+    # Each road joins a node to its east or north neighbour, both ways
+    start = np.concatenate([grid[:, :-1].ravel(), grid[:-1, :].ravel()])
+    end = np.concatenate([grid[:, 1:].ravel(), grid[1:, :].ravel()])
+    kept = rng.random(len(start)) >= 0.1
+    start, end = start[kept], end[kept]
+    winding = rng.uniform(1.05, 1.6, len(start))
+    speed = rng.choice([50.0, 80.0, 100.0], len(start), p=[0.5, 0.35, 0.15])
+    length = haversine(lat[start], lng[start], lat[end], lng[end]) * 1000 * winding
+    duration = length / (speed / 3.6)
+    return build_road_network(
+        directory, lat, lng, np.concatenate([start, end]), np.concatenate([end, start]),
+        np.concatenate([length, length]), np.concatenate([duration, duration])
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--communities', default='1k', help="1k, 10k, 100k or a number (default 1k)")
+    parser.add_argument('--clinics', type=int, help="default: communities / 50, at least 20")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', required=True, help="output directory")
+    parser.add_argument('--road-network', action='store_true', help="also write a road network into OUT/network")
+    args = parser.parse_args()
+
+    paths = generate_dataset(args.out, parse_scale(args.communities), args.clinics, args.seed)
+    for name, path in paths.items():
+        print(f"{name}: {path}")
+    if args.road_network:
+        network = os.path.join(args.out, 'network')
+        generate_road_network(network, seed=args.seed)
+        print(f"road network: {network}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,327 @@
+"""
+Time each stage of /api/calculate-distances-and-merge-costs, and the
+endpoint end to end through the Flask test client, on generated datasets
+routed through a local fake OSRM server, or with --backend local over a
+generated road network.
+
+    python -m benchmarks.run_benchmarks --scales 1k 10k --repeat 3 --output bench.json
+    python -m benchmarks.run_benchmarks --scales 1k --compare bench.json
+    python -m benchmarks.run_benchmarks --scales 10k --backend local
+
+Every run is cold: the result, stage and route caches are disabled and the
+clinic spatial index is rebuilt for each repetition. Stage timings come from
+separate runs without memory tracing, so tracemalloc's overhead does not
+distort them; peak memory per stage is measured in one extra traced run,
+and the peak resident memory of a whole run in one more, in a forked child.
+"""
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+import tracemalloc
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
+
+from benchmarks.fake_osrm import FakeOSRM  # noqa: E402
+from benchmarks.generate_data import generate_dataset, generate_road_network, parse_scale  # noqa: E402
+
+STAGES = [
+    'read_locations', 'compute_distances', 'read_cost_inputs',
+    'merge_encounters', 'apply_equations', 'build_report', 'save_report',
+]
+
+
+def configure_environment(cache_dir, osrm_url, backend, road_network=''):
+    """Settings are read at import time, so this must run before importing the app"""
+    os.environ.update({
+        'CACHE_DIR': cache_dir,
+        'ROUTING_BACKEND': backend,
+        'OSRM_URL': osrm_url or 'http://127.0.0.1:9',
+        'ROAD_NETWORK_PATH': road_network,
+        'RESULT_CACHE_MAX_BYTES': '0',
+        'STAGE_CACHE_MAX_BYTES': '0',
+        'ROUTE_CACHE_TTL_SECONDS': '0',
+        'LOG_LEVEL': os.environ.get('LOG_LEVEL', 'WARNING'),
+    })
+
+
+def reset_caches():
+    import spatial_index
+    spatial_index._memory_cache.clear()
+    shutil.rmtree(spatial_index.INDEX_CACHE_DIR, ignore_errors=True)
+
+
+def stage_span_seconds():
+    """Total seconds recorded so far for each metrics span"""
+    from metrics import metrics
+    return {
+        dict(labels)['stage']: histogram['sum']
+        for name, labels, histogram in metrics.snapshot()['histograms']
+        if name == 'pipeline_stage_seconds'
+    }
+
+
+def run_stages(paths, output_path, trace_memory=False):
+    """Run the pipeline stage by stage, returning {stage: {'seconds': ..., 'peak_mb': ...}}"""
+    import pipeline
+
+    results = {}
+
+    def measure(stage, fn, *args):
+        if trace_memory:
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        value = fn(*args)
+        results[stage] = {'seconds': time.perf_counter() - start}
+        if trace_memory:
+            results[stage]['peak_mb'] = (tracemalloc.get_traced_memory()[1] - baseline) / 2 ** 20
+        return value
+
+    reset_caches()
+    files = {name: open(path, 'rb') for name, path in paths.items()}
+    try:
+        community_df, clinic_df = measure(
+            'read_locations', pipeline.read_locations, files['community_file'], files['clinic_file']
+        )
+        result_df = measure('compute_distances', pipeline.compute_distances, community_df, clinic_df)
+        charlie_df, equation_columns, equations = measure(
+            'read_cost_inputs', pipeline.read_cost_inputs, files['charlie_file'], files['costs_file']
+        )
+        result_df = measure('merge_encounters', pipeline.merge_encounters, result_df, charlie_df)
+        result_df = measure('apply_equations', pipeline.apply_equations, result_df, equation_columns, equations)
+        final_result_df = measure('build_report', pipeline.build_report, result_df)
+        measure('save_report', pipeline.save_report, final_result_df, output_path)
+    finally:
+        for f in files.values():
+            f.close()
+    return results
+
+
+def maxrss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+def run_peak_rss(paths, output_path):
+    """
+    MB of resident memory one run of the stages adds at its peak, or None
+    without fork. The run is in a forked child, whose peak starts at its
+    resident size when forked, so earlier runs' peaks do not hide it.
+    """
+    if not hasattr(os, 'fork'):
+        return None
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        try:
+            start = maxrss_mb()
+            run_stages(paths, output_path)
+            os.write(write_fd, str(maxrss_mb() - start).encode())
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        peak = f.read()
+    os.waitpid(pid, 0)
+    return round(float(peak), 1) if peak else None
+
+
+def run_end_to_end(client, paths):
+    reset_caches()
+    files = {name: (open(path, 'rb'), os.path.basename(path)) for name, path in paths.items()}
+    try:
+        start = time.perf_counter()
+        response = client.post('/api/calculate-distances-and-merge-costs', data=files,
+                               content_type='multipart/form-data')
+        body = response.get_data()
+        seconds = time.perf_counter() - start
+    finally:
+        for f, _ in files.values():
+            f.close()
+    return seconds, response.status_code, len(body)
+
+
+def summarize(samples):
+    return {
+        'seconds': [round(s, 6) for s in samples],
+        'median': round(statistics.median(samples), 6),
+        'min': round(min(samples), 6),
+    }
+
+
+def benchmark_scale(communities, args, workdir, router):
+    data_dir = os.path.join(workdir, f"data_{communities}")
+    paths = generate_dataset(data_dir, communities, args.clinics, args.seed)
+    output_path = os.path.join(workdir, 'report.csv')
+    router_before = router.stats() if router else None
+
+    timings = {stage: [] for stage in STAGES}
+    spans = {}
+    for _ in range(args.repeat):
+        spans_before = stage_span_seconds()
+        for stage, result in run_stages(paths, output_path).items():
+            timings[stage].append(result['seconds'])
+        for stage, total in stage_span_seconds().items():
+            spans.setdefault(stage, []).append(total - spans_before.get(stage, 0.0))
+
+    tracemalloc.start()
+    try:
+        memory = run_stages(paths, output_path, trace_memory=True)
+    finally:
+        tracemalloc.stop()
+
+    peak_rss = run_peak_rss(paths, output_path)
+
+    stages = {}
+    for stage in STAGES:
+        stages[stage] = summarize(timings[stage])
+        stages[stage]['peak_mb'] = round(memory[stage]['peak_mb'], 3)
+
+    result = {
+        'communities': communities,
+        'clinics': sum(1 for _ in open(paths['clinic_file'])) - 1,
+        'stages': stages,
+        'peak_rss_mb': peak_rss,
+        # Spans inside the stages above; ones only other code paths record stay at 0
+        'spans': {stage: summarize(samples) for stage, samples in sorted(spans.items()) if any(samples)},
+    }
+
+    if not args.no_end_to_end:
+        from app import app
+        client = app.test_client()
+        samples, status, size = [], None, None
+        for _ in range(args.repeat):
+            seconds, status, size = run_end_to_end(client, paths)
+            samples.append(seconds)
+        result['end_to_end'] = dict(summarize(samples), status=status, bytes=size)
+
+    if router:
+        after = router.stats()
+        result['router'] = {key: after[key] - router_before[key] for key in after}
+    # The process's peak only ever grows, so run scales smallest first
+    result['max_rss_mb'] = round(maxrss_mb(), 1)
+    return result
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=BACKEND_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain'], cwd=BACKEND_DIR, capture_output=True,
+                                    text=True, check=True).stdout.strip())
+        return {'commit': commit, 'dirty': dirty}
+    except (OSError, subprocess.CalledProcessError):
+        return {'commit': None, 'dirty': None}
+
+
+def print_results(results, previous=None):
+    for scale, result in results.items():
+        print(f"\n{scale}: {result['communities']} communities, {result['clinics']} clinics")
+        rows = [(stage, stats) for stage, stats in result['stages'].items()]
+        rows += [(f"  {stage}", stats) for stage, stats in result['spans'].items()]
+        if 'end_to_end' in result:
+            rows.append(('end_to_end', result['end_to_end']))
+        for name, stats in rows:
+            line = f"  {name:<24} {stats['median']:>10.4f}s"
+            if 'peak_mb' in stats:
+                line += f" {stats['peak_mb']:>10.1f} MB"
+            old = _previous_stats(previous, scale, name.strip(), name.startswith('  '))
+            if old and old['median'] > 0:
+                change = (stats['median'] - old['median']) / old['median'] * 100
+                line += f"   was {old['median']:.4f}s ({change:+.1f}%)"
+            print(line)
+        if 'router' in result:
+            print(f"  router requests: {result['router']}")
+        if result.get('peak_rss_mb') is not None:
+            line = f"  peak RSS of one run: {result['peak_rss_mb']} MB"
+            old = previous and previous.get('results', {}).get(scale, {}).get('peak_rss_mb')
+            if old:
+                line += f"   was {old} MB ({old / max(result['peak_rss_mb'], 0.1):.1f}x)"
+            print(line)
+        print(f"  max RSS: {result['max_rss_mb']} MB")
+
+
+def _previous_stats(previous, scale, name, is_span):
+    if not previous or scale not in previous.get('results', {}):
+        return None
+    old = previous['results'][scale]
+    if name == 'end_to_end':
+        return old.get('end_to_end')
+    return old.get('spans' if is_span else 'stages', {}).get(name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', nargs='+', default=['1k'], help="1k, 10k, 100k or numbers of communities")
+    parser.add_argument('--clinics', type=int, help="clinics per dataset (default: communities / 50, at least 20)")
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per scale")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--backend', default='osrm-table', help="ROUTING_BACKEND to benchmark")
+    parser.add_argument('--latency', type=float, default=0.0, help="fake router delay per request, seconds")
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of fake router requests that fail")
+    parser.add_argument('--no-end-to-end', action='store_true', help="skip the Flask test client runs")
+    parser.add_argument('--output', help="write results as JSON to this file")
+    parser.add_argument('--compare', help="earlier results JSON to compare against")
+    args = parser.parse_args()
+
+    previous = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            previous = json.load(f)
+
+    workdir = tempfile.mkdtemp(prefix='geoffe-bench-')
+    router = None
+    try:
+        if args.backend not in ('geodesic', 'local'):
+            router = FakeOSRM(latency=args.latency, failure_rate=args.failure_rate, seed=args.seed).start()
+        road_network = os.path.join(workdir, 'network') if args.backend == 'local' else ''
+        configure_environment(os.path.join(workdir, 'cache'), router.url if router else None, args.backend, road_network)
+        if road_network:
+            generate_road_network(road_network, seed=args.seed)
+
+        results = {}
+        for scale in sorted(args.scales, key=parse_scale):
+            print(f"Benchmarking {scale}...", file=sys.stderr)
+            results[scale] = benchmark_scale(parse_scale(scale), args, workdir, router)
+    finally:
+        if router:
+            router.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    import numpy
+    import pandas
+    report = {
+        'meta': dict(
+            git_revision(),
+            timestamp=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            python=platform.python_version(),
+            platform=platform.platform(),
+            numpy=numpy.__version__,
+            pandas=pandas.__version__,
+            settings={key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+        ),
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+    print_results(results, previous)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""
+Compact in-memory report columns.
+
+Report values are rounded to 2 decimal places when they are written, not
+before. A column whose values are all 2-decimal numbers below COMPACT_LIMIT
+(distances, durations, CO2, unit costs, encounter counts) is held as
+float32, half the size of float64: with 24 significant bits, rounding the
+widened float32 to 2 decimal places gives back exactly the float64 it was
+made from. decode() does that, and everything that reads column values as
+numbers goes through it, so results are the same as with float64 columns.
+Clinic names are held as categoricals.
+"""
+import numpy as np
+import pandas as pd
+
+# 2 ** 17: below this a float32 is within 0.005 of the 2-decimal number it was made from
+COMPACT_LIMIT = 2.0 ** 17
+
+
+def compactable(values):
+    """Whether decode() gives back float64 values exactly from their float32 copy"""
+    if values.dtype != np.float64:
+        return False
+    finite = values[np.isfinite(values)]
+    return not len(finite) or (np.abs(finite).max() < COMPACT_LIMIT and np.array_equal(np.round(finite, 2), finite))
+
+
+def compact_array(values):
+    """values as float32 if they are compactable, else unchanged"""
+    values = np.asarray(values)
+    return values.astype(np.float32) if compactable(values) else values
+
+
+def decode(values):
+    """A column's values as float64 if it is a compact float32 column, else unchanged"""
+    if values.dtype == np.float32:
+        return np.round(values.astype(np.float64), 2)
+    return values
+
+
+def column_array(frame, column):
+    """A frame column's values as an array, with compact columns decoded"""
+    return decode(frame[column].to_numpy())
+
+
+class DecodedColumns:
+    """Read-only view of a DataFrame that returns each column as column_array() does, for equations"""
+
+    def __init__(self, frame):
+        self._frame = frame
+
+    def __getitem__(self, column):
+        return column_array(self._frame, column)
+
+    def __len__(self):
+        return len(self._frame)
+
+
+def finalize_column(column):
+    """A column (Series) as it is written: compact floats decoded, floats rounded to 2 decimal places, categoricals as objects"""
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.astype(object)
+    if column.dtype == np.float32:
+        return pd.Series(decode(column.to_numpy()), index=column.index, name=column.name)
+    if column.dtype == np.float64:
+        return column.round(2)
+    return column
+
+
+def finalize(df):
+    """A block of report rows as it is written (see finalize_column), keeping the frame's attrs"""
+    final = pd.DataFrame({column: finalize_column(df[column]) for column in df.columns}, index=df.index)
+    final.attrs = dict(df.attrs)
+    return final
@@ -0,0 +1,121 @@
+import os
+
+# Directory for on-disk caches (spatial indexes, routing results, reports)
+CACHE_DIR = os.environ.get(
+    'CACHE_DIR',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cache')
+)
+
+# Log level for the application loggers (DEBUG logs per-stage timings)
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+# Per-worker metric snapshots, summed by the /metrics endpoint
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(CACHE_DIR, 'metrics'))
+# Minimum seconds between a worker's metric snapshot writes (a scrape always writes)
+METRICS_FLUSH_SECONDS = float(os.environ.get('METRICS_FLUSH_SECONDS', 5))
+
+# Persistent OSRM routing result cache
+ROUTE_CACHE_PATH = os.environ.get('ROUTE_CACHE_PATH', os.path.join(CACHE_DIR, 'routes.sqlite'))
+ROUTE_CACHE_TTL_SECONDS = int(os.environ.get('ROUTE_CACHE_TTL_SECONDS', 30 * 24 * 3600))
+ROUTE_CACHE_MAX_ENTRIES = int(os.environ.get('ROUTE_CACHE_MAX_ENTRIES', 1_000_000))
+# Coordinates are snapped to this many decimal places (5 ~= 1 m) for cache keys
+ROUTE_CACHE_PRECISION = int(os.environ.get('ROUTE_CACHE_PRECISION', 5))
+
+# Routing backend: 'osrm-table' (batched matrix calls), 'osrm-route' (one call per pair),
+# 'local' (a road network file, no server) or 'geodesic'
+ROUTING_BACKEND = os.environ.get('ROUTING_BACKEND', 'osrm-table')
+ROUTING_PROFILE = os.environ.get('ROUTING_PROFILE', 'driving')
+# Most candidate clinics routed per community, nearest by great-circle
+# distance first; the search stops sooner once no further clinic can be
+# closer by road
+ROUTING_MAX_CANDIDATES = int(os.environ.get('ROUTING_MAX_CANDIDATES', 10))
+# Road network directory for the 'local' backend, written by road_network.py
+ROAD_NETWORK_PATH = os.environ.get('ROAD_NETWORK_PATH', '')
+# Points further than this from every road network node are left to the geodesic fallback
+ROAD_NETWORK_SNAP_KM = float(os.environ.get('ROAD_NETWORK_SNAP_KM', 5))
+# Settled nodes the 'local' backend keeps across a run's clinic searches
+# (~150 bytes each); the least recently used searches are dropped past it
+ROAD_NETWORK_SEARCH_NODES = int(os.environ.get('ROAD_NETWORK_SEARCH_NODES', 1_000_000))
+OSRM_URL = os.environ.get('OSRM_URL', 'https://router.project-osrm.org').rstrip('/')
+OSRM_TIMEOUT = float(os.environ.get('OSRM_TIMEOUT', 30))
+# The public OSRM server rejects table requests with more than 100 coordinates
+OSRM_TABLE_MAX_COORDINATES = int(os.environ.get('OSRM_TABLE_MAX_COORDINATES', 100))
+OSRM_CONNECT_TIMEOUT = float(os.environ.get('OSRM_CONNECT_TIMEOUT', 5))
+# Concurrent requests in flight per job, and per-host request rate (0 = unlimited)
+OSRM_CONCURRENCY = int(os.environ.get('OSRM_CONCURRENCY', 4))
+OSRM_RATE_LIMIT = float(os.environ.get('OSRM_RATE_LIMIT', 0))
+# Retries with exponential backoff on 429/5xx and connection errors
+OSRM_MAX_RETRIES = int(os.environ.get('OSRM_MAX_RETRIES', 3))
+OSRM_BACKOFF_SECONDS = float(os.environ.get('OSRM_BACKOFF_SECONDS', 0.5))
+OSRM_BACKOFF_MAX_SECONDS = float(os.environ.get('OSRM_BACKOFF_MAX_SECONDS', 8))
+# Consecutive failed requests before the job switches to fallback mode
+OSRM_BREAKER_THRESHOLD = int(os.environ.get('OSRM_BREAKER_THRESHOLD', 5))
+OSRM_BREAKER_RESET_SECONDS = float(os.environ.get('OSRM_BREAKER_RESET_SECONDS', 60))
+
+# Unit-cost model parameters (constants, service and age-group tables)
+COST_PARAMETERS_PATH = os.environ.get(
+    'COST_PARAMETERS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cost_parameters.json')
+)
+
+# Communities whose name has no exact match in the charlie file are matched
+# to the most similar charlie name (character trigram Dice similarity, 0-1)
+# if it scores at least this much; 0 turns fuzzy matching off
+NAME_MATCH_FUZZY_THRESHOLD = float(os.environ.get('NAME_MATCH_FUZZY_THRESHOLD', 0))
+
+# Communities at the same coordinates are routed and costed once. Set this
+# to also group those that match once rounded to this many decimal places
+# (4 ~= 11 m); unset groups identical coordinates only
+LOCATION_SNAP_DECIMALS = (
+    int(os.environ['LOCATION_SNAP_DECIMALS']) if os.environ.get('LOCATION_SNAP_DECIMALS') else None
+)
+
+# Finished reports cached by a content hash of the inputs and model
+# parameters, evicted least recently used above this many bytes (0 disables)
+RESULT_CACHE_DIR = os.environ.get('RESULT_CACHE_DIR', os.path.join(CACHE_DIR, 'results'))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 1024 ** 3))
+# Built clinic KD-trees, cached by the clinic coordinates, evicted least
+# recently used above this many bytes (0 disables)
+SPATIAL_INDEX_CACHE_DIR = os.environ.get('SPATIAL_INDEX_CACHE_DIR', os.path.join(CACHE_DIR, 'spatial_index'))
+SPATIAL_INDEX_CACHE_MAX_BYTES = int(os.environ.get('SPATIAL_INDEX_CACHE_MAX_BYTES', 256 * 1024 ** 2))
+# Routes of a run, cached by the community and clinic files alone so runs
+# that only change the charlie or costs file (or cost parameters) skip routing
+STAGE_CACHE_DIR = os.environ.get('STAGE_CACHE_DIR', os.path.join(CACHE_DIR, 'stages'))
+STAGE_CACHE_MAX_BYTES = int(os.environ.get('STAGE_CACHE_MAX_BYTES', 1024 ** 3))
+
+# CSV parser for uploads: 'auto' uses pyarrow's multithreaded reader, when
+# installed, for files of at least PYARROW_MIN_BYTES; 'c' always uses pandas' C parser
+CSV_ENGINE = os.environ.get('CSV_ENGINE', 'auto').lower()
+PYARROW_MIN_BYTES = int(os.environ.get('PYARROW_MIN_BYTES', 256 * 1024))
+
+# Finished reports in columnar form for the paged /api/results queries,
+# evicted least recently used above this many bytes (0 disables)
+RESULT_STORE_DIR = os.environ.get('RESULT_STORE_DIR', os.path.join(CACHE_DIR, 'store'))
+RESULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_BYTES', 1024 ** 3))
+
+# Registered clinic, charlie and costs datasets, referenced by id in place of uploads
+DATASETS_DIR = os.environ.get('DATASETS_DIR', os.path.join(CACHE_DIR, 'datasets'))
+
+# Scenario sweeps: the most scenarios one request may evaluate, and the
+# memory (bytes) the per-row scenario columns of one batch of scenarios may take
+SCENARIO_LIMIT = int(os.environ.get('SCENARIO_LIMIT', 200))
+SCENARIO_BATCH_BYTES = int(os.environ.get('SCENARIO_BATCH_BYTES', 256 * 1024 ** 2))
+
+# Gunicorn worker processes, and the processes each may use to run one
+# request's per-community stages in shards of PIPELINE_SHARD_ROWS communities
+# (1 keeps everything in the worker). The default splits the cores between
+# the workers; runs smaller than two shards are never split.
+WEB_CONCURRENCY = int(os.environ.get('WEB_CONCURRENCY', 2))
+PIPELINE_PROCESSES = int(os.environ.get('PIPELINE_PROCESSES', max(1, (os.cpu_count() or 1) // WEB_CONCURRENCY)))
+PIPELINE_SHARD_ROWS = int(os.environ.get('PIPELINE_SHARD_ROWS', 10000))
+
+# Communities per chunk when the report is streamed
+STREAM_CHUNK_ROWS = int(os.environ.get('STREAM_CHUNK_ROWS', 5000))
+
+# Background jobs: runner threads per gunicorn worker, max queued jobs,
+# seconds without a heartbeat before a running job is considered orphaned,
+# attempts before a job is marked failed, and how long finished jobs are kept
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+JOB_QUEUE_LIMIT = int(os.environ.get('JOB_QUEUE_LIMIT', 20))
+JOB_STALE_SECONDS = int(os.environ.get('JOB_STALE_SECONDS', 120))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', 7 * 24 * 3600))
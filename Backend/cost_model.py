@@ -0,0 +1,153 @@
+import json
+from functools import lru_cache
+
+import numpy as np
+
+from config import COST_PARAMETERS_PATH
+
+COST_COMPONENTS = ['lost_productivity', 'informal_caregiving', 'out_of_pocket', 'total_unit_cost']
+
+SERVICE_FIELDS = ['parking', 'time', 'travel', 'meals', 'accommodation_nights', 'hospital_meals', 'data_usage']
+AGE_GROUP_FIELDS = ['caregiver_coeff', 'hospital_coeff', 'productivity_coeff']
+
+
+class CostParameters:
+    """
+    Unit-cost model parameters, held as arrays over the service and age
+    group axes.
+
+    Out-of-pocket cost per visit is parking + meals * MEAL_COST + the round
+    trip car cost (in-person services only) + data usage, plus accommodation
+    nights and hospital meals scaled by the age group's hospital coefficient.
+    Lost productivity and informal caregiving are the visit time plus the
+    round trip duration (in-person services only), valued at WAGE and scaled
+    by the age group's productivity and caregiver coefficients.
+    """
+
+    def __init__(self, constants, services, age_groups):
+        self.constants = dict(constants)
+        self.services = [row['service'] for row in services]
+        self.age_groups = [row['age_group'] for row in age_groups]
+        self.service_table = {
+            field: np.array([float(row[field]) for row in services]) for field in SERVICE_FIELDS
+        }
+        self.age_group_table = {
+            field: np.array([float(row[field]) for row in age_groups]) for field in AGE_GROUP_FIELDS
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        missing = [key for key in ('constants', 'services', 'age_groups') if key not in data]
+        if missing:
+            raise ValueError(f"Cost parameters are missing: {', '.join(missing)}")
+        return cls(data['constants'], data['services'], data['age_groups'])
+
+    def to_dict(self):
+        return {
+            'constants': dict(self.constants),
+            'services': [
+                dict(service=name, **{field: float(self.service_table[field][i]) for field in SERVICE_FIELDS})
+                for i, name in enumerate(self.services)
+            ],
+            'age_groups': [
+                dict(age_group=name, **{field: float(self.age_group_table[field][i]) for field in AGE_GROUP_FIELDS})
+                for i, name in enumerate(self.age_groups)
+            ],
+        }
+
+    @classmethod
+    def stack(cls, scenarios):
+        """
+        Several parameter sets with the same services and age groups as one,
+        whose values have a leading scenario axis: compute_unit_costs then
+        returns arrays shaped (scenarios, communities).
+        """
+        first = scenarios[0]
+        for params in scenarios[1:]:
+            if params.services != first.services or params.age_groups != first.age_groups:
+                raise ValueError("Stacked cost parameters must have the same services and age groups")
+        stacked = cls.__new__(cls)
+        stacked.services = list(first.services)
+        stacked.age_groups = list(first.age_groups)
+        # Shaped to broadcast against (scenarios, communities[, services[, age groups]])
+        stacked.constants = {
+            key: np.array([params.constants[key] for params in scenarios], dtype=np.float64)[:, None]
+            for key in first.constants
+        }
+        stacked.service_table = {
+            field: np.stack([params.service_table[field] for params in scenarios])[:, None, :]
+            for field in SERVICE_FIELDS
+        }
+        stacked.age_group_table = {
+            field: np.stack([params.age_group_table[field] for params in scenarios])[:, None, None, :]
+            for field in AGE_GROUP_FIELDS
+        }
+        return stacked
+
+    def columns(self):
+        """Unit-cost column names, in output order"""
+        return [
+            f"{service}_{age_group}_{component}"
+            for service in self.services
+            for age_group in self.age_groups
+            for component in COST_COMPONENTS
+        ]
+
+
+@lru_cache(maxsize=1)
+def load_cost_parameters(path=COST_PARAMETERS_PATH):
+    with open(path, encoding='utf-8') as f:
+        return CostParameters.from_dict(json.load(f))
+
+
+def compute_unit_costs(distance_km, duration_hours, params):
+    """
+    Compute travel cost, round trip duration and every service x age group
+    unit cost for all communities at once.
+
+    distance_km and duration_hours are the one-way routed distance and
+    duration per community. Returns (travel_cost, round_trip_duration, costs)
+    where costs maps each column from params.columns() to an array shaped
+    like the inputs, or (scenarios, communities) for parameters made with
+    CostParameters.stack.
+    """
+    distance_km = np.asarray(distance_km, dtype=np.float64)
+    duration_hours = np.asarray(duration_hours, dtype=np.float64)
+    constants = params.constants
+    service = params.service_table
+    age = params.age_group_table
+
+    # Round trip
+    travel_cost = distance_km * 2 * constants['CAR_COST']
+    round_trip_duration = duration_hours * 2
+
+    # (..., services): hours spent per visit, and per-visit costs that do not
+    # depend on age group
+    hours = service['time'] + service['travel'] * round_trip_duration[..., None]
+    # (constants get a trailing axis per service / age group axis, which
+    # broadcasts away for scalars and lines stacked scenarios up)
+    flat_out_of_pocket = (
+        service['travel'] * travel_cost[..., None]
+        + service['parking']
+        + service['meals'] * np.asarray(constants['MEAL_COST'])[..., None]
+        + service['data_usage'] * np.asarray(constants['DATA_USAGE'])[..., None]
+    )
+    hospital_stay = (
+        service['accommodation_nights'] * np.asarray(constants['ACCOMM'])[..., None]
+        + service['hospital_meals'] * np.asarray(constants['MEAL_COST'])[..., None]
+    )
+
+    # (..., services, age groups)
+    wage_hours = np.asarray(constants['WAGE'])[..., None, None] * hours[..., None]
+    lost_productivity = age['productivity_coeff'] * wage_hours
+    informal_caregiving = age['caregiver_coeff'] * wage_hours
+    out_of_pocket = flat_out_of_pocket[..., None] + hospital_stay[..., None] * age['hospital_coeff']
+    total_unit_cost = lost_productivity + informal_caregiving + out_of_pocket
+
+    components = dict(zip(COST_COMPONENTS, (lost_productivity, informal_caregiving, out_of_pocket, total_unit_cost)))
+    costs = {}
+    for s, service_name in enumerate(params.services):
+        for a, age_group in enumerate(params.age_groups):
+            for component in COST_COMPONENTS:
+                costs[f"{service_name}_{age_group}_{component}"] = components[component][..., s, a]
+    return travel_cost, round_trip_duration, costs
@@ -0,0 +1,269 @@
+"""
+Registry of clinic, charlie and costs datasets, uploaded once and then
+referenced by id in place of the file.
+
+A dataset is parsed and validated when it is registered, and its parsed
+form is kept next to the raw file, so a run that names it skips the upload
+and the parse. Registering a clinic set also builds its spatial index, and
+registering a costs set compiles its equations against the columns a run
+will have, so a broken equation is reported at upload time.
+
+Ids are content hashes: registering the same file again returns the
+existing dataset. Each kind and name has its own version sequence, so
+re-uploading an edited "clinics" file gives clinics version 2 with a new id.
+"""
+import hashlib
+import io
+import json
+import logging
+import os
+import pickle
+import re
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from config import DATASETS_DIR
+from metrics import metrics
+from pipeline import check_equations, read_charlie, read_clinics, read_costs
+from spatial_index import get_clinic_index
+
+logger = logging.getLogger(__name__)
+
+DATASETS_DB_PATH = os.path.join(DATASETS_DIR, 'datasets.sqlite')
+
+# Kind -> the pipeline input it stands in for
+DATASET_KINDS = {
+    'clinic': 'clinic_file',
+    'charlie': 'charlie_file',
+    'costs': 'costs_file',
+}
+
+DATASET_ID_PATTERN = re.compile(r'(clinic|charlie|costs)-[0-9a-f]{16}')
+
+# Number of parsed datasets kept in memory per worker
+MEMORY_CACHE_SIZE = 16
+
+
+def parse_dataset(kind, file):
+    """
+    Parse and validate a dataset file, building its derived artifacts.
+    Returns (parsed data, row count, columns); raises InputError if the file
+    is not a valid dataset of this kind.
+    """
+    if kind == 'clinic':
+        clinic_df = read_clinics(file)
+        # Built now and persisted, so runs with this clinic set find it cached
+        get_clinic_index(clinic_df['Latitude'].to_numpy(), clinic_df['Longitude'].to_numpy())
+        return clinic_df, len(clinic_df), clinic_df.columns.tolist()
+    if kind == 'charlie':
+        charlie_df = read_charlie(file)
+        return charlie_df, len(charlie_df), charlie_df.columns.tolist()
+
+    equation_columns, equations = read_costs(file)
+    check_equations(equation_columns, equations)
+    return (equation_columns, equations), int(equations.notna().sum()), list(equation_columns)
+
+
+def copy_parsed(parsed):
+    """A copy of parsed data the pipeline can modify without changing the registry's"""
+    if isinstance(parsed, tuple):
+        equation_columns, equations = parsed
+        return list(equation_columns), equations.copy()
+    return parsed.copy()
+
+
+class RegisteredFile(io.BytesIO):
+    """
+    A registered dataset, passed to the pipeline in place of an uploaded
+    file. It reads as the raw file, so cache keys are the same as for the
+    upload, and parsed() gives the pipeline the already parsed data.
+    """
+
+    def __init__(self, registry, dataset):
+        with open(registry.raw_path(dataset['id']), 'rb') as f:
+            super().__init__(f.read())
+        self.dataset_id = dataset['id']
+        self.filename = dataset['name']
+        self._registry = registry
+
+    def parsed(self):
+        return copy_parsed(self._registry.parsed(self.dataset_id))
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.getbuffer())
+
+
+class DatasetRegistry:
+    """
+    Dataset metadata in SQLite, with each dataset's raw file and parsed data
+    on disk under DATASETS_DIR/<id>/, shared by every gunicorn worker.
+    """
+
+    def __init__(self, path=DATASETS_DB_PATH, datasets_dir=DATASETS_DIR):
+        self.path = path
+        self.datasets_dir = datasets_dir
+        self._local = threading.local()
+        self._memory_cache = OrderedDict()
+        self._memory_lock = threading.Lock()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS datasets (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    rows INTEGER NOT NULL,
+                    bytes INTEGER NOT NULL,
+                    columns TEXT NOT NULL,
+                    sha256 TEXT NOT NULL
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS datasets_name ON datasets (kind, name, version)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def dataset_dir(self, dataset_id):
+        return os.path.join(self.datasets_dir, dataset_id)
+
+    def raw_path(self, dataset_id):
+        return os.path.join(self.dataset_dir(dataset_id), 'raw.csv')
+
+    def parsed_path(self, dataset_id):
+        return os.path.join(self.dataset_dir(dataset_id), 'parsed.pkl')
+
+    def register(self, kind, file, name):
+        """
+        Parse, validate and store a dataset file. Returns (dataset, created),
+        where created is False if the same content was already registered.
+        Raises InputError if the file is not a valid dataset of this kind.
+        """
+        file.seek(0)
+        data = file.read()
+        sha256 = hashlib.sha256(data).hexdigest()
+        dataset_id = f"{kind}-{sha256[:16]}"
+        existing = self.get(dataset_id)
+        if existing is not None:
+            return existing, False
+
+        with metrics.span('dataset_register', kind=kind, bytes=len(data)):
+            parsed, rows, columns = parse_dataset(kind, io.BytesIO(data))
+
+            # Write the files to a temporary directory and move it into place,
+            # so a dataset directory is always complete
+            dataset_dir = self.dataset_dir(dataset_id)
+            tmp_dir = f"{dataset_dir}.{os.getpid()}.{threading.get_ident()}.tmp"
+            os.makedirs(tmp_dir, exist_ok=True)
+            try:
+                with open(os.path.join(tmp_dir, 'raw.csv'), 'wb') as f:
+                    f.write(data)
+                with open(os.path.join(tmp_dir, 'parsed.pkl'), 'wb') as f:
+                    pickle.dump(parsed, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp_dir, dataset_dir)
+            except OSError:
+                # Another worker moved the same dataset into place first
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                if not os.path.exists(self.parsed_path(dataset_id)):
+                    raise
+
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            created = conn.execute("SELECT 1 FROM datasets WHERE id = ?", (dataset_id,)).fetchone() is None
+            if created:
+                version = conn.execute(
+                    "SELECT COALESCE(MAX(version), 0) + 1 FROM datasets WHERE kind = ? AND name = ?", (kind, name)
+                ).fetchone()[0]
+                conn.execute(
+                    "INSERT INTO datasets (id, kind, name, version, created_at, rows, bytes, columns, sha256) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (dataset_id, kind, name, version, time.time(), rows, len(data), json.dumps(columns), sha256)
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if created:
+            logger.info("Registered %s dataset %s (%s, %d rows)", kind, dataset_id, name, rows)
+            metrics.inc('datasets_registered_total', kind=kind)
+        return self.get(dataset_id), created
+
+    def get(self, dataset_id):
+        row = self._connection().execute("SELECT * FROM datasets WHERE id = ?", (dataset_id,)).fetchone()
+        return self._to_dict(row) if row is not None else None
+
+    def list(self, kind=None, name=None):
+        """Datasets, optionally of one kind and name, newest version first"""
+        query = "SELECT * FROM datasets WHERE (? IS NULL OR kind = ?) AND (? IS NULL OR name = ?)"
+        rows = self._connection().execute(
+            query + " ORDER BY kind, name, version DESC", (kind, kind, name, name)
+        )
+        return [self._to_dict(row) for row in rows]
+
+    def delete(self, dataset_id):
+        """Remove a dataset. Returns False if there was none with this id."""
+        if not self._connection().execute("DELETE FROM datasets WHERE id = ?", (dataset_id,)).rowcount:
+            return False
+        with self._memory_lock:
+            self._memory_cache.pop(dataset_id, None)
+        shutil.rmtree(self.dataset_dir(dataset_id), ignore_errors=True)
+        return True
+
+    def open(self, dataset_id):
+        """The dataset as a RegisteredFile for the pipeline, or None if there is none with this id"""
+        dataset = self.get(dataset_id)
+        if dataset is None:
+            return None
+        try:
+            return RegisteredFile(self, dataset)
+        except FileNotFoundError:
+            # Deleted by another worker since the lookup
+            return None
+
+    def parsed(self, dataset_id):
+        """The parsed data of a dataset, from memory or disk; callers must not modify it"""
+        with self._memory_lock:
+            parsed = self._memory_cache.get(dataset_id)
+            if parsed is not None:
+                self._memory_cache.move_to_end(dataset_id)
+                metrics.inc('dataset_cache_total', result='hit')
+                return parsed
+
+        metrics.inc('dataset_cache_total', result='miss')
+        with open(self.parsed_path(dataset_id), 'rb') as f:
+            parsed = pickle.load(f)
+        with self._memory_lock:
+            self._memory_cache[dataset_id] = parsed
+            if len(self._memory_cache) > MEMORY_CACHE_SIZE:
+                self._memory_cache.popitem(last=False)
+        return parsed
+
+    @staticmethod
+    def _to_dict(row):
+        dataset = dict(row)
+        dataset['columns'] = json.loads(dataset['columns'])
+        return dataset
+
+
+_dataset_registry = None
+
+
+def get_dataset_registry():
+    """Process-wide dataset registry"""
+    global _dataset_registry
+    if _dataset_registry is None:
+        _dataset_registry = DatasetRegistry()
+    return _dataset_registry
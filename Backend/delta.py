@@ -0,0 +1,137 @@
+"""
+Delta runs: a run whose inputs differ a little from a previous run's takes
+the previous routes of the communities the changes cannot affect, and routes
+only the rest again.
+
+A community's route depends only on its coordinates and the clinics, so a
+row is routed again when no previous row was at its coordinates, when the
+clinic it was routed to is gone (clinics are matched by name and
+coordinates), or when an added or removed clinic is close enough that the
+best-first search (route_search.py) would have routed to it: its great-circle
+distance, less the sphere tolerance both ways, is no more than the road
+distance the row was routed. Any clinic further out is ruled out by the same
+bound, so the rows kept have the route a full run would pick.
+
+A previous report, unlike the routes a stored result refers to, holds
+coordinates to REPORT_DECIMALS decimal places, so its rows are matched by
+title and coordinates as written, and its clinics by name and coordinates
+as written. Its distances and durations are rounded too, so the rows kept
+take the figures the report wrote rather than costs computed from them.
+"""
+import numpy as np
+import pandas as pd
+
+from distance import SPHERE_TOLERANCE
+from spatial_index import ClinicIndex
+
+# Decimal places of the coordinates and figures in a written report
+REPORT_DECIMALS = 2
+
+# Report columns an uploaded previous report's routes are read from, by routes column
+REPORT_ROUTE_COLUMNS = {
+    'Title': 'Title',
+    'Latitude': 'Latitude',
+    'Longitude': 'Longitude',
+    'Nearest Clinic': 'Nearest Clinic',
+    'Clinic Latitude': 'Clinic Latitude',
+    'Clinic Longitude': 'Clinic Longitude',
+    'distance_km': 'Google Distance (km)',
+    'haversine_km': 'Haversine Distance (km)',
+    'duration_hours': 'Duration (hours)',
+}
+
+
+def report_routes(report_df, figure_columns=()):
+    """
+    The routes (see pipeline.compute_routes) of a previous report's
+    community rows, with their figures as written, and the report's
+    figure_columns (those of pipeline.distance_frame it has) under their own
+    names; the summary row, which has no coordinates, is left out
+    """
+    report_df = report_df.dropna(subset=['Latitude', 'Longitude', 'Clinic Latitude', 'Clinic Longitude'])
+    routes = {column: report_df[source].to_numpy() for column, source in REPORT_ROUTE_COLUMNS.items()}
+    for column in figure_columns:
+        if column in report_df.columns:
+            routes[column] = pd.to_numeric(report_df[column], errors='coerce').to_numpy(dtype=np.float64)
+    return pd.DataFrame(routes)
+
+
+def _coordinates(lat, lng, decimals):
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    if decimals is not None:
+        lat, lng = np.round(lat, decimals), np.round(lng, decimals)
+    # +0.0 folds -0.0 into 0.0, so the two are one value as they compare equal
+    return lat + 0.0, lng + 0.0
+
+
+def location_keys(df, decimals=None):
+    """Community rows by coordinates, or by title and coordinates rounded to decimals places if given"""
+    lat, lng = _coordinates(df['Latitude'], df['Longitude'], decimals)
+    if decimals is None:
+        return pd.MultiIndex.from_arrays([lat, lng])
+    return pd.MultiIndex.from_arrays([df['Title'].astype(str).to_numpy(), lat, lng])
+
+
+def clinic_keys(names, lat, lng, decimals=None):
+    """Clinics by name and coordinates (rounded to decimals places if given)"""
+    lat, lng = _coordinates(lat, lng, decimals)
+    return pd.MultiIndex.from_arrays([np.asarray(names, dtype=object).astype(str), lat, lng])
+
+
+def reusable_rows(previous_routes, previous_clinics, community_df, clinic_df, decimals=None):
+    """
+    For each row of community_df, the previous_routes row whose route it
+    takes, or -1 where it is routed again, and {'rows', 'reused',
+    'recomputed', 'clinics_added', 'clinics_removed'}.
+
+    previous_clinics (Facility Name, Latitude, Longitude) are the clinics
+    the previous routes were picked from; None (a report, which only names
+    the clinics it picked) takes those, so every other clinic counts as
+    added. decimals is the precision of a report's coordinates.
+    """
+    community_lat = community_df['Latitude'].to_numpy(dtype=np.float64)
+    community_lng = community_df['Longitude'].to_numpy(dtype=np.float64)
+
+    # Each row's previous row at the same location, the first if there are several
+    previous_keys = location_keys(previous_routes, decimals)
+    unique = ~previous_keys.duplicated()
+    source = previous_keys[unique].get_indexer(location_keys(community_df, decimals))
+    # (-1, no previous row there, picks the -1 appended)
+    source = np.append(np.flatnonzero(unique), -1)[source]
+
+    # Clinics added or removed since the previous run
+    chosen = clinic_keys(
+        previous_routes['Nearest Clinic'], previous_routes['Clinic Latitude'], previous_routes['Clinic Longitude']
+    )
+    if previous_clinics is None:
+        previous = chosen.unique()
+    else:
+        previous = clinic_keys(
+            previous_clinics['Facility Name'], previous_clinics['Latitude'], previous_clinics['Longitude']
+        )
+    current = clinic_keys(clinic_df['Facility Name'], clinic_df['Latitude'], clinic_df['Longitude'], decimals)
+    added = ~current.isin(previous)
+    removed = previous[~previous.isin(current)]
+    # Added clinics at their own coordinates, removed ones as the previous run had them
+    changed_lat = np.concatenate([clinic_df['Latitude'].to_numpy(dtype=np.float64)[added], removed.get_level_values(1)])
+    changed_lng = np.concatenate([clinic_df['Longitude'].to_numpy(dtype=np.float64)[added], removed.get_level_values(2)])
+
+    # A previous route is stale if its clinic is gone or a changed clinic is
+    # within the search's bound of the row
+    kept = np.flatnonzero(source >= 0)
+    stale = ~chosen.isin(current)[source[kept]]
+    if len(changed_lat) and len(kept):
+        _, nearest = ClinicIndex(changed_lat, changed_lng).query(community_lat[kept], community_lng[kept], 1)
+        bound = nearest[:, 0] * (1 - SPHERE_TOLERANCE) / (1 + SPHERE_TOLERANCE)
+        stale |= bound <= previous_routes['distance_km'].to_numpy(dtype=np.float64)[source[kept]]
+    source[kept[stale]] = -1
+
+    reused = len(kept) - int(np.count_nonzero(stale))
+    return source, {
+        'rows': len(source),
+        'reused': reused,
+        'recomputed': len(source) - reused,
+        'clinics_added': int(np.count_nonzero(added)),
+        'clinics_removed': len(removed),
+    }
@@ -0,0 +1,176 @@
+import numpy as np
+from geopy.distance import geodesic
+
+# Mean Earth radius (IUGG) used for great-circle distances
+EARTH_RADIUS_KM = 6371.0088
+
+# A great-circle distance on the mean sphere differs from the WGS-84 geodesic
+# by at most ~0.56%, so anything further than this band past the k-th
+# great-circle candidate can never make the geodesic top-k.
+SPHERE_TOLERANCE = 0.0056
+
+# Upper bound on the number of cells in one community x clinic distance block
+MAX_BLOCK_CELLS = 2_000_000
+
+# WGS-84 ellipsoid: semi-major axis (m) and flattening
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+WGS84_B = (1 - WGS84_F) * WGS84_A
+# Vincenty's iteration stops once longitude on the auxiliary sphere moves less
+# than this (radians, ~0.006 mm); pairs not there after VINCENTY_MAX_ITERATIONS
+# (nearly antipodal points) are measured with geopy's geodesic instead
+VINCENTY_TOLERANCE = 1e-12
+VINCENTY_MAX_ITERATIONS = 200
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """Great-circle distances (km) between points, element by element (the arrays broadcast)"""
+    lat1 = np.radians(np.asarray(lat1, dtype=np.float64))
+    lng1 = np.radians(np.asarray(lng1, dtype=np.float64))
+    lat2 = np.radians(np.asarray(lat2, dtype=np.float64))
+    lng2 = np.radians(np.asarray(lng2, dtype=np.float64))
+
+    a = (np.sin((lat2 - lat1) / 2) ** 2
+         + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def haversine_matrix(lat1, lng1, lat2, lng2):
+    """
+    Great-circle distances (km) between every point in the first set and
+    every point in the second set, as a (len(lat1), len(lat2)) matrix.
+    """
+    return haversine(
+        np.asarray(lat1, dtype=np.float64)[:, None], np.asarray(lng1, dtype=np.float64)[:, None],
+        np.asarray(lat2, dtype=np.float64)[None, :], np.asarray(lng2, dtype=np.float64)[None, :]
+    )
+
+
+def geodesic_km(lat1, lng1, lat2, lng2):
+    """
+    WGS-84 geodesic distances (km) between points, element by element (the
+    arrays broadcast), by Vincenty's inverse formula over whole arrays. They
+    agree with geopy's geodesic to well under a millimetre.
+    """
+    lat1, lng1, lat2, lng2 = np.broadcast_arrays(*(np.asarray(x, dtype=np.float64) for x in (lat1, lng1, lat2, lng2)))
+    shape = lat1.shape
+    lat1, lng1, lat2, lng2 = (x.ravel() for x in (lat1, lng1, lat2, lng2))
+
+    # Reduced latitudes and the longitude difference
+    u1 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat1)))
+    u2 = np.arctan((1 - WGS84_F) * np.tan(np.radians(lat2)))
+    sin_u1, cos_u1, sin_u2, cos_u2 = np.sin(u1), np.cos(u1), np.sin(u2), np.cos(u2)
+    lng_diff = np.radians(lng2 - lng1)
+
+    # Iterate the longitude on the auxiliary sphere, each pair until it
+    # converges, so a pair's distance does not depend on the others
+    n = len(lng_diff)
+    lam = lng_diff.copy()
+    sin_sigma, cos_sigma, sigma, cos2_alpha, cos_2sigma_m = (np.zeros(n) for _ in range(5))
+    active = np.arange(n)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for _ in range(VINCENTY_MAX_ITERATIONS):
+            if not len(active):
+                break
+            su1, cu1, su2, cu2 = sin_u1[active], cos_u1[active], sin_u2[active], cos_u2[active]
+            sin_lam, cos_lam = np.sin(lam[active]), np.cos(lam[active])
+            sin_s = np.hypot(cu2 * sin_lam, cu1 * su2 - su1 * cu2 * cos_lam)
+            cos_s = su1 * su2 + cu1 * cu2 * cos_lam
+            s = np.arctan2(sin_s, cos_s)
+            # Coincident points have sin_sigma 0 and distance 0
+            sin_alpha = np.where(sin_s > 0, cu1 * cu2 * sin_lam / sin_s, 0.0)
+            cos2_a = 1 - sin_alpha ** 2
+            # Along the equator cos2_alpha is 0 and so is the midpoint term
+            cos_2sm = np.where(cos2_a > 0, cos_s - 2 * su1 * su2 / cos2_a, 0.0)
+            c = WGS84_F / 16 * cos2_a * (4 + WGS84_F * (4 - 3 * cos2_a))
+            new_lam = lng_diff[active] + (1 - c) * WGS84_F * sin_alpha * (
+                s + c * sin_s * (cos_2sm + c * cos_s * (-1 + 2 * cos_2sm ** 2))
+            )
+            converged = np.abs(new_lam - lam[active]) <= VINCENTY_TOLERANCE
+            sin_sigma[active], cos_sigma[active], sigma[active] = sin_s, cos_s, s
+            cos2_alpha[active], cos_2sigma_m[active] = cos2_a, cos_2sm
+            lam[active] = new_lam
+            active = active[~converged]
+
+        u_sq = cos2_alpha * (WGS84_A ** 2 - WGS84_B ** 2) / WGS84_B ** 2
+        a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+        b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+        delta_sigma = b * sin_sigma * (cos_2sigma_m + b / 4 * (
+            cos_sigma * (-1 + 2 * cos_2sigma_m ** 2)
+            - b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma ** 2) * (-3 + 4 * cos_2sigma_m ** 2)
+        ))
+        km = WGS84_B * a * (sigma - delta_sigma) / 1000
+
+    unconverged = np.zeros(n, dtype=bool)
+    unconverged[active] = True
+    for i in np.flatnonzero(unconverged | ~np.isfinite(km)):
+        km[i] = geodesic((lat1[i], lng1[i]), (lat2[i], lng2[i])).km
+    return km.reshape(shape)
+
+
+def nearest_clinics(community_lat, community_lng, clinic_index, k=3):
+    """
+    Find the k closest clinics to every community.
+
+    The spatial index supplies a great-circle shortlist, widened until it
+    covers every clinic within the sphere/ellipsoid tolerance band of the
+    k-th candidate. Only the shortlisted pairs are measured with the exact
+    geodesic (geodesic_km, all of them at once), so the chosen clinics, their
+    order and their distances match a full geodesic scan (ties keep clinic
+    file order).
+
+    Returns (indices, distances): two (n_communities, k) arrays holding clinic
+    row positions and geodesic distances in km, sorted nearest first.
+    """
+    community_lat = np.asarray(community_lat, dtype=np.float64)
+    community_lng = np.asarray(community_lng, dtype=np.float64)
+
+    n, m = len(community_lat), len(clinic_index)
+    k = min(k, m)
+    indices = np.zeros((n, k), dtype=np.int64)
+    distances = np.zeros((n, k), dtype=np.float64)
+    if n == 0 or k == 0:
+        return indices, distances
+
+    band = (1 + SPHERE_TOLERANCE) / (1 - SPHERE_TOLERANCE)
+    shortlist, shortlist_dist = clinic_index.query(community_lat, community_lng, min(m, 2 * k))
+    limit = shortlist_dist[:, k - 1] * band + 1e-9
+
+    # Widen the shortlist for the rare rows whose band extends past it
+    width = shortlist.shape[1]
+    widened = {}
+    pending = np.flatnonzero(shortlist_dist[:, -1] <= limit) if width < m else np.zeros(0, dtype=np.int64)
+    while len(pending):
+        width = min(m, width * 2)
+        wide, wide_dist = clinic_index.query(community_lat[pending], community_lng[pending], width)
+        widened.update((i, (wide[row], wide_dist[row])) for row, i in enumerate(pending))
+        pending = pending[wide_dist[:, -1] <= limit[pending]] if width < m else pending[:0]
+
+    # The shortlisted pairs within each row's band, as flat (row, clinic) arrays
+    in_band = shortlist_dist <= limit[:, None]
+    in_band[list(widened)] = False
+    rows, columns = np.nonzero(in_band)
+    clinics = shortlist[rows, columns]
+    if widened:
+        wide_rows = list(widened)
+        wide_clinics = [wide[wide_dist <= limit[i]] for i, (wide, wide_dist) in widened.items()]
+        rows = np.concatenate([rows, np.repeat(wide_rows, [len(c) for c in wide_clinics])])
+        clinics = np.concatenate([clinics, *wide_clinics])
+
+    # Measure them a block at a time
+    exact = np.empty(len(rows))
+    for start in range(0, len(rows), MAX_BLOCK_CELLS):
+        block = slice(start, start + MAX_BLOCK_CELLS)
+        exact[block] = geodesic_km(
+            community_lat[rows[block]], community_lng[rows[block]],
+            clinic_index.lat[clinics[block]], clinic_index.lng[clinics[block]]
+        )
+
+    # Every row has at least k pairs in its band; keep the k nearest, ties by clinic position
+    order = np.lexsort((clinics, exact, rows))
+    rows, clinics, exact = rows[order], clinics[order], exact[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    picked = rank < k
+    indices[rows[picked], rank[picked]] = clinics[picked]
+    distances[rows[picked], rank[picked]] = exact[picked]
+    return indices, distances
@@ -0,0 +1,180 @@
+import ast
+from functools import lru_cache
+
+import numpy as np
+
+# Bare 'Distance' in an equation refers to the routed distance column
+COLUMN_ALIASES = {'Distance': 'Google Distance (km)'}
+
+ALLOWED_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+ALLOWED_UNARYOPS = (ast.UAdd, ast.USub)
+ALLOWED_COMPARES = (ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE)
+
+
+def _elementwise(reduce):
+    def apply(*args):
+        return reduce(np.broadcast_arrays(*args)) if len(args) > 1 else np.asarray(args[0])
+    return apply
+
+
+def _round(values, decimals=0):
+    # Constants are floats (see _FloatConstants), and NumPy takes decimals as an int
+    return np.round(values, int(decimals))
+
+
+# Functions equations may call, mapped to their element-wise NumPy versions
+FUNCTIONS = {
+    'min': _elementwise(lambda args: np.minimum.reduce(args)),
+    'max': _elementwise(lambda args: np.maximum.reduce(args)),
+    'abs': np.abs,
+    'round': _round,
+    'where': np.where,
+}
+
+
+class EquationError(ValueError):
+    """An equation from the costs file could not be compiled or evaluated"""
+
+    def __init__(self, column, message):
+        super().__init__(f"{column}: {message}")
+        self.column = column
+        self.message = message
+
+
+class _IfExpToWhere(ast.NodeTransformer):
+    """Rewrite `a if cond else b` into an element-wise where(cond, a, b)"""
+
+    def visit_IfExp(self, node):
+        self.generic_visit(node)
+        return ast.copy_location(
+            ast.Call(func=ast.Name(id='where', ctx=ast.Load()), args=[node.test, node.body, node.orelse], keywords=[]),
+            node
+        )
+
+
+class _FloatConstants(ast.NodeTransformer):
+    """
+    Replace each number constant with a name bound to it as a float64, so
+    that constant arithmetic such as 9**9**9 overflows to inf (and is zeroed
+    like any other non-finite result) rather than running unbounded integer
+    arithmetic or raising OverflowError
+    """
+
+    def __init__(self):
+        self.constants = []
+
+    def visit_Constant(self, node):
+        try:
+            value = np.float64(node.value)
+        except OverflowError:
+            value = np.float64(np.inf)
+        self.constants.append(value)
+        return ast.copy_location(ast.Name(id=f"_c{len(self.constants) - 1}", ctx=ast.Load()), node)
+
+
+class CompiledEquation:
+    """
+    An equation parsed once into a whitelisted expression over DataFrame
+    columns, evaluated for a whole column at once with NumPy.
+    """
+
+    def __init__(self, column, equation, variables, code, constants=()):
+        self.column = column
+        self.equation = equation
+        self.variables = variables
+        self._code = code
+        self._constants = constants
+
+    def evaluate(self, frame, shape=None):
+        """
+        Evaluate against a DataFrame (or any mapping of column name to array
+        with the given result shape). Returns a float64 array; rows whose
+        result is not a finite number (e.g. division by zero) are set to 0,
+        as the per-row evaluator did.
+        """
+        namespace = {f"_c{i}": value for i, value in enumerate(self._constants)}
+        for i, name in enumerate(self.variables):
+            try:
+                namespace[f"_v{i}"] = np.asarray(frame[name], dtype=np.float64)
+            except (TypeError, ValueError):
+                raise EquationError(self.column, f"column '{name}' is not numeric")
+        try:
+            with np.errstate(all='ignore'):
+                result = eval(self._code, {'__builtins__': {}, **FUNCTIONS}, namespace)
+            result = np.asarray(result, dtype=np.float64)
+        except Exception as e:
+            raise EquationError(self.column, f"evaluation failed: {str(e)}")
+
+        result = np.broadcast_to(result, shape if shape is not None else (len(frame),))
+        return np.where(np.isfinite(result), result, 0.0)
+
+
+def _validate(node, column, n_variables):
+    for child in ast.walk(node):
+        if isinstance(child, (ast.Expression, ast.Load)):
+            continue
+        if isinstance(child, ast.BinOp):
+            if not isinstance(child.op, ALLOWED_BINOPS):
+                raise EquationError(column, f"operator '{type(child.op).__name__}' is not allowed")
+        elif isinstance(child, ast.UnaryOp):
+            if not isinstance(child.op, ALLOWED_UNARYOPS):
+                raise EquationError(column, f"operator '{type(child.op).__name__}' is not allowed")
+        elif isinstance(child, ast.Compare):
+            if not all(isinstance(op, ALLOWED_COMPARES) for op in child.ops):
+                raise EquationError(column, "comparison is not allowed")
+        elif isinstance(child, ast.Call):
+            if not isinstance(child.func, ast.Name) or child.func.id not in FUNCTIONS or child.keywords:
+                raise EquationError(column, "only min, max, abs, round and where calls are allowed")
+        elif isinstance(child, ast.Name):
+            if child.id not in FUNCTIONS and not (
+                child.id.startswith('_v') and child.id[2:].isdigit() and int(child.id[2:]) < n_variables
+            ):
+                raise EquationError(column, f"unknown variable '{child.id}'")
+        elif isinstance(child, ast.Constant):
+            if isinstance(child.value, bool) or not isinstance(child.value, (int, float)):
+                raise EquationError(column, f"constant {child.value!r} is not a number")
+        elif isinstance(child, (ast.operator, ast.unaryop, ast.cmpop, ast.IfExp)):
+            continue
+        else:
+            raise EquationError(column, f"'{type(child).__name__}' expressions are not allowed")
+
+
+@lru_cache(maxsize=1024)
+def compile_equation(column, equation, columns):
+    """
+    Compile an equation whose variables are column names (which may contain
+    spaces and symbols, e.g. 'Encounters 65+' or 'MD_0-14_total_unit_cost').
+
+    Column names are substituted longest first, so names containing other
+    names resolve to the longer column. `columns` must be a tuple of the
+    available column names; compiled equations are cached on
+    (column, equation, columns) across requests.
+    """
+    normalized = ' '.join(str(equation).split())
+    if not normalized:
+        raise EquationError(column, "equation is empty")
+    text = normalized
+
+    # Replace each column name with a private-use placeholder character that
+    # no later (shorter) column name can match inside
+    variables = []
+    for name in sorted(columns, key=len, reverse=True):
+        if name and name in text:
+            text = text.replace(name, f" {chr(0xE000 + len(variables))} ")
+            variables.append(name)
+    for alias, name in COLUMN_ALIASES.items():
+        if alias in text and name in columns:
+            text = text.replace(alias, f" {chr(0xE000 + len(variables))} ")
+            variables.append(name)
+
+    source = ''.join(f"_v{ord(ch) - 0xE000}" if 0xE000 <= ord(ch) < 0xF8FF else ch for ch in text)
+    try:
+        tree = ast.parse(source.strip(), mode='eval')
+    except SyntaxError as e:
+        raise EquationError(column, f"invalid syntax: {e.msg}")
+
+    _validate(tree, column, len(variables))
+    constants = _FloatConstants()
+    tree = ast.fix_missing_locations(_IfExpToWhere().visit(constants.visit(tree)))
+    code = compile(tree, f"<equation {column}>", 'eval')
+    return CompiledEquation(column, normalized, tuple(variables), code, tuple(constants.constants))
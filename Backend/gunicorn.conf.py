@@ -1,10 +1,21 @@
 # Gunicorn configuration file
+from config import WEB_CONCURRENCY
+
 bind = "0.0.0.0:10000"
-workers = 2
+# Each worker may also fork PIPELINE_PROCESSES processes for a large run;
+# both are sized together in config.py
+workers = WEB_CONCURRENCY
 worker_class = "sync"
 worker_connections = 1000
 timeout = 120
 keepalive = 2
 max_requests = 1000
 max_requests_jitter = 50
-preload_app = True 
\ No newline at end of file
+preload_app = True
+
+
+def post_fork(server, worker):
+    # Start the background job runner in each worker so queued jobs, and jobs
+    # orphaned by a recycled worker, resume without waiting for a request
+    from jobs import get_job_runner
+    get_job_runner()
@@ -0,0 +1,207 @@
+"""
+Reading the uploaded CSV files.
+
+Each upload is read into memory once and every parse works on those bytes.
+The encoding is picked from a bounded sample, the header is checked for the
+required columns before the body is parsed, and only the columns the
+pipeline uses are parsed, with explicit dtypes, by pyarrow's multithreaded
+reader when it is installed and the file is large enough to benefit.
+"""
+import codecs
+import io
+import logging
+
+import numpy as np
+import pandas as pd
+
+from config import CSV_ENGINE, PYARROW_MIN_BYTES
+from metrics import metrics
+
+try:
+    import pyarrow  # noqa: F401  (pandas' engine='pyarrow' needs it)
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+# Bytes of each upload decoded to pick its encoding
+ENCODING_SAMPLE_BYTES = 64 * 1024
+
+# For each kind of upload: the columns it must have, the columns parsed from
+# it (None for all), their dtypes, and how parse errors are reported
+UPLOADS = {
+    'community': {
+        'required': ['Title', 'Latitude', 'Longitude'],
+        'usecols': ['Title', 'Latitude', 'Longitude'],
+        'dtype': {'Title': object, 'Latitude': 'float64', 'Longitude': 'float64'},
+        'error': "Invalid coordinate values",
+    },
+    'clinic': {
+        'required': ['Facility', 'latitude', 'longitude'],
+        'usecols': ['Facility', 'latitude', 'longitude'],
+        'dtype': {'Facility': object, 'latitude': 'float64', 'longitude': 'float64'},
+        'error': "Invalid coordinate values",
+    },
+    'charlie': {
+        'required': ['community_name', 'Encounters 0-14', 'Encounters 15-64', 'Encounters 65+'],
+        'usecols': ['community_name', 'Encounters 0-14', 'Encounters 15-64', 'Encounters 65+'],
+        'dtype': {'community_name': object},
+        'error': "Error reading charlie file",
+    },
+    'costs': {
+        # Any columns: each one is an output column with its equation
+        'required': [],
+        'usecols': None,
+        'dtype': object,
+        'error': "Error reading costs file",
+    },
+    'report': {
+        # A report this service wrote, whose routes a delta run starts from
+        'required': ['Title', 'Latitude', 'Longitude', 'Nearest Clinic', 'Clinic Latitude', 'Clinic Longitude',
+                     'Google Distance (km)', 'Haversine Distance (km)', 'Duration (hours)'],
+        # Every column: the rows a delta run keeps take the report's figures
+        'usecols': None,
+        'dtype': {'Title': object, 'Latitude': 'float64', 'Longitude': 'float64', 'Nearest Clinic': object,
+                  'Clinic Latitude': 'float64', 'Clinic Longitude': 'float64', 'Google Distance (km)': 'float64',
+                  'Haversine Distance (km)': 'float64', 'Duration (hours)': 'float64'},
+        'error': "Error reading previous report",
+    },
+}
+
+
+class InputError(ValueError):
+    """Invalid or unreadable input, reported to the client as a 400"""
+
+    def __init__(self, message, **details):
+        super().__init__(message)
+        self.details = details
+
+    def to_dict(self):
+        return {"error": str(self), **self.details}
+
+
+def sample_encoding(data, sample_bytes=ENCODING_SAMPLE_BYTES):
+    """utf-8 if the first sample_bytes of data decode as utf-8, latin1 (which accepts any bytes) otherwise"""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        # Not final unless the sample is the whole file, so a character cut
+        # off at the end of the sample is not an error
+        decoder.decode(memoryview(data)[:sample_bytes], final=len(data) <= sample_bytes)
+        return 'utf-8'
+    except UnicodeDecodeError:
+        return 'latin1'
+
+
+def detect_encoding(file, block_size=1 << 20):
+    """
+    Pick the encoding for a file that will be read in chunks: utf-8 if the
+    whole file decodes as utf-8, latin1 otherwise. Only one block is held in
+    memory at a time.
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    file.seek(0)
+    try:
+        while True:
+            block = file.read(block_size)
+            if not block:
+                decoder.decode(b'', final=True)
+                return 'utf-8'
+            decoder.decode(block)
+    except UnicodeDecodeError:
+        return 'latin1'
+    finally:
+        file.seek(0)
+
+
+def csv_engine(size):
+    """pyarrow for files of at least PYARROW_MIN_BYTES when it is installed, pandas' C parser otherwise"""
+    if CSV_ENGINE == 'c' or pyarrow is None or size < PYARROW_MIN_BYTES:
+        return 'c'
+    return 'pyarrow'
+
+
+def check_columns(columns, kind):
+    """Raise InputError naming any required column the header lacks"""
+    missing = [col for col in UPLOADS[kind]['required'] if col not in columns]
+    if missing:
+        raise InputError(f"{kind.capitalize()} file is missing required columns: {', '.join(missing)}")
+
+
+def read_header(buffer, encoding, kind):
+    """Column names from the header row alone"""
+    try:
+        return pd.read_csv(buffer, encoding=encoding, nrows=0).columns.tolist()
+    except pd.errors.EmptyDataError:
+        raise InputError(f"{kind.capitalize()} file is empty")
+    except ValueError as e:
+        raise InputError(f"{UPLOADS[kind]['error']}: {str(e)}")
+
+
+def read_upload(file, kind):
+    """
+    Read an uploaded CSV of the given kind ('community', 'clinic', 'charlie',
+    'costs' or 'report') into a DataFrame of the columns the pipeline uses.
+
+    Raises InputError if the file is empty, lacks a required column or
+    cannot be parsed.
+    """
+    spec = UPLOADS[kind]
+
+    # Read the upload once; the header check and the parse share the bytes
+    file.seek(0)
+    data = file.read()
+    encoding = sample_encoding(data)
+    check_columns(read_header(io.BytesIO(data), encoding, kind), kind)
+
+    engine = csv_engine(len(data))
+    with metrics.span('csv_read', file=kind, bytes=len(data), engine=engine):
+        while True:
+            try:
+                df = pd.read_csv(io.BytesIO(data), encoding=encoding, engine=engine,
+                                 usecols=spec['usecols'], dtype=spec['dtype'])
+                break
+            except UnicodeDecodeError:
+                # Only the sample was utf-8; latin1 decodes anything
+                logger.info("%s file is not utf-8 past the first %d bytes, reading it as latin1", kind, ENCODING_SAMPLE_BYTES)
+                encoding = 'latin1'
+            except pd.errors.ParserError as e:
+                # pyarrow rejects some files the C parser accepts, such as rows with missing trailing fields
+                if engine == 'c':
+                    raise InputError(f"{spec['error']}: {str(e)}")
+                logger.debug("pyarrow could not parse the %s file (%s), using the C parser", kind, e)
+                engine = 'c'
+            except ValueError as e:
+                raise InputError(f"{spec['error']}: {str(e)}")
+
+    if engine == 'pyarrow':
+        # pyarrow gives None for empty text fields where the C parser gives NaN
+        text_columns = df.columns[df.dtypes == object]
+        df[text_columns] = df[text_columns].where(df[text_columns].notna(), np.nan)
+
+    logger.debug("Read %s file with %s encoding and %s engine: shape=%s columns=%s",
+                 kind, encoding, engine, df.shape, df.columns.tolist())
+    return df
+
+
+def read_upload_chunks(file, kind, chunk_rows):
+    """
+    Like read_upload, but yield the file chunk_rows rows at a time so only
+    one chunk is parsed into memory. The whole file is checked for utf-8
+    first, a block at a time, so a late non-utf-8 byte cannot change the
+    encoding halfway through.
+    """
+    spec = UPLOADS[kind]
+    encoding = detect_encoding(file)
+    check_columns(read_header(file, encoding, kind), kind)
+    file.seek(0)
+    logger.debug("Reading %s file in chunks of %d rows with %s encoding", kind, chunk_rows, encoding)
+
+    chunks = pd.read_csv(file, encoding=encoding, usecols=spec['usecols'], dtype=spec['dtype'], chunksize=chunk_rows)
+    return _checked_chunks(chunks, spec)
+
+
+def _checked_chunks(chunks, spec):
+    try:
+        yield from chunks
+    except ValueError as e:
+        raise InputError(f"{spec['error']}: {str(e)}")
@@ -0,0 +1,350 @@
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+
+from config import (
+    CACHE_DIR,
+    JOB_MAX_ATTEMPTS,
+    JOB_QUEUE_LIMIT,
+    JOB_RETENTION_SECONDS,
+    JOB_STALE_SECONDS,
+    JOB_WORKERS,
+)
+from datasets import get_dataset_registry
+from metrics import metrics
+from pipeline import InputError, run_pipeline, save_report
+from result_cache import get_result_cache, request_key
+from result_store import get_result_store, store_result
+
+logger = logging.getLogger(__name__)
+
+JOBS_DIR = os.path.join(CACHE_DIR, 'jobs')
+JOBS_DB_PATH = os.path.join(CACHE_DIR, 'jobs.sqlite')
+
+INPUT_FILES = ['community_file', 'clinic_file', 'charlie_file', 'costs_file']
+
+# Seconds between queue polls and between heartbeats of running jobs
+POLL_INTERVAL = 2
+HEARTBEAT_INTERVAL = 15
+
+
+def open_input(job_dir, name):
+    """A job's saved input file, or the registered dataset it names"""
+    dataset_path = os.path.join(job_dir, f"{name}.dataset")
+    if not os.path.exists(dataset_path):
+        return open(os.path.join(job_dir, f"{name}.csv"), 'rb')
+
+    with open(dataset_path, encoding='utf-8') as f:
+        dataset_id = f.read().strip()
+    file = get_dataset_registry().open(dataset_id)
+    if file is None:
+        raise InputError(f"Dataset {dataset_id} was deleted before the job ran")
+    return file
+
+
+class QueueFullError(Exception):
+    """The job queue already holds JOB_QUEUE_LIMIT waiting jobs"""
+
+
+class JobStore:
+    """
+    Job queue and status table in SQLite, with job inputs and results kept
+    on disk under JOBS_DIR/<job id>/.
+
+    Everything lives outside the worker process, so queued jobs, and running
+    jobs whose worker died (no heartbeat for JOB_STALE_SECONDS), are picked up
+    again by any gunicorn worker.
+    """
+
+    def __init__(self, path=JOBS_DB_PATH, jobs_dir=JOBS_DIR):
+        self.path = path
+        self.jobs_dir = jobs_dir
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    stage TEXT,
+                    percent REAL NOT NULL DEFAULT 0,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    worker TEXT,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL,
+                    heartbeat_at REAL,
+                    result_id TEXT
+                )
+                """
+            )
+            # Databases created before results were stored for querying lack result_id
+            if 'result_id' not in {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}:
+                try:
+                    conn.execute("ALTER TABLE jobs ADD COLUMN result_id TEXT")
+                except sqlite3.OperationalError:
+                    # Another worker added it first
+                    pass
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_dir, job_id)
+
+    def result_path(self, job_id):
+        return os.path.join(self.job_dir(job_id), 'result.csv')
+
+    def submit(self, files):
+        """Save the uploaded files and queue a job for them. Returns the job id."""
+        conn = self._connection()
+        queued = conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+        if queued >= JOB_QUEUE_LIMIT:
+            raise QueueFullError(f"The job queue is full ({queued} jobs waiting), try again later")
+
+        job_id = uuid.uuid4().hex
+        job_dir = self.job_dir(job_id)
+        os.makedirs(job_dir, exist_ok=True)
+        for name in INPUT_FILES:
+            dataset_id = getattr(files[name], 'dataset_id', None)
+            if dataset_id is not None:
+                # Registered datasets are referenced, not copied
+                with open(os.path.join(job_dir, f"{name}.dataset"), 'w', encoding='utf-8') as f:
+                    f.write(dataset_id)
+            else:
+                files[name].save(os.path.join(job_dir, f"{name}.csv"))
+
+        conn.execute(
+            "INSERT INTO jobs (id, status, stage, created_at) VALUES (?, 'queued', 'queued', ?)",
+            (job_id, time.time())
+        )
+        return job_id
+
+    def get(self, job_id):
+        row = self._connection().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['error'] = json.loads(job['error']) if job['error'] else None
+        return job
+
+    def claim(self, worker):
+        """Atomically move the oldest queued job to running. Returns its id or None."""
+        conn = self._connection()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is not None:
+                conn.execute(
+                    "UPDATE jobs SET status = 'running', worker = ?, attempts = attempts + 1, "
+                    "started_at = ?, heartbeat_at = ? WHERE id = ?",
+                    (worker, now, now, row['id'])
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return row['id'] if row is not None else None
+
+    def update_progress(self, job_id, stage, percent):
+        self._connection().execute(
+            "UPDATE jobs SET stage = ?, percent = ?, heartbeat_at = ? WHERE id = ?",
+            (stage, percent, time.time(), job_id)
+        )
+
+    def heartbeat(self, job_ids):
+        now = time.time()
+        self._connection().executemany(
+            "UPDATE jobs SET heartbeat_at = ? WHERE id = ? AND status = 'running'",
+            [(now, job_id) for job_id in job_ids]
+        )
+
+    def finish(self, job_id, result_id=None):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'done', stage = 'done', percent = 100, finished_at = ?, result_id = ? "
+            "WHERE id = ?",
+            (time.time(), result_id, job_id)
+        )
+
+    def fail(self, job_id, error):
+        self._connection().execute(
+            "UPDATE jobs SET status = 'failed', stage = 'failed', error = ?, finished_at = ? WHERE id = ?",
+            (json.dumps(error), time.time(), job_id)
+        )
+
+    def recover_stale(self):
+        """Requeue running jobs whose worker stopped sending heartbeats"""
+        conn = self._connection()
+        cutoff = time.time() - JOB_STALE_SECONDS
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "UPDATE jobs SET status = 'failed', stage = 'failed', error = ?, finished_at = ? "
+                "WHERE status = 'running' AND heartbeat_at < ? AND attempts >= ?",
+                (json.dumps({"error": "Job was interrupted too many times"}), time.time(), cutoff, JOB_MAX_ATTEMPTS)
+            )
+            requeued = conn.execute(
+                "UPDATE jobs SET status = 'queued', stage = 'queued', percent = 0, worker = NULL "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (cutoff,)
+            ).rowcount
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        if requeued:
+            logger.warning("Requeued %d interrupted job(s)", requeued)
+
+    def purge_expired(self):
+        """Delete finished jobs, and their files, older than JOB_RETENTION_SECONDS"""
+        conn = self._connection()
+        cutoff = time.time() - JOB_RETENTION_SECONDS
+        expired = [row['id'] for row in conn.execute(
+            "SELECT id FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (cutoff,)
+        )]
+        for job_id in expired:
+            shutil.rmtree(self.job_dir(job_id), ignore_errors=True)
+            conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+class JobRunner:
+    """
+    Background threads that take jobs from the JobStore and run the pipeline
+    on them. One runner is started per worker process.
+    """
+
+    def __init__(self, store=None, workers=JOB_WORKERS):
+        self.store = store if store is not None else JobStore()
+        self.workers = workers
+        self.worker_id = f"{os.uname().nodename}:{os.getpid()}"
+        self._wakeup = threading.Event()
+        self._running = set()
+        self._running_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self.store.recover_stale()
+        self.store.purge_expired()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._work_loop, name=f"job-runner-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        thread = threading.Thread(target=self._heartbeat_loop, name="job-heartbeat", daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def submit(self, files):
+        job_id = self.store.submit(files)
+        self._wakeup.set()
+        return job_id
+
+    def _work_loop(self):
+        while True:
+            try:
+                job_id = self.store.claim(self.worker_id)
+            except sqlite3.Error as e:
+                logger.warning("Could not claim a job: %s", e)
+                job_id = None
+            if job_id is None:
+                self._wakeup.wait(POLL_INTERVAL)
+                self._wakeup.clear()
+                continue
+            with self._running_lock:
+                self._running.add(job_id)
+            try:
+                self._run(job_id)
+            finally:
+                with self._running_lock:
+                    self._running.discard(job_id)
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            try:
+                with self._running_lock:
+                    running = list(self._running)
+                if running:
+                    self.store.heartbeat(running)
+                self.store.recover_stale()
+            except sqlite3.Error as e:
+                logger.warning("Job heartbeat failed: %s", e)
+
+    def _run(self, job_id):
+        logger.info("Starting job %s", job_id)
+        job_dir = self.store.job_dir(job_id)
+        inputs = {}
+        try:
+            for name in INPUT_FILES:
+                inputs[name] = open_input(job_dir, name)
+            files = [inputs[name] for name in INPUT_FILES]
+            result_path = self.store.result_path(job_id)
+
+            # Reuse a cached report for identical inputs, and cache new ones
+            cache = get_result_cache()
+            cache_key = request_key(*files)
+            cached_path = cache.get(cache_key)
+            if cached_path is not None:
+                logger.info("Job %s: result cache hit %s", job_id, cache_key)
+                shutil.copyfile(cached_path, result_path)
+                result_id = cache_key if get_result_store().get(cache_key) is not None else None
+            else:
+                final_result_df = run_pipeline(
+                    *files, progress=lambda stage, percent: self.store.update_progress(job_id, stage, percent)
+                )
+                save_report(final_result_df, result_path)
+                result_id = store_result(cache_key, final_result_df)
+                if cache.enabled:
+                    try:
+                        cache.put(cache_key, lambda path: shutil.copyfile(result_path, path))
+                    except OSError as e:
+                        logger.warning("Could not cache report: %s", e)
+            self.store.finish(job_id, result_id)
+            metrics.inc('jobs_total', status='done')
+            logger.info("Job %s completed", job_id)
+        except InputError as e:
+            self.store.fail(job_id, e.to_dict())
+            metrics.inc('jobs_total', status='failed')
+        except Exception as e:
+            logger.exception("Error in job %s: %s", job_id, e)
+            self.store.fail(job_id, {"error": str(e)})
+            metrics.inc('jobs_total', status='failed')
+        finally:
+            for f in inputs.values():
+                f.close()
+            metrics.flush()
+
+
+_job_runner = None
+_job_runner_lock = threading.Lock()
+
+
+def get_job_runner():
+    """
+    Process-wide JobRunner, started on first use. With preload_app the
+    runner must be created after fork; gunicorn.conf.py starts it in
+    post_fork so queued and orphaned jobs resume without waiting for a request.
+    """
+    global _job_runner
+    with _job_runner_lock:
+        if _job_runner is None or _job_runner.worker_id.split(':')[-1] != str(os.getpid()):
+            _job_runner = JobRunner()
+            _job_runner.start()
+        return _job_runner
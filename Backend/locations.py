@@ -0,0 +1,54 @@
+"""
+Communities grouped by location, so rows at one place are searched, routed
+and costed once.
+
+Community files often repeat a location: sub-localities, duplicate postal
+points, repeated titles. Rows with the same coordinates, or the same once
+rounded to LOCATION_SNAP_DECIMALS decimal places, are one location, routed
+from its first row's coordinates; the results are spread back to every row,
+and each row keeps its own title and coordinates in the report.
+"""
+import numpy as np
+import pandas as pd
+
+from config import LOCATION_SNAP_DECIMALS
+
+
+def distinct_pairs(first_values, second_values):
+    """
+    (first, inverse) for the distinct (first_values[i], second_values[i])
+    pairs, in order of first appearance: each pair's first row, and each
+    row's pair
+    """
+    first_values = np.asarray(first_values, dtype=np.float64)
+    second_values = np.asarray(second_values, dtype=np.float64)
+    # +0.0 folds -0.0 into 0.0, so the two are one value as they compare equal
+    inverse, _ = pd.factorize((first_values + 0.0) + 1j * (second_values + 0.0))
+    _, first = np.unique(inverse, return_index=True)
+    return first, inverse
+
+
+def group_locations(community_df, decimals=LOCATION_SNAP_DECIMALS):
+    """
+    (first, inverse, stats) for the locations of community_df's rows: each
+    location's first row, each row's location and {'rows', 'locations',
+    'collapsed'}
+    """
+    lat = community_df['Latitude'].to_numpy(dtype=np.float64)
+    lng = community_df['Longitude'].to_numpy(dtype=np.float64)
+    if decimals is not None:
+        lat, lng = np.round(lat, decimals), np.round(lng, decimals)
+    first, inverse = distinct_pairs(lat, lng)
+    stats = {'rows': len(inverse), 'locations': len(first), 'collapsed': len(inverse) - len(first)}
+    return first, inverse, stats
+
+
+def spread_rows(location_routes, inverse, community_df):
+    """Routes computed per location spread to community_df's rows, with each row's own title and coordinates"""
+    # Without repeated locations, every row is its own location, in order
+    if len(location_routes) == len(inverse) and np.array_equal(inverse, np.arange(len(inverse))):
+        return location_routes
+    routes = location_routes.iloc[inverse].reset_index(drop=True)
+    for column in ('Title', 'Latitude', 'Longitude'):
+        routes[column] = community_df[column].to_numpy()
+    return routes
@@ -0,0 +1,308 @@
+import atexit
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from config import METRICS_DIR, METRICS_FLUSH_SECONDS
+
+try:
+    import fcntl
+except ImportError:  # Not on Windows: snapshots of exited workers are then kept as they are
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Snapshot that the values of exited workers are folded into
+AGGREGATE_NAME = 'aggregate.json'
+
+# Upper bounds, in seconds, of the duration histogram buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+METRIC_HELP = {
+    'pipeline_stage_seconds': ('histogram', 'Time spent in each pipeline stage'),
+    'http_request_duration_seconds': ('histogram', 'Time to produce each HTTP response'),
+    'http_requests_total': ('counter', 'HTTP requests by endpoint and status'),
+    'pipeline_rows_total': ('counter', 'Community rows processed by the pipeline'),
+    'routing_pairs_total': ('counter', 'Community-clinic pairs sent to the routing backend'),
+    'routing_fallback_pairs_total': ('counter', 'Pairs that fell back to the geodesic distance'),
+    'routing_http_requests_total': ('counter', 'HTTP requests sent to the router, including retries'),
+    'routing_http_retries_total': ('counter', 'Router requests that were retried'),
+    'routing_short_circuited_total': ('counter', 'Router requests skipped because the circuit breaker was open'),
+    'cache_hits_total': ('counter', 'Cache hits by cache'),
+    'cache_misses_total': ('counter', 'Cache misses by cache'),
+    'cache_evictions_total': ('counter', 'Cache entries evicted by cache'),
+    'equation_errors_total': ('counter', 'Costs-file equations that failed to compile or evaluate'),
+    'jobs_total': ('counter', 'Background jobs finished, by status'),
+}
+
+
+def _label_key(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (
+        (key, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for key, value in pairs
+    )
+    return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+
+def _add_snapshot(counters, histograms, snapshot):
+    """Add a snapshot's values to counters and histograms (labels may come back from JSON as lists)"""
+    for name, labels, value in snapshot['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, h in snapshot['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        merged = histograms.setdefault(key, {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0})
+        merged['buckets'] = [a + b for a, b in zip(merged['buckets'], h['buckets'])]
+        merged['sum'] += h['sum']
+        merged['count'] += h['count']
+
+
+def _read_snapshot(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_snapshot(path, snapshot):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def _snapshot_pid(path):
+    """The PID a worker's snapshot file is named after, or None for other files"""
+    pid = os.path.basename(path).split('-', 1)[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # e.g. EPERM: the PID exists but belongs to another user
+        return True
+    return True
+
+
+class Metrics:
+    """
+    Counters and duration histograms for this process, rendered in the
+    Prometheus text format.
+
+    Each gunicorn worker keeps its own values and writes a snapshot of them
+    to METRICS_DIR on flush(), at most every METRICS_FLUSH_SECONDS unless a
+    scrape forces it; render() adds up the snapshots of every worker, so a
+    scrape sees the whole service whichever worker answers it. Snapshots of
+    workers that have exited are folded into AGGREGATE_NAME, so totals keep
+    growing across recycled workers without the directory growing with them.
+    """
+
+    def __init__(self, directory=METRICS_DIR):
+        self.directory = directory
+        self._pid = None
+        self._snapshot_name = None
+        self._reset()
+
+    def _reset(self):
+        """
+        Start with no values and a new lock; run in forked children, whose
+        copy of the lock may have been held by another of the parent's threads
+        """
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+        self._flushed_at = None
+        self._flush_timer = None
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _label_key(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {'buckets': [0] * len(DURATION_BUCKETS), 'sum': 0.0, 'count': 0}
+            # Buckets are cumulative, as Prometheus expects
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['sum'] += seconds
+            histogram['count'] += 1
+
+    @contextmanager
+    def span(self, stage, **fields):
+        """
+        Time a pipeline stage into pipeline_stage_seconds and log it, with any
+        extra fields (e.g. rows=...), at debug level.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            self.observe('pipeline_stage_seconds', seconds, stage=stage)
+            if logger.isEnabledFor(logging.DEBUG):
+                extra = ''.join(f" {key}={value}" for key, value in fields.items())
+                logger.debug("stage=%s seconds=%.4f%s", stage, seconds, extra)
+
+    def snapshot(self):
+        with self._lock:
+            return self._snapshot()
+
+    def _snapshot(self):
+        return {
+            'counters': [[name, labels, value] for (name, labels), value in self._counters.items()],
+            'histograms': [[name, labels, dict(h, buckets=list(h['buckets']))]
+                           for (name, labels), h in self._histograms.items()],
+        }
+
+    def drain(self):
+        """This process's snapshot, clearing its values, for merge() in another process"""
+        with self._lock:
+            snapshot = self._snapshot()
+            self._counters = {}
+            self._histograms = {}
+        return snapshot
+
+    def merge(self, snapshot):
+        """Add the values of a snapshot taken in another process (see drain)"""
+        with self._lock:
+            _add_snapshot(self._counters, self._histograms, snapshot)
+
+    def flush(self, force=False):
+        """
+        Write this process's snapshot for render() in any worker to pick up.
+        Unless forced, a write within METRICS_FLUSH_SECONDS of the last one is
+        put off until that interval is up.
+        """
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._flushed_at is not None and now - self._flushed_at < METRICS_FLUSH_SECONDS:
+                if self._flush_timer is None:
+                    # Write the values anyway once the interval is up, in case no other request comes
+                    self._flush_timer = threading.Timer(
+                        METRICS_FLUSH_SECONDS - (now - self._flushed_at), self.flush, kwargs={'force': True}
+                    )
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._flushed_at = now
+            snapshot = self._snapshot()
+        if self._pid != os.getpid():
+            # A forked worker starts its own snapshot rather than overwriting its parent's
+            self._pid = os.getpid()
+            self._snapshot_name = f"{self._pid}-{uuid.uuid4().hex[:8]}.json"
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            _write_snapshot(os.path.join(self.directory, self._snapshot_name), snapshot)
+        except OSError as e:
+            logger.warning("Could not write metrics snapshot: %s", e)
+
+    def _fold_exited(self, paths):
+        """
+        Fold the snapshots of workers that are no longer running into
+        AGGREGATE_NAME and delete them; returns the paths that are left
+        """
+        pids = {path: _snapshot_pid(path) for path in paths}
+        exited = [path for path, pid in pids.items()
+                  if pid is not None and pid != os.getpid() and not _is_running(pid)]
+        if not exited:
+            return paths
+        aggregate_path = os.path.join(self.directory, AGGREGATE_NAME)
+        counters, histograms = {}, {}
+        for path in [aggregate_path] + exited:
+            snapshot = _read_snapshot(path)
+            if snapshot is not None:
+                _add_snapshot(counters, histograms, snapshot)
+        try:
+            _write_snapshot(aggregate_path, {
+                'counters': [[name, labels, value] for (name, labels), value in counters.items()],
+                'histograms': [[name, labels, h] for (name, labels), h in histograms.items()],
+            })
+            for path in exited:
+                os.remove(path)
+        except OSError as e:
+            logger.warning("Could not fold metrics snapshots: %s", e)
+            return paths
+        logger.debug("Folded %d metrics snapshots of exited workers", len(exited))
+        return [path for path in paths if path not in exited and path != aggregate_path] + [aggregate_path]
+
+    def _merged(self):
+        counters = {}
+        histograms = {}
+        pattern = os.path.join(self.directory, '*.json')
+        if fcntl is None:
+            snapshots = [_read_snapshot(path) for path in glob.glob(pattern)]
+        else:
+            # Folding and reading under one lock, so that no scrape counts a
+            # snapshot both in the aggregate and in its own file
+            os.makedirs(self.directory, exist_ok=True)
+            with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                paths = self._fold_exited(glob.glob(pattern))
+                snapshots = [_read_snapshot(path) for path in paths]
+        for snapshot in snapshots:
+            if snapshot is not None:
+                _add_snapshot(counters, histograms, snapshot)
+        return counters, histograms
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format"""
+        self.flush(force=True)
+        counters, histograms = self._merged()
+        lines = []
+        names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+        for name in names:
+            kind, help_text = METRIC_HELP.get(name, ('untyped', name))
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f"{name}{_format_labels(labels)} {value}")
+            for (metric, labels), h in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, count in zip(DURATION_BUCKETS, h['buckets']):
+                    lines.append(f"{name}_bucket{_format_labels(labels, [('le', str(bound))])} {count}")
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {h['count']}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {h['sum']}")
+                lines.append(f"{name}_count{_format_labels(labels)} {h['count']}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+# A forked child (a gunicorn worker, a shard pool process) counts only what it
+# does itself, and must not inherit a lock held at the moment of the fork
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics._reset)
+
+
+@atexit.register
+def _flush_at_exit():
+    # Write what a worker counted since its last flush before it exits
+    if metrics._flushed_at is not None:
+        metrics.flush(force=True)
@@ -0,0 +1,258 @@
+"""
+Matching community names in the results to those in the charlie encounters
+file.
+
+Names are normalized with pandas string operations, once per distinct name
+(and remembered across requests), and joined exactly. Names left unmatched
+can optionally fall back to a fuzzy match against the charlie names nothing
+matched exactly: both sides are broken into character trigrams, an inverted
+index from trigram to charlie name picks the candidates that could reach
+the similarity threshold, and the candidate with the highest Dice
+similarity wins if it does. Only those candidates are scored, never every
+pair of names.
+"""
+import logging
+import re
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# Normalized names remembered across requests; cleared when full
+NAME_CACHE_SIZE = 200_000
+# Unmatched and fuzzy-matched names listed in the match statistics
+REPORT_NAMES_LIMIT = 50
+# Unmatched names scored together in fuzzy matching; bounds the candidate pairs held in memory
+FUZZY_BATCH_SIZE = 64
+
+_normalized_names = {}
+
+
+def _normalize_unique(names):
+    """
+    Normalize an array of distinct, non-null names with vectorized string
+    operations: Unicode NFKC, en and em dashes to hyphens, surrounding
+    whitespace stripped and runs of whitespace collapsed to one space.
+    """
+    normalized = pd.Series(names, dtype=object).astype(str)
+    # NFKC also turns NBSP into a space
+    normalized = normalized.str.normalize("NFKC")
+    normalized = normalized.str.replace("\u2013", "-", regex=False).str.replace("\u2014", "-", regex=False)
+    normalized = normalized.str.strip()
+    # Collapsing whitespace is the costly step, so only do it where there is something to collapse
+    spaced = normalized.str.contains(r"\s\s|[^\S ]", regex=True).to_numpy(dtype=bool)
+    if spaced.any():
+        normalized[spaced] = normalized[spaced].str.replace(r"\s+", " ", regex=True)
+    return normalized.to_numpy(dtype=object)
+
+
+def normalize_names(names):
+    """
+    Normalize a Series of names (see _normalize_unique), computing each
+    distinct name once and reusing names normalized by earlier calls.
+    """
+    codes, uniques = pd.factorize(names, use_na_sentinel=True)
+    uniques = np.asarray(uniques, dtype=object)
+    normalized = np.array([_normalized_names.get(name) for name in uniques], dtype=object)
+
+    missing = np.array([value is None for value in normalized], dtype=bool)
+    if missing.any():
+        normalized[missing] = _normalize_unique(uniques[missing])
+        if len(_normalized_names) + int(missing.sum()) > NAME_CACHE_SIZE:
+            _normalized_names.clear()
+        _normalized_names.update(zip(uniques[missing], normalized[missing]))
+
+    # Nulls (code -1) stay null
+    result = np.append(normalized, np.nan)[codes]
+    return pd.Series(result, index=names.index, dtype=object)
+
+
+def name_trigrams(name):
+    """The distinct character trigrams of a name, case- and punctuation-insensitive"""
+    words = re.sub(r'[\W_]+', ' ', name.casefold()).strip()
+    key = f" {words} "
+    return {key[i:i + 3] for i in range(len(key) - 2)}
+
+
+class TrigramIndex:
+    """
+    Index of names for finding, for a query name, the most similar one with
+    a trigram Dice similarity of at least threshold (0-1).
+
+    Uses prefix filtering: trigrams are ranked rarest first, and a pair of
+    names with Dice similarity t shares at least t / (2 - t) of either
+    name's trigrams, so they must share a trigram among the first
+    (size - that many + 1) of each. Only those prefix trigrams of each
+    indexed name are posted, and only names found through the query's own
+    prefix trigrams are scored.
+    """
+
+    def __init__(self, names, threshold):
+        self.names = list(names)
+        self.threshold = threshold
+        grams = [name_trigrams(name) for name in self.names]
+
+        # Trigram ids in rarest-first order (ties broken by the trigram itself)
+        frequency = {}
+        for name_grams in grams:
+            for gram in name_grams:
+                frequency[gram] = frequency.get(gram, 0) + 1
+        self.gram_ids = {gram: i for i, gram in enumerate(sorted(frequency, key=lambda gram: (frequency[gram], gram)))}
+
+        # Each name's trigram ids, rarest first, in CSR form
+        self.sizes = np.array([len(name_grams) for name_grams in grams], dtype=np.int64)
+        self.indptr = np.concatenate(([0], np.cumsum(self.sizes)))
+        self.indices = np.fromiter(
+            (gram_id for name_grams in grams for gram_id in sorted(self.gram_ids[gram] for gram in name_grams)),
+            dtype=np.int64, count=int(self.indptr[-1])
+        )
+
+        # Postings of each name's prefix trigrams, grouped by trigram id
+        prefix = self.sizes - self._min_shared(self.sizes) + 1
+        position = np.arange(len(self.indices)) - np.repeat(self.indptr[:-1], self.sizes)
+        in_prefix = position < np.repeat(prefix, self.sizes)
+        posted_grams = self.indices[in_prefix]
+        posted_names = np.repeat(np.arange(len(self.names)), self.sizes)[in_prefix]
+        order = np.argsort(posted_grams, kind='stable')
+        self.posted_grams = posted_grams[order]
+        self.posted_names = posted_names[order]
+
+    def _min_shared(self, size):
+        """The fewest trigrams a name of this size shares with any name at least threshold similar"""
+        return np.ceil(self.threshold * np.asarray(size) / (2 - self.threshold) - 1e-9).astype(np.int64)
+
+    def best_matches(self, queries, batch_size=FUZZY_BATCH_SIZE):
+        """
+        For each query name, the most similar indexed name and its
+        similarity, or (None, 0.0) if none reaches the threshold. Queries
+        are scored batch_size at a time, all candidate pairs of a batch at once.
+        """
+        results = []
+        for start in range(0, len(queries), batch_size):
+            results.extend(self._best_matches(queries[start:start + batch_size]))
+        return results
+
+    def _expand(self, starts, lengths):
+        """Positions start, start + 1, ..., start + length - 1 for each start and length, concatenated"""
+        offsets = np.cumsum(lengths) - lengths
+        return np.repeat(starts - offsets, lengths) + np.arange(int(lengths.sum()))
+
+    def _best_matches(self, queries):
+        # Each query's indexed trigram ids, rarest first, and how many of them are in its prefix
+        query_sizes = np.empty(len(queries), dtype=np.int64)
+        query_prefix = np.empty(len(queries), dtype=np.int64)
+        known = []
+        for i, query in enumerate(queries):
+            grams = name_trigrams(query)
+            ids = sorted(self.gram_ids[gram] for gram in grams if gram in self.gram_ids)
+            query_sizes[i] = len(grams)
+            # Trigrams no indexed name has rank rarest of all, so they take up the prefix first
+            query_prefix[i] = len(ids) - int(self._min_shared(len(grams))) + 1 if grams else 0
+            known.append(ids)
+        known_sizes = np.array([len(ids) for ids in known], dtype=np.int64)
+        known_ids = np.fromiter((gram_id for ids in known for gram_id in ids), dtype=np.int64,
+                                count=int(known_sizes.sum()))
+        known_queries = np.repeat(np.arange(len(queries)), known_sizes)
+        query_prefix = np.clip(query_prefix, 0, known_sizes)
+
+        # Candidate pairs: indexed names posted under one of the query's prefix trigrams
+        position = np.arange(len(known_ids)) - np.repeat(np.cumsum(known_sizes) - known_sizes, known_sizes)
+        in_prefix = position < np.repeat(query_prefix, known_sizes)
+        prefix_ids, prefix_queries = known_ids[in_prefix], known_queries[in_prefix]
+        starts = np.searchsorted(self.posted_grams, prefix_ids, side='left')
+        lengths = np.searchsorted(self.posted_grams, prefix_ids, side='right') - starts
+        pair_names = self.posted_names[self._expand(starts, lengths)]
+        pair_queries = np.repeat(prefix_queries, lengths)
+        pairs = np.sort(pair_queries * len(self.names) + pair_names)
+        pairs = pairs[np.concatenate(([True], pairs[1:] != pairs[:-1]))] if len(pairs) else pairs
+        pair_queries, pair_names = pairs // len(self.names), pairs % len(self.names)
+
+        # Names too much shorter or longer than the query cannot reach the threshold
+        name_sizes, sizes = self.sizes[pair_names], query_sizes[pair_queries]
+        keep = (name_sizes >= self._min_shared(sizes)) & (self._min_shared(name_sizes) <= sizes)
+        pair_queries, pair_names, name_sizes = pair_queries[keep], pair_names[keep], name_sizes[keep]
+
+        # Trigrams each pair shares: look each of the name's trigrams up in a
+        # query x trigram table of the batch's queries
+        in_query = np.zeros((len(queries), len(self.gram_ids)), dtype=bool)
+        in_query[known_queries, known_ids] = True
+        pair_grams = self.indices[self._expand(self.indptr[pair_names], name_sizes)]
+        hit = in_query[np.repeat(pair_queries, name_sizes), pair_grams]
+        shared = np.add.reduceat(hit, np.cumsum(name_sizes) - name_sizes, dtype=np.int64) if len(hit) else name_sizes
+        dice = 2 * shared / (query_sizes[pair_queries] + name_sizes)
+
+        # Best pair per query: highest similarity, then the earliest indexed name
+        order = np.lexsort((pair_names, -dice, pair_queries))
+        first = order[np.concatenate(([True], pair_queries[order][1:] != pair_queries[order][:-1]))] if len(order) else order
+        results = [(None, 0.0)] * len(queries)
+        for pair in first:
+            if dice[pair] >= self.threshold:
+                results[pair_queries[pair]] = (self.names[pair_names[pair]], float(dice[pair]))
+        return results
+
+
+def fuzzy_matches(unmatched_names, candidate_names, threshold):
+    """
+    For each unmatched name, the candidate name it fuzzily matches, if any:
+    {unmatched name: (candidate name, similarity)}.
+    """
+    if not len(unmatched_names) or not len(candidate_names):
+        return {}
+    index = TrigramIndex(candidate_names, threshold)
+    best = index.best_matches(list(unmatched_names))
+    matches = {name: (match, score) for name, (match, score) in zip(unmatched_names, best) if match is not None}
+    logger.debug("Fuzzy matched %d of %d unmatched names against %d candidates",
+                 len(matches), len(unmatched_names), len(candidate_names))
+    return matches
+
+
+def match_names(titles, community_names, fuzzy_threshold=0.0, exact_names=None):
+    """
+    Match normalized result titles to normalized charlie community names.
+
+    Returns the join key for each title (the charlie name it matches, or the
+    title itself when nothing matches) and the match statistics: how many
+    rows matched exactly, fuzzily or not at all, and examples of each.
+    Fuzzy matching is off when fuzzy_threshold is 0.
+
+    exact_names are the charlie names some title matches exactly, which
+    fuzzy matching leaves out; they default to those the given titles
+    match, so pass them in when titles are only part of a run's titles.
+    """
+    charlie_names = pd.unique(community_names.dropna())
+    exact = titles.isin(charlie_names).to_numpy()
+    keys = titles.copy()
+
+    unmatched_titles = pd.unique(titles[~exact].dropna())
+    matches = {}
+    if fuzzy_threshold > 0 and len(unmatched_titles):
+        # Leftovers are matched to leftovers: a charlie name some title already
+        # matches exactly is not offered to the unmatched titles
+        if exact_names is None:
+            exact_names = titles
+        unused_names = charlie_names[~pd.Series(charlie_names).isin(exact_names).to_numpy()]
+        matches = fuzzy_matches(unmatched_titles, unused_names, fuzzy_threshold)
+        if matches:
+            fuzzy = titles.isin(list(matches)).to_numpy() & ~exact
+            keys[fuzzy] = titles[fuzzy].map(lambda title: matches[title][0])
+
+    matched_rows = int(keys.isin(charlie_names).sum())
+    unmatched = [title for title in unmatched_titles if title not in matches]
+    used = set(keys[exact]) | {match for match, _ in matches.values()}
+    stats = {
+        'rows': len(titles),
+        'exact': int(exact.sum()),
+        'fuzzy': matched_rows - int(exact.sum()),
+        'unmatched': len(titles) - matched_rows,
+        'match_rate': round(matched_rows / len(titles), 4) if len(titles) else 1.0,
+        'charlie_names': len(charlie_names),
+        'charlie_names_unused': len(charlie_names) - len(used),
+        'fuzzy_threshold': fuzzy_threshold,
+        'fuzzy_matches': [
+            {'name': name, 'match': match, 'score': round(score, 3)}
+            for name, (match, score) in list(matches.items())[:REPORT_NAMES_LIMIT]
+        ],
+        'unmatched_names': unmatched[:REPORT_NAMES_LIMIT],
+    }
+    return keys, stats
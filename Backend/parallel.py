@@ -0,0 +1,84 @@
+"""
+Process pool for running the per-community stages of one run in shards on
+several cores.
+
+The pool is forked for the run, after the run's read-only data (clinic
+index, parsed inputs, compiled equations) has been prepared in the worker,
+so every pool process sees that data without it being pickled; tasks only
+carry their shard's bounds and small per-shard inputs. The metrics a task
+records in its pool process are sent back with its result and added to the
+parent's, so /metrics counts sharded runs like serial ones.
+"""
+import logging
+import multiprocessing
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# The run's shared data, in the pool processes
+_shared = None
+
+
+def fork_available():
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+
+def shard_bounds(rows, shard_rows):
+    """(start, stop) of each shard of rows rows, in order"""
+    return [(start, min(start + shard_rows, rows)) for start in range(0, rows, shard_rows)]
+
+
+def _set_shared(shared):
+    global _shared
+    _shared = shared
+
+
+def _call(function, args):
+    """Run a task in a pool process; returns its result and the metrics it recorded"""
+    result = function(_shared, *args)
+    return result, metrics.drain()
+
+
+def _unpack(task, future):
+    """Settle future with task's result, adding the metrics it recorded to this process's"""
+    if task.cancelled():
+        future.cancel()
+        return
+    try:
+        result, recorded = task.result()
+    except BaseException as e:
+        future.set_exception(e)
+        return
+    metrics.merge(recorded)
+    future.set_result(result)
+
+
+class ShardPool:
+    """
+    A process pool sharing one run's data: submit(function, *args) runs
+    function(shared, *args) in a pool process. function must be a module
+    level function. Use as a context manager.
+    """
+
+    def __init__(self, processes, shared):
+        # Forked children get initargs as they are, without pickling them
+        self._executor = ProcessPoolExecutor(
+            max_workers=processes, mp_context=multiprocessing.get_context('fork'),
+            initializer=_set_shared, initargs=(shared,)
+        )
+        self.processes = processes
+
+    def submit(self, function, *args):
+        future = Future()
+        task = self._executor.submit(_call, function, args)
+        task.add_done_callback(lambda task: _unpack(task, future))
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        # Drop queued shards if the run failed
+        self._executor.shutdown(wait=True, cancel_futures=exc_type is not None)
@@ -0,0 +1,1118 @@
+import logging
+
+import numpy as np
+import pandas as pd
+
+from compact import DecodedColumns, column_array, compact_array, compactable, finalize
+from config import (
+    NAME_MATCH_FUZZY_THRESHOLD, PIPELINE_PROCESSES, PIPELINE_SHARD_ROWS, ROUTING_MAX_CANDIDATES, STREAM_CHUNK_ROWS,
+)
+from cost_model import compute_unit_costs, load_cost_parameters
+from delta import REPORT_DECIMALS, report_routes, reusable_rows
+from distance import nearest_clinics
+from equations import EquationError, compile_equation
+from ingest import InputError, read_upload, read_upload_chunks
+from locations import distinct_pairs, group_locations, spread_rows
+from metrics import metrics
+from name_matching import match_names, normalize_names
+from parallel import ShardPool, fork_available, shard_bounds
+from report_formats import write_report
+from result_cache import get_stage_cache, route_parameters, route_stage_key
+from route_search import clinic_pairs, search_routes
+from routing import fill_fallback, get_routing_backend, route_pairs
+from spatial_index import get_clinic_index
+
+logger = logging.getLogger(__name__)
+
+# Columns of a routes frame (compute_routes) copied as-is into the stage 1 output
+ROUTE_LOCATION_COLUMNS = ['Title', 'Latitude', 'Longitude', 'Nearest Clinic', 'Clinic Latitude', 'Clinic Longitude']
+ROUTE_COLUMNS = ROUTE_LOCATION_COLUMNS + ['distance_km', 'haversine_km', 'duration_hours']
+
+# Clinic columns cached with the routes, so a delta run can tell which clinics changed
+CLINIC_COLUMNS = ['Facility Name', 'Latitude', 'Longitude']
+
+# Candidate clinics found per community up front; the routing search looks
+# further out only for the few communities that need it
+FIRST_CANDIDATES = 3
+
+# Encounter count columns of the charlie file, merged onto the results
+ENCOUNTER_COLUMNS = ['Encounters 0-14', 'Encounters 15-64', 'Encounters 65+']
+
+
+def _report_progress(progress, stage, percent):
+    if progress is not None:
+        progress(stage, percent)
+
+
+def prepare_communities(community_df):
+    """Validate community columns and coordinates, dropping rows without coordinates"""
+    # Check for required columns in community file
+    community_required = ['Title', 'Latitude', 'Longitude']
+    community_missing = [col for col in community_required if col not in community_df.columns]
+    if community_missing:
+        raise InputError(f"Community file is missing required columns: {', '.join(community_missing)}")
+
+    # Convert Title columns to string type
+    community_df['Title'] = community_df['Title'].astype(str)
+
+    # Clean and validate coordinates
+    community_df = community_df.dropna(subset=['Latitude', 'Longitude']).copy()
+
+    # Convert coordinates to float
+    try:
+        community_df['Latitude'] = community_df['Latitude'].astype(float)
+        community_df['Longitude'] = community_df['Longitude'].astype(float)
+    except (ValueError, TypeError) as e:
+        raise InputError(f"Invalid coordinate values: {str(e)}")
+
+    return community_df
+
+
+def prepare_clinics(clinic_df):
+    """Validate clinic columns and coordinates, renaming them to Facility Name / Latitude / Longitude"""
+    # Check for required columns in clinic file
+    clinic_required = ['Facility', 'latitude', 'longitude']
+    clinic_missing = [col for col in clinic_required if col not in clinic_df.columns]
+    if clinic_missing:
+        raise InputError(f"Clinic file is missing required columns: {', '.join(clinic_missing)}")
+
+    # Rename clinic columns for consistency
+    clinic_df.rename(columns={'latitude': 'Latitude', 'longitude': 'Longitude', 'Facility': 'Facility Name'}, inplace=True)
+    clinic_df['Facility Name'] = clinic_df['Facility Name'].astype(str)
+
+    # Clean and validate coordinates
+    clinic_df = clinic_df.dropna(subset=['Latitude', 'Longitude']).copy()
+
+    # Convert coordinates to float
+    try:
+        clinic_df['Latitude'] = clinic_df['Latitude'].astype(float)
+        clinic_df['Longitude'] = clinic_df['Longitude'].astype(float)
+    except (ValueError, TypeError) as e:
+        raise InputError(f"Invalid coordinate values: {str(e)}")
+
+    if clinic_df.empty:
+        raise InputError("Clinic file has no clinics with valid coordinates")
+
+    return clinic_df
+
+
+def registered_data(file):
+    """
+    A fresh copy of the parsed data behind a registered dataset (see
+    datasets.py), which the pipeline accepts in place of an uploaded file, or
+    None for an uploaded file.
+    """
+    parsed = getattr(file, 'parsed', None)
+    return parsed() if parsed is not None else None
+
+
+def read_clinics(clinic_file):
+    """Read and validate the clinic file, or take a registered clinic dataset as is"""
+    clinic_df = registered_data(clinic_file)
+    if clinic_df is not None:
+        return clinic_df
+
+    clinic_df = read_upload(clinic_file, 'clinic')
+    with metrics.span('validation', clinics=len(clinic_df)):
+        return prepare_clinics(clinic_df)
+
+
+def read_locations(community_file, clinic_file):
+    """
+    Read and validate the community and clinic files.
+
+    Returns (community_df, clinic_df) with float coordinates, rows without
+    coordinates dropped and clinic columns renamed to Facility Name /
+    Latitude / Longitude.
+    """
+    community_df = read_upload(community_file, 'community')
+    with metrics.span('validation', communities=len(community_df)):
+        community_df = prepare_communities(community_df)
+    clinic_df = read_clinics(clinic_file)
+
+    logger.info("Processing %d communities and %d clinics with valid coordinates", len(community_df), len(clinic_df))
+    return community_df, clinic_df
+
+
+def compute_distances(community_df, clinic_df, progress=None, routing_backend=None):
+    """
+    Stage 1: find each community's nearest clinic by routed distance and
+    compute the travel figures and unit-cost grid for it.
+
+    routing_backend defaults to a new get_routing_backend(); pass one in to
+    share its client and circuit breaker across several calls.
+    """
+    routes = compute_routes(community_df, clinic_df, progress, routing_backend)
+
+    # Calculate comprehensive costs for all service types and age groups
+    # as one array operation over every community
+    _report_progress(progress, 'unit costs', 60)
+    return distance_frame(routes)
+
+
+def compute_routes(community_df, clinic_df, progress=None, routing_backend=None):
+    """
+    Find each community's nearest clinic by routed distance. Returns the
+    routes, unrounded: the community and clinic names and coordinates and
+    distance_km, haversine_km and duration_hours, which are all the unit-cost
+    model needs. Rows at one location (locations.py) are searched and routed
+    once; the counts are in the routes' attrs['locations'].
+    """
+    # Calculate distances for each community to clinics
+    _report_progress(progress, 'candidate search', 10)
+    metrics.inc('pipeline_rows_total', len(community_df))
+    first, inverse, location_stats = group_locations(community_df)
+    log_locations(location_stats)
+    locations = community_df.iloc[first] if location_stats['collapsed'] else community_df
+
+    # Find the first candidate clinics by haversine for all locations at once
+    with metrics.span('candidate_search', communities=len(locations)):
+        clinic_index = get_clinic_index(clinic_df['Latitude'].to_numpy(), clinic_df['Longitude'].to_numpy())
+        candidate_idx, candidate_dist = candidate_search(locations, clinic_index)
+
+    _report_progress(progress, 'routing', 25)
+    routes = route_candidates(locations, clinic_df, clinic_index, candidate_idx, candidate_dist, routing_backend)
+    routes = spread_rows(routes, inverse, community_df)
+    routes.attrs['locations'] = location_stats
+    return routes
+
+
+def log_locations(location_stats):
+    metrics.inc('location_rows_collapsed_total', location_stats['collapsed'])
+    if location_stats['collapsed']:
+        logger.info("%d communities are at %d locations; %d rows collapsed onto a location already routed",
+                    location_stats['rows'], location_stats['locations'], location_stats['collapsed'])
+
+
+def candidate_search(community_df, clinic_index):
+    """
+    The first candidate clinics of each community, nearest by haversine
+    first: (clinic positions, distances in km). search_routes looks further
+    out for the communities that need it.
+    """
+    return nearest_clinics(
+        community_df['Latitude'].to_numpy(), community_df['Longitude'].to_numpy(),
+        clinic_index, k=min(FIRST_CANDIDATES, ROUTING_MAX_CANDIDATES)
+    )
+
+
+def route_candidates(community_df, clinic_df, clinic_index, candidate_idx, candidate_dist, routing_backend=None):
+    """Route each community to its candidate clinics and return the routes to the closest (see compute_routes)"""
+    if routing_backend is None:
+        routing_backend = get_routing_backend()
+    closest, closest_dist, routed = search_candidates(
+        community_df, clinic_df, clinic_index, candidate_idx, candidate_dist, routing_backend
+    )
+    return pick_routes(community_df, clinic_df, closest, closest_dist, routed)
+
+
+def search_candidates(community_df, clinic_df, clinic_index, candidate_idx, candidate_dist, routing_backend):
+    """
+    Best-first search (search_routes) for each community's nearest clinic by
+    road, routing through routing_backend; pairs it cannot route fall back to
+    geodesic. Returns (closest, closest_dist, routed).
+    """
+    with metrics.span('routing', communities=len(community_df), backend=routing_backend.name):
+        closest, closest_dist, routed, stats = search_routes(
+            community_df, clinic_df, clinic_index, candidate_idx, candidate_dist,
+            lambda pairs: route_pairs(routing_backend, pairs),
+            candidates_per_round=routing_backend.candidates_per_round
+        )
+    metrics.inc('routing_pairs_pruned_total', stats['pruned'], backend=routing_backend.name)
+    metrics.inc('routing_candidate_cap_total', stats['capped'], backend=routing_backend.name)
+    logger.info(
+        "Routed %d community-clinic pairs (%.2f per community) with the '%s' backend, %d used the geodesic "
+        "fallback; the great-circle bound ruled out %d candidates, %d communities reached the %d candidate cap",
+        stats['pairs'], stats['pairs'] / max(len(community_df), 1), routing_backend.name, stats['fallback'],
+        stats['pruned'], stats['capped'], ROUTING_MAX_CANDIDATES
+    )
+    logger.debug("Routing stats: %s", routing_backend.stats())
+    return closest, closest_dist, routed
+
+
+def pick_routes(community_df, clinic_df, closest, closest_dist, routed):
+    """The routes to each community's closest clinic, from search_routes' results"""
+    clinic_lat = clinic_df['Latitude'].to_numpy()
+    clinic_lng = clinic_df['Longitude'].to_numpy()
+    pairs = clinic_pairs(community_df['Latitude'], community_df['Longitude'], clinic_lat, clinic_lng, closest)
+    # A fallback route's distance is the geodesic one the clinic was picked by
+    leaflet_distance, estimated_duration, _ = fill_fallback(pairs, routed, closest_dist)
+
+    return pd.DataFrame({
+        'Title': community_df['Title'].to_numpy(),
+        'Latitude': community_df['Latitude'].to_numpy(),
+        'Longitude': community_df['Longitude'].to_numpy(),
+        'Nearest Clinic': clinic_df['Facility Name'].to_numpy()[closest],
+        'Clinic Latitude': clinic_lat[closest],
+        'Clinic Longitude': clinic_lng[closest],
+        'distance_km': leaflet_distance,
+        'haversine_km': closest_dist,
+        'duration_hours': estimated_duration,
+    })
+
+
+def travel_costs(routes, cost_params):
+    """
+    The columns that depend on the cost parameters, unrounded: travel cost,
+    round trip duration, CO2 and the unit-cost grid. With stacked parameters
+    (CostParameters.stack) each is shaped (scenarios, communities).
+    """
+    leaflet_distance = routes['distance_km'].to_numpy()
+    duration = routes['duration_hours'].to_numpy()
+
+    # Every column depends only on the distance and duration, so rows at one
+    # location are computed once and spread back
+    first, inverse = distinct_pairs(leaflet_distance, duration)
+    spread = len(first) < len(inverse)
+    if spread:
+        leaflet_distance, duration = leaflet_distance[first], duration[first]
+    travel_cost, duration_hours, all_costs = compute_unit_costs(leaflet_distance, duration, cost_params)
+
+    # Estimate CO2 emissions (assuming average car emissions per km)
+    estimated_co2 = leaflet_distance * np.asarray(cost_params.constants['CO2_PER_KM'])
+
+    costs = {
+        'Estimated CO2 (kg)': estimated_co2,
+        'Round Trip Duration (hours)': duration_hours,
+        'Travel Cost ($)': travel_cost,
+        **all_costs,
+    }
+    return {column: values[..., inverse] for column, values in costs.items()} if spread else costs
+
+
+def route_figures(routes, cost_params):
+    """The figures distance_frame reports for each route, unrounded"""
+    costs = travel_costs(routes, cost_params)
+    leaflet_distance = routes['distance_km'].to_numpy()
+    haversine_distance = routes['haversine_km'].to_numpy()
+    return {
+        'Google Distance (km)': leaflet_distance,
+        'Haversine Distance (km)': haversine_distance,
+        'Duration (hours)': routes['duration_hours'].to_numpy(),
+        'Estimated CO2 (kg)': costs.pop('Estimated CO2 (kg)'),
+        'Distance Difference (Leaflet - Haversine)': leaflet_distance - haversine_distance,
+        'Round Trip Distance (km)': leaflet_distance * 2,
+        **costs,
+    }
+
+
+def figure_columns(cost_params):
+    """The names of route_figures' figures, in report order"""
+    empty = pd.DataFrame({column: np.zeros(0) for column in ('distance_km', 'haversine_km', 'duration_hours')})
+    return list(route_figures(empty, cost_params))
+
+
+def report_figures_hold(routes, figures, cost_params):
+    """
+    Whether the figures an uploaded report wrote for its routes (see
+    delta.report_routes) are the figures (route_figures) that cost_params
+    give for its distances and durations, to within the report's rounding.
+    A report written with other cost parameters, or without some figure,
+    fails.
+    """
+    if any(column not in routes.columns for column in figures):
+        return False
+    # Every figure is affine in the distance, haversine distance and
+    # duration, so probing each of them by 1 gives its slopes, and the
+    # rounding of the inputs moves a figure by at most their sum times it
+    probes = pd.DataFrame({
+        'distance_km': [0.0, 1.0, 0.0, 0.0],
+        'haversine_km': [0.0, 0.0, 1.0, 0.0],
+        'duration_hours': [0.0, 0.0, 0.0, 1.0],
+    })
+    rounding = 0.5 * 10.0 ** -REPORT_DECIMALS
+    for column, values in route_figures(probes, cost_params).items():
+        written = routes[column].to_numpy(dtype=np.float64)
+        rows = ~np.isnan(written)
+        tolerance = rounding * (1 + np.abs(values[1:] - values[0]).sum()) + 1e-9
+        if np.any(np.abs(written[rows] - figures[column][rows]) > tolerance):
+            return False
+    return True
+
+
+def distance_frame(routes, cost_params=None):
+    """
+    Stage 1 output: travel figures and the unit-cost grid for each
+    community's chosen clinic, rounded to 2 decimal places and held as
+    compact columns (see compact.py), with the clinic names as a categorical.
+    """
+    with metrics.span('cost_grid', communities=len(routes)):
+        cost_params = cost_params or load_cost_parameters()
+        figures = route_figures(routes, cost_params)
+        # Rows a delta run kept from an uploaded report carry the figures it
+        # wrote, which its rounded distances and durations would not reproduce
+        if 'Google Distance (km)' in routes.columns:
+            if report_figures_hold(routes, figures, cost_params):
+                for column, values in figures.items():
+                    written = routes[column].to_numpy(dtype=np.float64)
+                    figures[column] = np.where(np.isnan(written), values, written)
+            else:
+                logger.warning("The previous report's figures do not fit the cost parameters; "
+                               "recomputing them from its rounded routes")
+
+        # The figures are rounded straight into one preallocated float32 block,
+        # which becomes the frame without a copy; any that float32 cannot hold
+        # exactly, and the location columns, are inserted around it
+        block = np.empty((len(figures), len(routes)), dtype=np.float32)
+        columns = ROUTE_LOCATION_COLUMNS + list(figures)
+        compact_columns = []
+        other_columns = {column: routes[column].to_numpy() for column in ROUTE_LOCATION_COLUMNS}
+        other_columns['Nearest Clinic'] = pd.Categorical(other_columns['Nearest Clinic'])
+        for column, values in figures.items():
+            values = np.round(values, 2)
+            if compactable(values):
+                block[len(compact_columns)] = values
+                compact_columns.append(column)
+            else:
+                other_columns[column] = values
+        del figures
+
+        result_df = pd.DataFrame(block[:len(compact_columns)].T, columns=compact_columns, copy=False)
+        # Inserting in column order puts each column in its place among the block's
+        for position, column in enumerate(columns):
+            if column in other_columns:
+                result_df.insert(position, column, other_columns[column])
+        result_df.attrs.update(routes.attrs)
+    logger.debug("Distance calculations completed. Result shape: %s", result_df.shape)
+    return result_df
+
+
+def read_charlie(charlie_file):
+    """Read the CHARLiE encounters file, or take a registered encounter dataset as is"""
+    charlie_df = registered_data(charlie_file)
+    if charlie_df is not None:
+        return charlie_df
+
+    charlie_df = read_upload(charlie_file, 'charlie')
+    # Strip whitespace from community names
+    charlie_df['community_name'] = charlie_df['community_name'].str.strip()
+    return charlie_df
+
+
+def read_costs(costs_file):
+    """
+    Read the costs file, or take a registered costs dataset as is.
+
+    Returns (equation_columns, equations) where equations is the first
+    non-empty row of the costs file, indexed by output column.
+    """
+    registered = registered_data(costs_file)
+    if registered is not None:
+        return registered
+
+    costs_df = read_upload(costs_file, 'costs')
+
+    # Check if we have enough columns
+    if len(costs_df.columns) < 2:
+        raise InputError("Costs file must have at least 2 columns")
+
+    # Find the row with equations (first non-empty row after header)
+    equation_row = None
+    for i in range(len(costs_df)):
+        if not costs_df.iloc[i].isna().all():
+            equation_row = i
+            break
+
+    if equation_row is None:
+        raise InputError("No equations found in costs file")
+
+    # Get the equation row
+    equations = costs_df.iloc[equation_row]
+    logger.debug("Equations found in row %d: %s", equation_row, equations.to_dict())
+
+    # Validate equations
+    if equations.isna().all():
+        raise InputError("No valid equations found in costs file")
+
+    return costs_df.columns.tolist(), equations
+
+
+def read_cost_inputs(charlie_file, costs_file):
+    """
+    Read the CHARLiE encounters file and the costs file (or registered
+    datasets in their place).
+
+    Returns (charlie_df, equation_columns, equations) where equations is the
+    first non-empty row of the costs file, indexed by output column.
+    """
+    charlie_df = read_charlie(charlie_file)
+    equation_columns, equations = read_costs(costs_file)
+    return charlie_df, equation_columns, equations
+
+
+def merge_encounters(result_df, charlie_df, fuzzy_threshold=NAME_MATCH_FUZZY_THRESHOLD, exact_names=None):
+    """
+    Stage 2a: join encounter counts onto the results by normalized community
+    name, falling back to fuzzy matching for unmatched names when
+    fuzzy_threshold is above 0. The match statistics are kept in
+    result_df.attrs['name_matching'], alongside its other attrs.
+
+    exact_names (see name_matching.match_names) are needed when result_df
+    is only some of a run's communities.
+    """
+    attrs = dict(result_df.attrs)
+    # just before merging encounters
+    result_df["Title_norm"] = normalize_names(result_df["Title"])
+    charlie_df["community_name_norm"] = normalize_names(charlie_df["community_name"])
+
+    match_keys, match_stats = match_names(
+        result_df["Title_norm"], charlie_df["community_name_norm"], fuzzy_threshold, exact_names
+    )
+    encounters = charlie_df[['community_name_norm', *ENCOUNTER_COLUMNS]]
+    keys = pd.Index(encounters['community_name_norm'])
+    if keys.is_unique:
+        # Each community matches at most one charlie row, so the counts are
+        # taken into place rather than merged into a copy of the results
+        positions = keys.get_indexer(match_keys)
+        for column in ENCOUNTER_COLUMNS:
+            result_df[column] = pd.api.extensions.take(encounters[column].to_numpy(), positions, allow_fill=True)
+    else:
+        result_df["_match_key"] = match_keys
+        result_df = result_df.merge(
+            encounters,
+            left_on='_match_key',
+            right_on='community_name_norm',
+            how='left'
+        ).drop(columns=['community_name_norm', '_match_key'])
+
+    # Fill NaN values with 0
+    for column in ENCOUNTER_COLUMNS:
+        result_df[column] = compact_array(result_df[column].fillna(0).to_numpy())
+
+    if match_stats['unmatched']:
+        logger.info("%d of %d communities have no encounters in the charlie file (%d matched fuzzily)",
+                    match_stats['unmatched'], match_stats['rows'], match_stats['fuzzy'])
+    metrics.inc('name_matches_total', match_stats['exact'], method='exact')
+    metrics.inc('name_matches_total', match_stats['fuzzy'], method='fuzzy')
+    metrics.inc('name_matches_total', match_stats['unmatched'], method='none')
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(
+            "Encounters after merge: 0-14=%s 15-64=%s 65+=%s",
+            result_df['Encounters 0-14'].sum(), result_df['Encounters 15-64'].sum(), result_df['Encounters 65+'].sum()
+        )
+
+    # Drop the temporary merge column
+    if 'community_name' in result_df.columns:
+        result_df = result_df.drop(columns=['community_name'])
+
+    result_df.attrs = {**attrs, 'name_matching': match_stats}
+    return result_df
+
+
+def compile_equations(equation_columns, equations, available_columns):
+    """
+    Compile every non-empty equation against the available columns (a
+    tuple). Returns ({column: CompiledEquation}, {column: error message}).
+    """
+    compiled = {}
+    equation_errors = {}
+    for col in equation_columns:
+        # Get the equation for this column
+        equation = equations[col]
+        if pd.isna(equation):
+            continue
+
+        try:
+            compiled[col] = compile_equation(col, str(equation), available_columns)
+        except EquationError as e:
+            equation_errors[col] = e.message
+    return compiled, equation_errors
+
+
+def equation_columns_available(equation_columns, result_columns):
+    """The columns equations can refer to: the result columns, then any new equation output columns"""
+    return tuple(result_columns) + tuple(col for col in equation_columns if col not in result_columns)
+
+
+def cost_stage_columns():
+    """The columns of the distance stage output after the encounter merge, as apply_equations sees them"""
+    empty = np.empty(0)
+    routes = pd.DataFrame({
+        'Title': pd.Series(dtype=object), 'Latitude': empty, 'Longitude': empty,
+        'Nearest Clinic': pd.Series(dtype=object), 'Clinic Latitude': empty, 'Clinic Longitude': empty,
+        'distance_km': empty, 'haversine_km': empty, 'duration_hours': empty,
+    })
+    result_df = distance_frame(routes)
+    charlie_df = pd.DataFrame({'community_name': pd.Series(dtype=object),
+                               'Encounters 0-14': empty, 'Encounters 15-64': empty, 'Encounters 65+': empty})
+    return merge_encounters(result_df, charlie_df).columns.tolist()
+
+
+def check_equations(equation_columns, equations):
+    """Raise InputError if any equation fails to compile against the columns a run will have"""
+    available_columns = equation_columns_available(equation_columns, cost_stage_columns())
+    _, equation_errors = compile_equations(equation_columns, equations, available_columns)
+    if equation_errors:
+        raise InputError("Some equations in the costs file could not be compiled", equation_errors=equation_errors)
+
+
+def apply_equations(result_df, equation_columns, equations):
+    """
+    Stage 2b: evaluate the costs-file equations into their output columns.
+
+    Every equation is compiled once (and cached across requests) and
+    evaluated for the whole column with NumPy.
+    """
+    # Ensure columns exist before assignment
+    for col in equation_columns:
+        if col not in result_df.columns:
+            result_df[col] = 0
+
+    compiled, equation_errors = compile_equations(equation_columns, equations, tuple(result_df.columns))
+    for col, equation in compiled.items():
+        try:
+            logger.debug("Evaluating equation for %s: %s", col, equation.equation)
+            result_df[col] = equation.evaluate(DecodedColumns(result_df))
+        except EquationError as e:
+            equation_errors[col] = e.message
+
+    if equation_errors:
+        for col, message in equation_errors.items():
+            logger.warning("Error processing equation for %s: %s", col, message)
+        metrics.inc('equation_errors_total', len(equation_errors))
+        raise InputError(
+            "Some equations in the costs file could not be evaluated",
+            equation_errors=equation_errors
+        )
+
+    return result_df
+
+
+def summary_totals(result_df):
+    """
+    WITH / WITHOUT totals for the summary row. Every value is a plain sum
+    over rows, so totals from separate chunks of a run can be added up.
+    """
+    return column_totals(
+        result_df.columns,
+        lambda columns: pd.DataFrame({column: column_array(result_df, column) for column in columns}).sum().sum()
+    )
+
+
+def column_totals(columns, total):
+    """
+    summary_totals for any set of columns, where total(columns) sums a list
+    of them over every row (the scenario sweep sums each scenario separately).
+    """
+    # Get only the actual total unit cost columns (not LOP/OOP/ICG variants)
+    with_encounter_cost_cols = [col for col in columns
+                                if col.startswith('WITH_Encounter_Costs_')]
+    without_encounter_cost_cols = [col for col in columns
+                                if col.startswith('WITHOUT_Encounter_Costs_')]
+
+    def like(text):
+        return total([col for col in columns if text in col])
+
+    def column_sum(column):
+        return total([column]) if column in columns else 0
+
+    return {
+        'with_encounter': total(with_encounter_cost_cols) if with_encounter_cost_cols else 0,
+        'without_encounter': total(without_encounter_cost_cols) if without_encounter_cost_cols else 0,
+        # Patient-side cost breakdowns (for separate reporting)
+        'with_lop': like('lost_productivity_WITH_Encounter'),
+        'without_lop': like('lost_productivity_WITHOUT_Encounter'),
+        'with_oop': like('out_of_pocket_WITH_Encounter'),
+        'without_oop': like('out_of_pocket_WITHOUT_Encounter'),
+        'with_icg': like('informal_caregiving_WITH_Encounter'),
+        'without_icg': like('informal_caregiving_WITHOUT_Encounter'),
+        # Distance, duration, CO2 and trips using exact column names
+        'with_distance': column_sum('WITH_total_distance'),
+        'without_distance': column_sum('WITHOUT_total_distance'),
+        'with_duration': column_sum('WITH_total_duration'),
+        'without_duration': column_sum('WITHOUT_total_duration'),
+        'with_co2': column_sum('WITH_total_CO2'),
+        'without_co2': column_sum('WITHOUT_total_CO2'),
+        'with_trips': column_sum('WITH_total_trips'),
+        'without_trips': column_sum('WITHOUT_total_trips'),
+    }
+
+
+def log_summary_totals(totals):
+    logger.debug("Summary totals: %s", totals)
+
+
+def summary_values(totals):
+    """The summary metrics, in report column order: the WITH / WITHOUT totals and the savings between them"""
+    return {
+        'WITH LOP': totals['with_lop'],
+        'WITHOUT LOP': totals['without_lop'],
+        'Total LOP Savings': totals['without_lop'] - totals['with_lop'],
+        'WITH OOP': totals['with_oop'],
+        'WITHOUT OOP': totals['without_oop'],
+        'Total OOP Savings': totals['without_oop'] - totals['with_oop'],
+        'WITH ICG': totals['with_icg'],
+        'WITHOUT ICG': totals['without_icg'],
+        'Total ICG Savings': totals['without_icg'] - totals['with_icg'],
+        'WITH Encounter': totals['with_encounter'],
+        'Without Encounter': totals['without_encounter'],
+        'Total Savings': totals['without_encounter'] - totals['with_encounter'],
+        'Total Distance Savings (km)': totals['without_distance'] - totals['with_distance'],
+        'Total Duration Savings (hours)': totals['without_duration'] - totals['with_duration'],
+        'Total CO2 Savings (kg)': totals['without_co2'] - totals['with_co2'],
+        'Total Trips Savings': totals['without_trips'] - totals['with_trips'],
+    }
+
+
+def build_summary_row(totals):
+    """One-row DataFrame with the WITH / WITHOUT totals and the savings between them"""
+    return pd.DataFrame({
+        'Title': ['Summary'],
+        **{column: [value] for column, value in summary_values(totals).items()}
+    })
+
+
+def run_route_stage(community_file, clinic_file, progress=None):
+    """
+    Nearest clinics and routing for community_file + clinic_file. The routes
+    are cached by the content of the two files and the routing settings, so
+    a run that changes only the charlie or costs file, or the cost
+    parameters, reuses them instead of routing again.
+    """
+    stage_key = route_stage_key(community_file, clinic_file)
+    routes = cached_routes(stage_key)
+    if routes is None:
+        # Step 1: read and validate the community and clinic files
+        _report_progress(progress, 'reading inputs', 0)
+        community_df, clinic_df = read_locations(community_file, clinic_file)
+
+        # Step 2: Calculate distances using Leaflet routing (complete logic from calculate-leaflet-distances)
+        routes = compute_routes(community_df, clinic_df, progress)
+        cache_routes(stage_key, routes, clinic_df)
+
+    # The stored result names its routes, for a later delta run to start from
+    routes.attrs['route_key'] = stage_key
+    return routes
+
+
+def cached_stage(stage_key):
+    """The routes, clinics and routing parameters cached under stage_key (see cache_routes), or None"""
+    cached_path = get_stage_cache().get(stage_key)
+    if cached_path is not None:
+        try:
+            entry = pd.read_pickle(cached_path)
+            logger.info("Reusing cached routes %s (%d rows)", stage_key, len(entry['routes']))
+            return entry
+        except Exception as e:
+            logger.warning("Could not load cached routes: %s", e)
+    return None
+
+
+def cached_routes(stage_key):
+    """The routes cached under stage_key, or None"""
+    entry = cached_stage(stage_key)
+    return entry['routes'] if entry is not None else None
+
+
+def cache_routes(stage_key, routes, clinic_df):
+    """Cache the routes under stage_key with the clinics they were picked from and the routing parameters"""
+    stage_cache = get_stage_cache()
+    if stage_cache.enabled:
+        entry = {'routes': routes, 'clinics': clinic_df[CLINIC_COLUMNS], 'parameters': route_parameters()}
+        try:
+            stage_cache.put(stage_key, lambda path: pd.to_pickle(entry, path))
+        except OSError as e:
+            logger.warning("Could not cache routes: %s", e)
+
+
+def run_distance_stage(community_file, clinic_file, progress=None):
+    """
+    Stage 1 (community_file + clinic_file): nearest clinics, routing (cached,
+    see run_route_stage) and the unit-cost grid.
+    """
+    routes = run_route_stage(community_file, clinic_file, progress)
+    _report_progress(progress, 'unit costs', 60)
+    return distance_frame(routes)
+
+
+def run_cost_stage(result_df, charlie_file, costs_file, progress=None):
+    """
+    Stage 2 (charlie_file + costs_file): merge encounter counts onto the
+    distance stage output, evaluate the costs-file equations and append the
+    summary row.
+    """
+    # Step 3: Now run the cost merging process (complete logic from merge-community-costs-65plus)
+    _report_progress(progress, 'merging encounters', 75)
+    charlie_df, equation_columns, equations = read_cost_inputs(charlie_file, costs_file)
+    with metrics.span('merge', rows=len(result_df)):
+        result_df = merge_encounters(result_df, charlie_df)
+
+    _report_progress(progress, 'evaluating equations', 85)
+    with metrics.span('equations', rows=len(result_df)):
+        result_df = apply_equations(result_df, equation_columns, equations)
+    logger.debug("All columns in DataFrame: %s", result_df.columns.tolist())
+
+    _report_progress(progress, 'building report', 95)
+    return build_report(result_df)
+
+
+def build_report(result_df):
+    """
+    Append the summary row. Values are rounded to 2 decimal places when the
+    report is written (see compact.finalize), not here.
+    """
+    # Combine the main results with the summary row
+    totals = summary_totals(result_df)
+    log_summary_totals(totals)
+    summary_row = build_summary_row(totals)
+    final_result_df = pd.concat([result_df, summary_row], ignore_index=True)
+    final_result_df.attrs = dict(result_df.attrs)
+    return final_result_df
+
+
+def run_pipeline(community_file, clinic_file, charlie_file, costs_file, progress=None):
+    """
+    Run the full distance calculation and cost merging process on the four
+    input files (file-like objects) and return the final report DataFrame,
+    including the summary row.
+
+    progress, if given, is called as progress(stage, percent) as the run
+    moves through its stages. Raises InputError for invalid input.
+    """
+    if PIPELINE_PROCESSES > 1 and fork_available():
+        return run_sharded_pipeline(community_file, clinic_file, charlie_file, costs_file, PIPELINE_PROCESSES, progress)
+    result_df = run_distance_stage(community_file, clinic_file, progress)
+    return run_cost_stage(result_df, charlie_file, costs_file, progress)
+
+
+def run_sharded_pipeline(community_file, clinic_file, charlie_file, costs_file, processes,
+                         progress=None, shard_rows=PIPELINE_SHARD_ROWS):
+    """
+    run_pipeline with the per-community work split into shards of shard_rows
+    communities on a pool of processes: candidate search, the unit-cost grid
+    and the equations run in the pool while this process routes each shard
+    as its candidates come back, so routing I/O overlaps the CPU work.
+    Encounter counts are matched over all communities at once, as in a
+    serial run, and the shards are put back in input order, so the report is
+    the same as run_pipeline's. A location shared by several rows is routed
+    with the shard of its first row. Runs of less than two shards stay serial.
+    """
+    stage_key = route_stage_key(community_file, clinic_file)
+    routes = cached_routes(stage_key)
+    community_df = clinic_df = None
+    if routes is None:
+        _report_progress(progress, 'reading inputs', 0)
+        community_df, clinic_df = read_locations(community_file, clinic_file)
+    locations = community_df if routes is None else routes
+
+    shards = shard_bounds(len(locations), shard_rows)
+    if len(shards) < 2:
+        if routes is None:
+            routes = compute_routes(community_df, clinic_df, progress)
+            cache_routes(stage_key, routes, clinic_df)
+        routes.attrs['route_key'] = stage_key
+        _report_progress(progress, 'unit costs', 60)
+        return run_cost_stage(distance_frame(routes), charlie_file, costs_file, progress)
+
+    charlie_df, equation_columns, equations = read_cost_inputs(charlie_file, costs_file)
+    _report_progress(progress, 'merging encounters', 10)
+    with metrics.span('merge', rows=len(locations)):
+        encounters = merge_encounters(
+            pd.DataFrame({'Title': locations['Title'].to_numpy(), '_row': np.arange(len(locations))}), charlie_df
+        )
+
+    # Everything the pool processes read is prepared here, before they are forked
+    compile_equations(equation_columns, equations, equation_columns_available(equation_columns, cost_stage_columns()))
+    shared = {
+        'community_df': community_df,
+        'routes': routes,
+        'encounter_rows': encounters['_row'].to_numpy(),
+        'encounters': encounters.drop(columns=['Title', '_row']),
+        'equation_columns': equation_columns,
+        'equations': equations,
+    }
+    if routes is None:
+        metrics.inc('pipeline_rows_total', len(community_df))
+        first, inverse, location_stats = group_locations(community_df)
+        log_locations(location_stats)
+        shared['clinic_df'] = clinic_df
+        shared['clinic_index'] = get_clinic_index(clinic_df['Latitude'].to_numpy(), clinic_df['Longitude'].to_numpy())
+        shared['locations'] = community_df.iloc[first]
+        shared['location_rows'] = inverse
+        # The locations each shard routes: those whose first row is in it
+        owned = np.searchsorted(first, [start for start, _ in shards] + [len(community_df)])
+        location_shards = list(zip(owned[:-1], owned[1:]))
+    else:
+        location_stats = routes.attrs.get('locations')
+
+    logger.info("Running %d shards of up to %d communities on %d processes", len(shards), shard_rows, processes)
+    with metrics.span('shards', shards=len(shards), processes=processes), ShardPool(processes, shared) as pool:
+        if routes is None:
+            candidates = [pool.submit(_shard_candidates, start, stop) for start, stop in location_shards]
+            routing_backend = get_routing_backend()
+            closest = np.zeros(len(first), dtype=np.int64)
+            closest_dist = np.zeros(len(first))
+            routed = [None] * len(first)
+            cost_shards = []
+            for i, ((start, stop), (location_start, location_stop), candidate_future) in enumerate(
+                zip(shards, location_shards, candidates)
+            ):
+                _report_progress(progress, 'routing', 20 + 60 * i // len(shards))
+                candidate_idx, candidate_dist = candidate_future.result()
+                # Only the search and the backend's requests run here; the
+                # geodesic fallback for the pairs it could not route runs in the pool
+                shard_closest, shard_closest_dist, shard_routed = search_candidates(
+                    shared['locations'].iloc[location_start:location_stop], clinic_df, shared['clinic_index'],
+                    candidate_idx, candidate_dist, routing_backend
+                )
+                closest[location_start:location_stop] = shard_closest
+                closest_dist[location_start:location_stop] = shard_closest_dist
+                routed[location_start:location_stop] = shard_routed
+                # The shard's rows may be at locations earlier shards routed
+                shard_locations = np.unique(inverse[start:stop])
+                cost_shards.append(pool.submit(
+                    _shard_costs, start, stop, shard_locations, closest[shard_locations],
+                    closest_dist[shard_locations], [routed[location] for location in shard_locations]
+                ))
+        else:
+            cost_shards = [pool.submit(_shard_costs, start, stop) for start, stop in shards]
+
+        _report_progress(progress, 'evaluating equations', 85)
+        results = [future.result() for future in cost_shards]
+
+    if routes is None:
+        routes = pd.concat([shard_routes for shard_routes, _ in results], ignore_index=True)
+        routes.attrs['locations'] = location_stats
+        cache_routes(stage_key, routes, clinic_df)
+    result_df = pd.concat([shard_df for _, shard_df in results], ignore_index=True)
+    # Shards' clinic name categoricals differ, so the concatenated column is not one
+    result_df['Nearest Clinic'] = result_df['Nearest Clinic'].astype('category')
+
+    result_df.attrs['name_matching'] = encounters.attrs['name_matching']
+    if location_stats is not None:
+        result_df.attrs['locations'] = location_stats
+    result_df.attrs['route_key'] = stage_key
+    _report_progress(progress, 'building report', 95)
+    return build_report(result_df)
+
+
+def _shard_candidates(shared, start, stop):
+    """Pool task: candidate clinics of one shard of locations"""
+    with metrics.span('candidate_search', communities=stop - start):
+        return candidate_search(shared['locations'].iloc[start:stop], shared['clinic_index'])
+
+
+def _shard_costs(shared, start, stop, locations=None, closest=None, closest_dist=None, routed=None):
+    """
+    Pool task: one shard's routes, from the routing search results of its
+    rows' locations (or taken from the shared cached routes), and its
+    distance stage output with encounter counts and equations. Returns
+    (routes, result_df).
+    """
+    if routed is None:
+        routes = shared['routes'].iloc[start:stop]
+    else:
+        routes = pick_routes(shared['locations'].iloc[locations], shared['clinic_df'], closest, closest_dist, routed)
+        rows = np.searchsorted(locations, shared['location_rows'][start:stop])
+        routes = spread_rows(routes, rows, shared['community_df'].iloc[start:stop])
+    result_df = distance_frame(routes)
+
+    # The shard's rows of the encounter merge, which may repeat a community
+    rows = shared['encounter_rows']
+    first, last = np.searchsorted(rows, [start, stop])
+    result_df = result_df.iloc[rows[first:last] - start].reset_index(drop=True)
+    for column, values in shared['encounters'].iloc[first:last].items():
+        result_df[column] = values.to_numpy()
+
+    with metrics.span('equations', rows=len(result_df)):
+        result_df = apply_equations(result_df, shared['equation_columns'], shared['equations'])
+    return routes, result_df
+
+
+def previous_routes(route_key=None, report_file=None):
+    """
+    The previous run a delta run starts from: {'routes', 'clinics',
+    'decimals'} (see delta.reusable_rows) for the routes cached under
+    route_key, a stored result's meta['route_key'], or for those of an
+    uploaded report_file. None if the routes are no longer cached or were
+    routed with other settings, or if the report was written with other
+    cost parameters.
+    """
+    if report_file is not None:
+        cost_params = load_cost_parameters()
+        routes = report_routes(read_upload(report_file, 'report'), figure_columns(cost_params))
+        # The rows kept take the figures the report wrote, which only hold for the cost parameters it was written with
+        if not report_figures_hold(routes, route_figures(routes, cost_params), cost_params):
+            logger.info("The previous report was written with other cost parameters")
+            return None
+        return {'routes': routes, 'clinics': None, 'decimals': REPORT_DECIMALS}
+
+    entry = cached_stage(route_key) if route_key else None
+    if entry is None or entry['parameters'] != route_parameters():
+        return None
+    return {'routes': entry['routes'], 'clinics': entry['clinics'], 'decimals': None}
+
+
+def delta_routes(previous, community_df, clinic_df, progress=None):
+    """
+    compute_routes for a delta run: rows whose previous route still holds
+    (delta.reusable_rows) take it from previous (see previous_routes), with
+    their own title and coordinates, and only the others are routed.
+    Returns (routes, delta stats).
+    """
+    source, delta_stats = reusable_rows(
+        previous['routes'], previous['clinics'], community_df, clinic_df, previous['decimals']
+    )
+    metrics.inc('delta_rows_total', delta_stats['reused'], outcome='reused')
+    metrics.inc('delta_rows_total', delta_stats['recomputed'], outcome='recomputed')
+    logger.info(
+        "Delta run: %d clinics added and %d removed; %d of %d communities keep their previous route, %d are routed",
+        delta_stats['clinics_added'], delta_stats['clinics_removed'], delta_stats['reused'], delta_stats['rows'],
+        delta_stats['recomputed']
+    )
+
+    reused = np.flatnonzero(source >= 0)
+    recomputed = np.flatnonzero(source < 0)
+    # (with the figures of a previous report's rows, see distance_frame)
+    parts = [previous['routes'].iloc[source[reused]]]
+    if len(recomputed):
+        parts.append(compute_routes(community_df.iloc[recomputed], clinic_df, progress))
+
+    # Each row's route among the reused ones, then the routed ones
+    order = np.empty(len(source), dtype=np.int64)
+    order[reused] = np.arange(len(reused))
+    order[recomputed] = len(reused) + np.arange(len(recomputed))
+    routes = pd.concat(parts, ignore_index=True).iloc[order].reset_index(drop=True)
+    for column in ('Title', 'Latitude', 'Longitude'):
+        routes[column] = community_df[column].to_numpy()
+    routes.attrs = {'locations': group_locations(community_df)[2]}
+    return routes, delta_stats
+
+
+def run_delta_pipeline(community_file, clinic_file, charlie_file, costs_file, route_key=None, report_file=None,
+                       delta_base=None, progress=None):
+    """
+    run_pipeline for inputs that differ a little from a previous run's: the
+    routes the changes cannot affect are taken from it (delta.py) and only
+    the rest are routed again. The previous run is the one whose routes are
+    cached under route_key (a stored result's meta['route_key']) or an
+    uploaded report_file. The unit costs, equations and summary row are
+    computed over the whole patched table, so a changed charlie or costs
+    file is taken into account too. The delta counts are in attrs['delta'].
+
+    delta_base names the previous run (see route_stage_key) when the routes
+    may differ from a full run's: those of a report are rounded, and with
+    LOCATION_SNAP_DECIMALS a location is routed from another first row. It
+    is None when they are a full run's, so they are cached as one.
+
+    Without previous routes to start from, every community is routed, as by
+    run_pipeline.
+    """
+    stage_key = route_stage_key(community_file, clinic_file, delta_base)
+    routes = cached_routes(stage_key)
+    delta_stats = None
+    if routes is None:
+        previous = previous_routes(route_key, report_file)
+        if previous is None:
+            logger.info("The previous routes are no longer cached or were routed with other settings; "
+                        "routing every community")
+            return run_pipeline(community_file, clinic_file, charlie_file, costs_file, progress)
+
+        _report_progress(progress, 'reading inputs', 0)
+        community_df, clinic_df = read_locations(community_file, clinic_file)
+        routes, delta_stats = delta_routes(previous, community_df, clinic_df, progress)
+        cache_routes(stage_key, routes, clinic_df)
+    routes.attrs['route_key'] = stage_key
+
+    _report_progress(progress, 'unit costs', 60)
+    result_df = distance_frame(routes)
+    if delta_stats is not None:
+        result_df.attrs['delta'] = delta_stats
+    return run_cost_stage(result_df, charlie_file, costs_file, progress)
+
+
+def _format_report_rows(df, columns):
+    """
+    Conform a block of report rows to the full report layout, as
+    run_pipeline's combined frame would be written.
+    """
+    df = df.reindex(columns=columns)
+    # Concatenating with the summary row turns integer columns into floats
+    int_columns = df.select_dtypes(include=['integer']).columns
+    df[int_columns] = df[int_columns].astype('float64')
+    return finalize(df)
+
+
+def exact_match_names(community_file, charlie_df, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    The normalized charlie names some community in community_file matches
+    exactly, reading the file a chunk at a time, so that a streamed run's
+    fuzzy matching offers each chunk the same names a whole-file run would.
+    """
+    charlie_names = pd.unique(normalize_names(charlie_df["community_name"]).dropna())
+    matched = set()
+    for community_df in read_upload_chunks(community_file, 'community', chunk_rows):
+        # Only the rows the run keeps, as prepare_communities leaves them
+        community_df = prepare_communities(community_df)
+        titles = normalize_names(community_df["Title"])
+        matched.update(titles[titles.isin(charlie_names)])
+    return matched
+
+
+def stream_pipeline(community_file, clinic_file, charlie_file, costs_file, chunk_rows=STREAM_CHUNK_ROWS):
+    """
+    Run the pipeline over the community file chunk_rows rows at a time and
+    yield the report CSV as text: the header with the first chunk's rows,
+    then one block per chunk, then the summary row built from running totals.
+
+    Only the current chunk of communities and results is held in memory.
+    The clinic, charlie and costs files are read and validated, and the first
+    chunk is processed, before anything is yielded, so input errors in them
+    raise InputError from the first next().
+    """
+    logger.info("Streaming pipeline in chunks of %d communities", chunk_rows)
+    clinic_df = read_clinics(clinic_file)
+    charlie_df, equation_columns, equations = read_cost_inputs(charlie_file, costs_file)
+
+    # Fuzzy matching leaves out the charlie names matched exactly anywhere in
+    # the file, not just in the chunk, so it needs a first pass over the titles
+    exact_names = None
+    if NAME_MATCH_FUZZY_THRESHOLD > 0:
+        with metrics.span('merge'):
+            exact_names = exact_match_names(community_file, charlie_df, chunk_rows)
+
+    chunks = read_upload_chunks(community_file, 'community', chunk_rows)
+
+    # One backend for the whole run, so its client and circuit breaker are shared
+    routing_backend = get_routing_backend()
+    columns = None
+    totals = None
+    rows = 0
+    for chunk_number, community_df in enumerate(chunks, start=1):
+        with metrics.span('validation', communities=len(community_df)):
+            community_df = prepare_communities(community_df)
+        result_df = compute_distances(community_df, clinic_df, routing_backend=routing_backend)
+        with metrics.span('merge', rows=len(result_df)):
+            result_df = merge_encounters(result_df, charlie_df, exact_names=exact_names)
+        with metrics.span('equations', rows=len(result_df)):
+            result_df = apply_equations(result_df, equation_columns, equations)
+
+        chunk_totals = summary_totals(result_df)
+        if totals is None:
+            totals = chunk_totals
+            # The summary row's columns follow the result columns, as in run_pipeline
+            summary_columns = build_summary_row(totals).columns
+            columns = result_df.columns.tolist() + [c for c in summary_columns if c not in result_df.columns]
+        else:
+            totals = {key: totals[key] + value for key, value in chunk_totals.items()}
+
+        rows += len(result_df)
+        logger.debug("Chunk %d: %d rows (%d total)", chunk_number, len(result_df), rows)
+        with metrics.span('serialization', rows=len(result_df)):
+            text = _format_report_rows(result_df, columns).to_csv(index=False, header=(chunk_number == 1))
+        yield text
+
+    if totals is None:
+        raise InputError("Community file has no rows")
+
+    log_summary_totals(totals)
+    yield _format_report_rows(build_summary_row(totals), columns).to_csv(index=False, header=False)
+    logger.info("Streaming pipeline completed: %d rows", rows)
+
+
+def save_report(final_result_df, output_path, report_format='csv'):
+    """Write the report to output_path (a path or binary file object) in report_format and return it"""
+    with metrics.span('serialization', rows=len(final_result_df), format=report_format):
+        write_report(final_result_df, output_path, report_format)
+    logger.debug("Combined %s report saved to: %s", report_format, output_path)
+    return output_path
@@ -0,0 +1,150 @@
+"""
+Report output formats: CSV (the default), gzip-compressed CSV, Parquet,
+Arrow IPC and a compact JSON of just the summary and the map fields.
+
+Parquet and Arrow need pyarrow, which is optional; the other formats only
+need pandas.
+
+Reports are held with compact columns (see compact.py) and rounded to 2
+decimal places as they are written. CSV is written a block of rows at a
+time, so only one block is ever held rounded.
+"""
+import contextlib
+import gzip
+import json
+
+from compact import finalize, finalize_column
+
+try:
+    import pyarrow  # noqa: F401  (pandas' Parquet and Arrow writers need it)
+except ImportError:
+    pyarrow = None
+
+# Name -> MIME type, download file extension and whether pyarrow is needed.
+# Order matters: with Accept: */* the first format wins.
+REPORT_FORMATS = {
+    'csv': {'mimetype': 'text/csv', 'extension': '.csv', 'pyarrow': False},
+    'csv.gz': {'mimetype': 'application/gzip', 'extension': '.csv.gz', 'pyarrow': False},
+    'parquet': {'mimetype': 'application/vnd.apache.parquet', 'extension': '.parquet', 'pyarrow': True},
+    'arrow': {'mimetype': 'application/vnd.apache.arrow.file', 'extension': '.arrow', 'pyarrow': True},
+    'json': {'mimetype': 'application/json', 'extension': '.json', 'pyarrow': False},
+}
+
+FORMAT_ALIASES = {
+    'gzip': 'csv.gz',
+    'gz': 'csv.gz',
+    'feather': 'arrow',
+    'ipc': 'arrow',
+}
+
+# Other MIME types clients use for the same formats
+MIMETYPE_ALIASES = {
+    'application/x-gzip': 'csv.gz',
+    'application/x-parquet': 'parquet',
+    'application/vnd.apache.arrow.stream': 'arrow',
+}
+
+# Report rows rounded and written to CSV at a time
+WRITE_CHUNK_ROWS = 10_000
+
+# Per-community columns the dashboard map needs
+MAP_COLUMNS = [
+    'Title', 'Latitude', 'Longitude', 'Nearest Clinic', 'Clinic Latitude', 'Clinic Longitude',
+    'Google Distance (km)', 'Duration (hours)',
+]
+
+
+def resolve_format(requested, accept_mimetypes):
+    """
+    The report format named by requested (a ?format= value) or, if that is
+    empty, the best match for the Accept header; CSV when neither picks one.
+    Returns None for an unknown format name.
+    """
+    if requested:
+        name = requested.strip().lower()
+        name = FORMAT_ALIASES.get(name, name)
+        return name if name in REPORT_FORMATS else None
+
+    offered = [spec['mimetype'] for spec in REPORT_FORMATS.values()] + list(MIMETYPE_ALIASES)
+    mimetype = accept_mimetypes.best_match(offered)
+    for name, spec in REPORT_FORMATS.items():
+        if spec['mimetype'] == mimetype:
+            return name
+    return MIMETYPE_ALIASES.get(mimetype, 'csv')
+
+
+def format_available(name):
+    return pyarrow is not None or not REPORT_FORMATS[name]['pyarrow']
+
+
+def column_values(column):
+    """A column (Series) as a list of plain Python values, with None for NaN"""
+    return column.astype(object).where(column.notna(), None).tolist()
+
+
+def summary_metrics(final_result_df):
+    """
+    The summary row's metrics. The summary row is the report's last row, and
+    its summary columns are the only ones set in it.
+    """
+    summary_row = finalize(final_result_df.iloc[-1:]).iloc[0].drop('Title').dropna()
+    return {column: float(value) for column, value in summary_row.items()}
+
+
+def report_summary(final_result_df):
+    """
+    The summary metrics, the community name match, location grouping and
+    delta run statistics and, column by column, the map fields of every
+    community
+    """
+    communities = final_result_df.iloc[:-1]
+    return {
+        'summary': summary_metrics(final_result_df),
+        'rows': len(communities),
+        'name_matching': final_result_df.attrs.get('name_matching'),
+        'locations': final_result_df.attrs.get('locations'),
+        'delta': final_result_df.attrs.get('delta'),
+        'communities': {
+            column: column_values(finalize_column(communities[column]))
+            for column in MAP_COLUMNS if column in communities.columns
+        },
+    }
+
+
+def report_chunks(final_result_df, chunk_rows=WRITE_CHUNK_ROWS):
+    """The report in blocks of chunk_rows rows, each as it is written (see compact.finalize)"""
+    for start in range(0, len(final_result_df), chunk_rows):
+        yield finalize(final_result_df.iloc[start:start + chunk_rows])
+
+
+def _binary_target(target):
+    """A context manager giving a binary file object for target (a path or binary file object)"""
+    return open(target, 'wb') if isinstance(target, str) else contextlib.nullcontext(target)
+
+
+def _write_csv(final_result_df, f):
+    for i, chunk in enumerate(report_chunks(final_result_df)):
+        f.write(chunk.to_csv(index=False, header=(i == 0)).encode('utf-8'))
+
+
+def write_report(final_result_df, target, report_format='csv'):
+    """Write the report to target (a path or binary file object) in report_format"""
+    if report_format == 'csv':
+        with _binary_target(target) as f:
+            _write_csv(final_result_df, f)
+    elif report_format == 'csv.gz':
+        # Level 6 is several times faster than gzip's default 9 for a few percent more bytes;
+        # mtime 0 makes the output reproducible
+        with _binary_target(target) as f, gzip.GzipFile(filename='', mode='wb', fileobj=f,
+                                                        compresslevel=6, mtime=0) as gz:
+            _write_csv(final_result_df, gz)
+    elif report_format == 'parquet':
+        finalize(final_result_df).to_parquet(target, index=False, compression='zstd')
+    elif report_format == 'arrow':
+        finalize(final_result_df).to_feather(target, compression='zstd')
+    elif report_format == 'json':
+        data = json.dumps(report_summary(final_result_df), allow_nan=False, separators=(',', ':')).encode('utf-8')
+        with _binary_target(target) as f:
+            f.write(data)
+    else:
+        raise ValueError(f"Unknown report format: {report_format}")
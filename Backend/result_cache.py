@@ -0,0 +1,263 @@
+import hashlib
+import json
+import os
+import threading
+
+from config import (
+    LOCATION_SNAP_DECIMALS,
+    NAME_MATCH_FUZZY_THRESHOLD,
+    OSRM_URL,
+    RESULT_CACHE_DIR,
+    RESULT_CACHE_MAX_BYTES,
+    ROAD_NETWORK_SNAP_KM,
+    ROUTING_BACKEND,
+    ROUTING_MAX_CANDIDATES,
+    ROUTING_PROFILE,
+    STAGE_CACHE_DIR,
+    STAGE_CACHE_MAX_BYTES,
+)
+from cost_model import load_cost_parameters
+from metrics import metrics
+from road_network import road_network_digest
+
+# Bump when the report layout or calculations change, so reports cached by
+# older code are not served again
+REPORT_VERSION = 1
+
+HASH_BLOCK_SIZE = 1 << 20
+
+
+# The model parameters the routes depend on
+ROUTE_PARAMETERS = (
+    'report_version', 'routing_backend', 'routing_profile', 'osrm_url', 'routing_max_candidates', 'road_network',
+    'location_snap_decimals',
+)
+
+
+def model_parameters():
+    """Everything besides the uploaded files that the report depends on"""
+    return {
+        'report_version': REPORT_VERSION,
+        'cost_parameters': load_cost_parameters().to_dict(),
+        'routing_backend': ROUTING_BACKEND,
+        'routing_profile': ROUTING_PROFILE,
+        'osrm_url': OSRM_URL,
+        'routing_max_candidates': ROUTING_MAX_CANDIDATES,
+        # The local backend's network, by content, and how far points snap to it
+        'road_network': [road_network_digest(), ROAD_NETWORK_SNAP_KM] if ROUTING_BACKEND == 'local' else None,
+        'location_snap_decimals': LOCATION_SNAP_DECIMALS,
+        'name_match_fuzzy_threshold': NAME_MATCH_FUZZY_THRESHOLD,
+    }
+
+
+def hash_file(file, digest):
+    """Feed a file-like object into digest block by block and rewind it"""
+    file.seek(0)
+    size = 0
+    while True:
+        block = file.read(HASH_BLOCK_SIZE)
+        if not block:
+            break
+        size += len(block)
+        digest.update(block)
+    file.seek(0)
+    # Length-prefix each file so content cannot shift between inputs
+    digest.update(size.to_bytes(8, 'big'))
+
+
+def content_key(files, parameters):
+    """Content hash of some input files and a JSON-serializable parameter dict"""
+    digest = hashlib.sha256()
+    for file in files:
+        hash_file(file, digest)
+    digest.update(json.dumps(parameters, sort_keys=True).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def request_key(community_file, clinic_file, charlie_file, costs_file, delta_base=None):
+    """
+    Key of a whole report: the four input files and the model parameters,
+    and for a delta run whose routes may differ from a full run's, the
+    previous run it started from (delta_base)
+    """
+    parameters = model_parameters()
+    if delta_base is not None:
+        parameters['delta_base'] = delta_base
+    return content_key((community_file, clinic_file, charlie_file, costs_file), parameters)
+
+
+def route_parameters():
+    """The model parameters the routes depend on (ROUTE_PARAMETERS)"""
+    return {key: value for key, value in model_parameters().items() if key in ROUTE_PARAMETERS}
+
+
+def route_stage_key(community_file, clinic_file, delta_base=None):
+    """
+    Key of the routes of a run, which depend only on the community and clinic
+    files and the routing settings (not the cost parameters), and on
+    delta_base as request_key does
+    """
+    parameters = {'stage': 'routes', **route_parameters()}
+    if delta_base is not None:
+        parameters['delta_base'] = delta_base
+    return content_key((community_file, clinic_file), parameters)
+
+
+class ResultCache:
+    """
+    Finished reports (or intermediate stage outputs) on disk, named by the
+    content key of the inputs that produced them, evicted least recently used
+    once they take up more than max_bytes.
+
+    Entries are plain files written atomically, so every gunicorn worker
+    shares the cache. A hit refreshes the file's mtime, which is the LRU order.
+    One key can have entries with different suffixes (e.g. the same report
+    as .csv and .parquet); each is cached and evicted on its own.
+    """
+
+    def __init__(self, directory=RESULT_CACHE_DIR, max_bytes=RESULT_CACHE_MAX_BYTES, suffix='.csv', name='result'):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.suffix = suffix
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def path(self, key, suffix=None):
+        return os.path.join(self.directory, f"{key}{self.suffix if suffix is None else suffix}")
+
+    def _tmp_path(self, key, suffix=None):
+        return f"{self.path(key, suffix)}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def get(self, key, suffix=None):
+        """Return the cached entry's path, or None on a miss"""
+        path = self.path(key, suffix)
+        try:
+            if not self.enabled:
+                raise FileNotFoundError(path)
+            os.utime(path)
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            metrics.inc('cache_misses_total', cache=self.name)
+            return None
+        with self._lock:
+            self.hits += 1
+        metrics.inc('cache_hits_total', cache=self.name)
+        return path
+
+    def put(self, key, write, suffix=None):
+        """
+        Store an entry by calling write(path) to produce it, and return the
+        path to serve it from.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key, suffix)
+        tmp_path = self._tmp_path(key, suffix)
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            self._discard(tmp_path)
+            raise
+        self._evict(keep=path)
+        return path
+
+    def stream(self, key, chunks):
+        """
+        Pass text chunks through while writing them to the cache. The entry is
+        only stored if every chunk was produced; an error or a client that
+        disconnects early leaves nothing behind.
+        """
+        if not self.enabled:
+            yield from chunks
+            return
+
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = self._tmp_path(key)
+        completed = False
+        try:
+            with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            completed = True
+        finally:
+            if completed:
+                os.replace(tmp_path, self.path(key))
+                self._evict(keep=self.path(key))
+            else:
+                self._discard(tmp_path)
+
+    def _discard(self, tmp_path):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            # Everything but other processes' partial writes
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        return entries
+
+    def _evict(self, keep=None):
+        """Delete least recently used entries, except the one at path keep, until the cache fits in max_bytes"""
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in entries:
+            if total <= self.max_bytes:
+                break
+            if keep is not None and name == os.path.basename(keep):
+                continue
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self.evictions += 1
+            metrics.inc('cache_evictions_total', cache=self.name)
+
+    def stats(self):
+        entries = self._entries() if os.path.isdir(self.directory) else []
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'bytes': sum(size for _, size, _ in entries),
+        }
+
+
+_result_cache = None
+_stage_cache = None
+
+
+def get_result_cache():
+    """Process-wide cache of finished report CSVs"""
+    global _result_cache
+    if _result_cache is None:
+        _result_cache = ResultCache()
+    return _result_cache
+
+
+def get_stage_cache():
+    """Process-wide cache of pickled intermediate stage outputs"""
+    global _stage_cache
+    if _stage_cache is None:
+        _stage_cache = ResultCache(STAGE_CACHE_DIR, STAGE_CACHE_MAX_BYTES, suffix='.pkl', name='stage')
+    return _stage_cache
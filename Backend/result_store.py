@@ -0,0 +1,162 @@
+"""
+Finished reports kept in a columnar form that can be queried a page at a
+time, so the dashboard can show a large run without downloading it whole.
+
+Each result is one uncompressed .npz file: one array per report column,
+read lazily so a query only loads the columns it touches, the summary row's
+metrics, and a latitude-sorted index for bounding-box queries. Results are
+stored under the same content key as the result cache and evicted least
+recently used.
+"""
+import json
+import logging
+
+import numpy as np
+import pandas as pd
+
+from compact import finalize_column
+from config import RESULT_STORE_DIR, RESULT_STORE_MAX_BYTES
+from ingest import InputError
+from report_formats import column_values, summary_metrics
+from result_cache import ResultCache
+
+logger = logging.getLogger(__name__)
+
+# Rows per page when the query does not say, and the most it may ask for
+DEFAULT_PAGE_ROWS = 100
+MAX_PAGE_ROWS = 10_000
+
+
+def write_result(final_result_df, path):
+    """Store a report (with its summary row last, as build_report makes it) at path"""
+    communities = final_result_df.iloc[:-1]
+    arrays = {}
+    for i, column in enumerate(communities.columns):
+        values = finalize_column(communities[column])
+        if values.dtype.kind in 'biuf':
+            arrays[f"c{i}"] = values.to_numpy()
+        else:
+            # Fixed-width unicode arrays load without pickle; nulls are kept in a mask
+            nulls = values.isna().to_numpy()
+            arrays[f"c{i}"] = values.where(~nulls, '').astype(str).to_numpy(dtype=str)
+            if nulls.any():
+                arrays[f"n{i}"] = nulls
+
+    # Rows ordered by latitude, with the sorted latitudes, for binary-searching bounding boxes
+    latitude = finalize_column(communities['Latitude']).to_numpy()
+    arrays['lat_order'] = np.argsort(latitude, kind='stable')
+    arrays['lat_sorted'] = latitude[arrays['lat_order']]
+
+    meta = {
+        'rows': len(communities),
+        'columns': communities.columns.tolist(),
+        'summary': summary_metrics(final_result_df),
+        'name_matching': final_result_df.attrs.get('name_matching'),
+        'locations': final_result_df.attrs.get('locations'),
+        'delta': final_result_df.attrs.get('delta'),
+        # The key of the cached routes, which a delta run naming this result starts from
+        'route_key': final_result_df.attrs.get('route_key'),
+    }
+    arrays['meta'] = np.array(json.dumps(meta))
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class StoredResult:
+    """A stored result opened for querying; use as a context manager"""
+
+    def __init__(self, path):
+        self._npz = np.load(path, allow_pickle=False)
+        self.meta = json.loads(str(self._npz['meta']))
+        self._positions = {column: i for i, column in enumerate(self.meta['columns'])}
+
+    def close(self):
+        self._npz.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def column(self, name, rows=None):
+        """A column's values, for the given row positions if any, with None for nulls in text columns"""
+        i = self._positions[name]
+        values = self._npz[f"c{i}"]
+        if rows is not None:
+            values = values[rows]
+        if f"n{i}" in self._npz.files:
+            nulls = self._npz[f"n{i}"]
+            values = values.astype(object)
+            values[nulls if rows is None else nulls[rows]] = None
+        return values
+
+    def check_columns(self, columns):
+        unknown = [column for column in columns if column not in self._positions]
+        if unknown:
+            raise InputError(f"Unknown columns: {', '.join(unknown)}")
+
+    def bbox_rows(self, west, south, east, north):
+        """Positions, in report order, of the rows inside a bounding box"""
+        lat_sorted = self._npz['lat_sorted']
+        start = np.searchsorted(lat_sorted, south, side='left')
+        stop = np.searchsorted(lat_sorted, north, side='right')
+        rows = self._npz['lat_order'][start:stop]
+        longitude = self.column('Longitude', rows)
+        if west <= east:
+            inside = (longitude >= west) & (longitude <= east)
+        else:
+            # The box crosses the antimeridian
+            inside = (longitude >= west) | (longitude <= east)
+        return np.sort(rows[inside])
+
+    def query(self, columns=None, sort=None, descending=False, bbox=None, offset=0, limit=DEFAULT_PAGE_ROWS):
+        """
+        One page of rows: those inside bbox (west, south, east, north) if
+        given, ordered by the sort column (report order otherwise), with only
+        the requested columns. Returns the total number of matching rows, the
+        column names in order and the page's values column by column.
+        """
+        columns = columns or self.meta['columns']
+        self.check_columns(columns + ([sort] if sort else []))
+
+        rows = self.bbox_rows(*bbox) if bbox else np.arange(self.meta['rows'])
+        if sort:
+            # Stable, with nulls last in either direction
+            order = pd.Series(self.column(sort, rows)).sort_values(
+                ascending=not descending, kind='stable', na_position='last'
+            ).index.to_numpy()
+            rows = rows[order]
+
+        page = rows[offset:offset + limit]
+        return {
+            'total': len(rows),
+            'offset': offset,
+            'limit': limit,
+            'columns': columns,
+            'data': {column: column_values(pd.Series(self.column(column, page))) for column in columns},
+        }
+
+
+_result_store = None
+
+
+def get_result_store():
+    """Process-wide store of queryable results, keyed like the result cache"""
+    global _result_store
+    if _result_store is None:
+        _result_store = ResultCache(RESULT_STORE_DIR, RESULT_STORE_MAX_BYTES, suffix='.npz', name='store')
+    return _result_store
+
+
+def store_result(cache_key, final_result_df):
+    """Store a finished report for querying; returns its result id, or None if the store is off or failed"""
+    store = get_result_store()
+    if not store.enabled:
+        return None
+    try:
+        store.put(cache_key, lambda path: write_result(final_result_df, path))
+    except OSError as e:
+        logger.warning("Could not store result: %s", e)
+        return None
+    return cache_key
@@ -0,0 +1,301 @@
+"""
+Road network for the 'local' routing backend: routes over a road graph read
+from disk, with no routing server.
+
+A network is a directory of NumPy arrays, memory-mapped when it is loaded,
+so the graph is paged in as it is searched and the pages are shared by every
+worker process:
+
+    latitude.npy, longitude.npy    node coordinates (float64)
+    indptr.npy                     the edges into node v are indptr[v]:indptr[v + 1] (int64)
+    source.npy                     each edge's start node (int32)
+    length_m.npy, duration_s.npy   each edge's length and travel time (float32)
+    network.json                   format version, counts and a content digest
+
+Edges are grouped by the node they lead to, because routes are searched
+backwards from their clinic: one Dijkstra search per clinic answers all its
+communities, and stops once they are all reached. The route is the fastest
+one, as with OSRM, and its distance is that route's length. No edge is
+shorter than the great-circle distance between its ends (build_road_network
+raises the ones that are), so no route is shorter than the great-circle
+distance between its ends, as the nearest clinic search (route_search.py)
+assumes.
+
+Build a network from node and edge CSVs, e.g. exported from an OSM extract:
+
+    python road_network.py --nodes nodes.csv --edges edges.csv --out network/
+"""
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import math
+import os
+
+import numpy as np
+import pandas as pd
+
+from config import ROAD_NETWORK_PATH
+from distance import haversine
+from spatial_index import ClinicIndex
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+META_FILE = 'network.json'
+ARRAYS = {
+    'latitude': np.float64, 'longitude': np.float64, 'indptr': np.int64,
+    'source': np.int32, 'length_m': np.float32, 'duration_s': np.float32,
+}
+
+# Speed (km/h) of edges built without a travel time
+DEFAULT_SPEED_KMH = 60.0
+
+# Speed (km/h) on the straight line between a point and the node it snaps to
+ACCESS_SPEED_KMH = 30.0
+
+# Loaded networks, by directory
+_networks = {}
+
+
+class RoadNetwork:
+    """A road network directory, memory-mapped, with a KD-tree over its nodes for snapping points"""
+
+    def __init__(self, directory):
+        with open(os.path.join(directory, META_FILE), encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Road network {directory} has format version {meta.get('version')}, not {FORMAT_VERSION}")
+        self.directory = directory
+        self.digest = meta['digest']
+        # Plain array views of the memory maps: slicing a np.memmap is several times slower
+        for name in ARRAYS:
+            setattr(self, name, np.asarray(np.load(os.path.join(directory, f"{name}.npy"), mmap_mode='r')))
+        self.index = ClinicIndex(self.latitude, self.longitude)
+
+    def __len__(self):
+        return len(self.latitude)
+
+    def snap(self, lat, lng):
+        """(nodes, km): each point's nearest node and its great-circle distance to it"""
+        nodes, km = self.index.query(lat, lng, 1)
+        return nodes[:, 0], km[:, 0]
+
+    def route(self, pairs, searches, snap_km, keep_nodes):
+        """
+        (distance_km, duration_hours) for each (start_lat, start_lng, end_lat,
+        end_lng) pair, or None where an end is further than snap_km from every
+        node or no road joins them. Each end is searched from its nearest node,
+        and the straight lines to and from the nodes are added at
+        ACCESS_SPEED_KMH. searches (an OrderedDict of {end node: search})
+        keeps the searches between calls, so routing more pairs to an end
+        carries on from where its search stopped; the least recently used are
+        dropped once they hold more than keep_nodes settled nodes.
+        """
+        results = [None] * len(pairs)
+        if not pairs or not len(self):
+            return results
+        coordinates = np.array(pairs, dtype=np.float64)
+        start_node, start_km = self.snap(coordinates[:, 0], coordinates[:, 1])
+        end_node, end_km = self.snap(coordinates[:, 2], coordinates[:, 3])
+
+        # Pairs grouped by their end node, each group answered by one search
+        groups = {}
+        for i in np.flatnonzero((start_km <= snap_km) & (end_km <= snap_km)).tolist():
+            groups.setdefault(int(end_node[i]), []).append(i)
+        start_node = start_node.tolist()
+        for end, members in groups.items():
+            search = searches.get(end)
+            if search is None:
+                search = searches[end] = _Search(self, end)
+            searches.move_to_end(end)
+            search.reach({start_node[i] for i in members})
+            for i in members:
+                found = search.settled.get(start_node[i])
+                if found is not None:
+                    access_km = float(start_km[i] + end_km[i])
+                    results[i] = (found[1] / 1000 + access_km, found[0] / 3600 + access_km / ACCESS_SPEED_KMH)
+            while len(searches) > 1 and sum(len(kept.settled) for kept in searches.values()) > keep_nodes:
+                searches.popitem(last=False)
+        return results
+
+
+class _Search:
+    """Dijkstra search by travel time over the edges into each node, from one node"""
+
+    def __init__(self, network, node):
+        self.network = network
+        # Settled nodes: (duration_s, length_m) of the fastest route to the search's node
+        self.settled = {}
+        self.queued = {node: 0.0}
+        self.heap = [(0.0, 0.0, node)]
+
+    def reach(self, targets):
+        """Settle nodes until every target is settled or no node is left to settle"""
+        missing = targets - self.settled.keys()
+        network, settled, queued, heap = self.network, self.settled, self.queued, self.heap
+        while missing and heap:
+            duration, length, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            settled[node] = (duration, length)
+            del queued[node]
+            missing.discard(node)
+            start, stop = int(network.indptr[node]), int(network.indptr[node + 1])
+            for source, edge_length, edge_duration in zip(
+                network.source[start:stop].tolist(), network.length_m[start:stop].tolist(),
+                network.duration_s[start:stop].tolist()
+            ):
+                if source in settled:
+                    continue
+                # Ties go to the shorter route, then the lower node, through the heap order
+                next_duration = duration + edge_duration
+                if next_duration <= queued.get(source, math.inf):
+                    queued[source] = next_duration
+                    heapq.heappush(heap, (next_duration, length + edge_length, source))
+
+
+def load_road_network(directory=ROAD_NETWORK_PATH):
+    """The RoadNetwork in directory, loaded once per process (again if it is rebuilt)"""
+    if not directory:
+        raise ValueError("ROAD_NETWORK_PATH is not set; build a network with road_network.py and point it there")
+    key = os.path.realpath(directory)
+    mtime = os.path.getmtime(os.path.join(directory, META_FILE))
+    network = _networks.get(key)
+    if network is None or network[0] != mtime:
+        network = _networks[key] = (mtime, RoadNetwork(directory))
+        logger.info("Loaded road network %s (%d nodes, %d edges)", directory, len(network[1]), len(network[1].source))
+    return network[1]
+
+
+def road_network_digest(directory=ROAD_NETWORK_PATH):
+    """Content digest of the network in directory, or None if there is none"""
+    try:
+        with open(os.path.join(directory, META_FILE), encoding='utf-8') as f:
+            return json.load(f).get('digest')
+    except (OSError, ValueError):
+        return None
+
+
+def build_road_network(directory, latitude, longitude, edge_from, edge_to, length_m=None, duration_s=None,
+                       speed_kmh=DEFAULT_SPEED_KMH):
+    """
+    Write a road network into directory. Edges are directed, from node
+    edge_from[i] to edge_to[i] (positions in latitude/longitude); add both
+    directions for two-way roads. Lengths default to the great-circle
+    distance and are raised to it where shorter; durations default to the
+    length at speed_kmh. Raises ValueError for invalid input.
+    """
+    latitude = np.asarray(latitude, dtype=np.float64)
+    longitude = np.asarray(longitude, dtype=np.float64)
+    edge_from = np.asarray(edge_from, dtype=np.int64)
+    edge_to = np.asarray(edge_to, dtype=np.int64)
+    n = len(latitude)
+    if len(longitude) != n or len(edge_to) != len(edge_from):
+        raise ValueError("Node coordinates and edge ends must have matching lengths")
+    if n >= 2 ** 31:
+        raise ValueError("A road network can have at most 2**31 - 1 nodes")
+    if not (np.isfinite(latitude).all() and np.isfinite(longitude).all()):
+        raise ValueError("Every node needs a latitude and longitude")
+    if len(edge_from) and (min(edge_from.min(), edge_to.min()) < 0 or max(edge_from.max(), edge_to.max()) >= n):
+        raise ValueError("Edges refer to nodes that do not exist")
+
+    # Lengths no shorter than the great-circle distance, also once stored as float32
+    straight = haversine(latitude[edge_from], longitude[edge_from], latitude[edge_to], longitude[edge_to]) * 1000
+    length = straight if length_m is None else np.asarray(length_m, dtype=np.float64)
+    if not (np.isfinite(length).all() and (length >= 0).all()):
+        raise ValueError("Edge lengths must be non-negative numbers")
+    raised = int(np.count_nonzero(length < straight))
+    if raised:
+        logger.warning("Raised %d edge lengths to the great-circle distance between their ends", raised)
+    length = np.maximum(length, straight).astype(np.float32)
+    low = length < straight
+    length[low] = np.nextafter(length[low], np.float32(np.inf))
+
+    if duration_s is None:
+        duration = length / np.float32(speed_kmh / 3.6)
+    else:
+        duration = np.asarray(duration_s, dtype=np.float32)
+        if not (np.isfinite(duration).all() and (duration >= 0).all()):
+            raise ValueError("Edge durations must be non-negative numbers")
+
+    # Edges grouped by the node they lead to
+    order = np.argsort(edge_to, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(edge_to, minlength=n), out=indptr[1:])
+    arrays = {
+        'latitude': latitude, 'longitude': longitude, 'indptr': indptr,
+        'source': edge_from[order], 'length_m': length[order], 'duration_s': duration[order],
+    }
+
+    # network.json goes last, so a half-written network is never loaded
+    os.makedirs(directory, exist_ok=True)
+    meta_path = os.path.join(directory, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    digest = hashlib.sha256()
+    for name, dtype in ARRAYS.items():
+        values = np.ascontiguousarray(arrays[name], dtype=dtype)
+        np.save(os.path.join(directory, f"{name}.npy"), values)
+        digest.update(name.encode())
+        digest.update(values.tobytes())
+    with open(meta_path, 'w', encoding='utf-8') as f:
+        json.dump({'version': FORMAT_VERSION, 'nodes': n, 'edges': len(edge_from), 'digest': digest.hexdigest()}, f)
+    logger.info("Wrote road network %s (%d nodes, %d edges)", directory, n, len(edge_from))
+    return digest.hexdigest()
+
+
+def read_network_csvs(nodes_file, edges_file, speed_kmh=DEFAULT_SPEED_KMH):
+    """
+    build_road_network's arguments from a nodes CSV (id, latitude, longitude)
+    and an edges CSV (from, to and optionally length_m, duration_s and
+    oneway; edges are two-way unless oneway is 1/true/yes)
+    """
+    nodes = pd.read_csv(nodes_file)
+    edges = pd.read_csv(edges_file)
+    for name, df, required in (('nodes', nodes, ['id', 'latitude', 'longitude']), ('edges', edges, ['from', 'to'])):
+        missing = [column for column in required if column not in df.columns]
+        if missing:
+            raise ValueError(f"The {name} file is missing columns: {', '.join(missing)}")
+    ids = pd.Index(nodes['id'])
+    if not ids.is_unique:
+        raise ValueError("Node ids must be unique")
+    edge_from, edge_to = ids.get_indexer(edges['from']), ids.get_indexer(edges['to'])
+    if (edge_from < 0).any() or (edge_to < 0).any():
+        raise ValueError("Edges refer to node ids that are not in the nodes file")
+
+    length_m = edges['length_m'].to_numpy(dtype=np.float64) if 'length_m' in edges else None
+    duration_s = edges['duration_s'].to_numpy(dtype=np.float64) if 'duration_s' in edges else None
+    if 'oneway' in edges:
+        oneway = edges['oneway'].astype(str).str.strip().str.lower().isin(['1', 'true', 'yes']).to_numpy()
+    else:
+        oneway = np.zeros(len(edges), dtype=bool)
+
+    # Two-way edges again in reverse
+    back = ~oneway
+    return {
+        'latitude': nodes['latitude'].to_numpy(), 'longitude': nodes['longitude'].to_numpy(),
+        'edge_from': np.concatenate([edge_from, edge_to[back]]),
+        'edge_to': np.concatenate([edge_to, edge_from[back]]),
+        'length_m': None if length_m is None else np.concatenate([length_m, length_m[back]]),
+        'duration_s': None if duration_s is None else np.concatenate([duration_s, duration_s[back]]),
+        'speed_kmh': speed_kmh,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nodes', required=True, help="CSV with id, latitude and longitude columns")
+    parser.add_argument('--edges', required=True, help="CSV with from and to columns, optionally length_m, duration_s and oneway")
+    parser.add_argument('--speed', type=float, default=DEFAULT_SPEED_KMH, help="km/h for edges without duration_s")
+    parser.add_argument('--out', required=True, help="network directory to write")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s %(name)s: %(message)s')
+    digest = build_road_network(args.out, **read_network_csvs(args.nodes, args.edges, args.speed))
+    print(f"{args.out}: {digest}")
+
+
+if __name__ == '__main__':
+    main()
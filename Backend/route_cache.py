@@ -0,0 +1,182 @@
+import os
+import sqlite3
+import threading
+import time
+
+from config import (
+    ROUTE_CACHE_MAX_ENTRIES,
+    ROUTE_CACHE_PATH,
+    ROUTE_CACHE_PRECISION,
+    ROUTE_CACHE_TTL_SECONDS,
+)
+from metrics import metrics
+
+# Prune back to the size cap after this many inserts
+EVICTION_INTERVAL = 1000
+
+
+class RouteCache:
+    """
+    SQLite-backed cache of routing results keyed by the router they came
+    from (e.g. the OSRM URL), the routing profile and snapped coordinate pairs.
+
+    Entries expire after `ttl` seconds and the least recently used entries
+    are evicted once the cache holds more than `max_entries`. The file lives
+    outside the worker process, so it survives gunicorn worker recycling and
+    is shared by all workers.
+    """
+
+    def __init__(self, path=ROUTE_CACHE_PATH, ttl=ROUTE_CACHE_TTL_SECONDS,
+                 max_entries=ROUTE_CACHE_MAX_ENTRIES, precision=ROUTE_CACHE_PRECISION):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.scale = 10 ** precision
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._inserts = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        # Connections must not be shared across a fork (gunicorn preload_app)
+        if self._conn is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(routes)")]
+            if columns and 'router' not in columns:
+                # Routes cached before the router was part of the key could be any server's
+                conn.execute("DROP TABLE routes")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS routes (
+                    router TEXT NOT NULL,
+                    profile TEXT NOT NULL,
+                    start_lat INTEGER NOT NULL,
+                    start_lng INTEGER NOT NULL,
+                    end_lat INTEGER NOT NULL,
+                    end_lng INTEGER NOT NULL,
+                    distance_km REAL NOT NULL,
+                    duration_hours REAL NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (router, profile, start_lat, start_lng, end_lat, end_lng)
+                )
+                """
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS routes_accessed_at ON routes (accessed_at)")
+            conn.commit()
+            self._conn = conn
+            self._pid = os.getpid()
+        return self._conn
+
+    def _key(self, router, profile, start_lat, start_lng, end_lat, end_lng):
+        return (
+            router, profile,
+            round(start_lat * self.scale), round(start_lng * self.scale),
+            round(end_lat * self.scale), round(end_lng * self.scale),
+        )
+
+    def get_many(self, router, profile, pairs):
+        """
+        Look up (start_lat, start_lng, end_lat, end_lng) pairs routed by router
+        with profile. Returns a list with a (distance_km, duration_hours)
+        tuple for each hit and None for each miss or expired entry.
+        """
+        now = time.time()
+        keys = [self._key(router, profile, *pair) for pair in pairs]
+        results = []
+        with self._lock:
+            conn = self._connection()
+            for key in keys:
+                row = conn.execute(
+                    "SELECT distance_km, duration_hours, created_at FROM routes "
+                    "WHERE router = ? AND profile = ? "
+                    "AND start_lat = ? AND start_lng = ? AND end_lat = ? AND end_lng = ?",
+                    key
+                ).fetchone()
+                if row is not None and now - row[2] <= self.ttl:
+                    results.append((row[0], row[1]))
+                else:
+                    results.append(None)
+
+            hit_keys = [key for key, result in zip(keys, results) if result is not None]
+            if hit_keys:
+                conn.executemany(
+                    "UPDATE routes SET accessed_at = ? "
+                    "WHERE router = ? AND profile = ? "
+                    "AND start_lat = ? AND start_lng = ? AND end_lat = ? AND end_lng = ?",
+                    [(now,) + key for key in hit_keys]
+                )
+                conn.commit()
+            self.hits += len(hit_keys)
+            self.misses += len(keys) - len(hit_keys)
+        metrics.inc('cache_hits_total', len(hit_keys), cache='route')
+        metrics.inc('cache_misses_total', len(keys) - len(hit_keys), cache='route')
+        return results
+
+    def get(self, router, profile, start_lat, start_lng, end_lat, end_lng):
+        return self.get_many(router, profile, [(start_lat, start_lng, end_lat, end_lng)])[0]
+
+    def set_many(self, router, profile, entries):
+        """
+        Store ((start_lat, start_lng, end_lat, end_lng), (distance_km, duration_hours))
+        entries, replacing any existing value for the same key.
+        """
+        now = time.time()
+        rows = [
+            self._key(router, profile, *pair) + (float(value[0]), float(value[1]), now, now)
+            for pair, value in entries
+        ]
+        if not rows:
+            return
+        with self._lock:
+            conn = self._connection()
+            conn.executemany("INSERT OR REPLACE INTO routes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            conn.commit()
+            self._inserts += len(rows)
+            if self._inserts >= EVICTION_INTERVAL:
+                self._inserts = 0
+                self._evict(conn, now)
+
+    def set(self, router, profile, start_lat, start_lng, end_lat, end_lng, distance_km, duration_hours):
+        self.set_many(router, profile, [((start_lat, start_lng, end_lat, end_lng), (distance_km, duration_hours))])
+
+    def _evict(self, conn, now):
+        expired = conn.execute("DELETE FROM routes WHERE created_at < ?", (now - self.ttl,)).rowcount
+        overflow = conn.execute("SELECT COUNT(*) FROM routes").fetchone()[0] - self.max_entries
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM routes WHERE rowid IN (SELECT rowid FROM routes ORDER BY accessed_at LIMIT ?)",
+                (overflow,)
+            )
+        conn.commit()
+        self.evictions += expired + max(overflow, 0)
+        metrics.inc('cache_evictions_total', expired + max(overflow, 0), cache='route')
+
+    def stats(self):
+        with self._lock:
+            entries = self._connection().execute("SELECT COUNT(*) FROM routes").fetchone()[0]
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': entries,
+        }
+
+
+_route_cache = None
+
+
+def get_route_cache():
+    """Process-wide RouteCache, opened lazily so it is created after fork"""
+    global _route_cache
+    if _route_cache is None:
+        _route_cache = RouteCache()
+    return _route_cache
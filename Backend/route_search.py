@@ -0,0 +1,118 @@
+"""
+Best-first search for each community's nearest clinic by road.
+
+A road is never shorter than the great-circle distance between its ends, so
+a candidate clinic's great-circle distance is a lower bound on its road
+distance. Candidates are routed in increasing great-circle order, one round
+at a time with every community's next candidate in a single batch, and a
+community stops as soon as its next candidate's bound is no less than the
+shortest road distance it has found: no clinic from there on can be closer.
+The clinic picked is then the nearest by road among all clinics, not just
+the first few, while communities whose nearest clinic is clearly closest
+are routed to it alone. Only the cap on candidates per community
+(ROUTING_MAX_CANDIDATES) can stop a search before that, and such
+communities are counted.
+"""
+import numpy as np
+
+from config import ROUTING_MAX_CANDIDATES
+from distance import SPHERE_TOLERANCE, nearest_clinics
+
+
+def clinic_pairs(community_lat, community_lng, clinic_lat, clinic_lng, clinics):
+    """(community lat, lng, clinic lat, lng) for every community and its clinic at position clinics[i]"""
+    return list(zip(
+        np.asarray(community_lat).tolist(), np.asarray(community_lng).tolist(),
+        clinic_lat[clinics].tolist(), clinic_lng[clinics].tolist()
+    ))
+
+
+def search_routes(community_df, clinic_df, clinic_index, candidate_idx, candidate_dist, route,
+                  max_candidates=ROUTING_MAX_CANDIDATES, candidates_per_round=1):
+    """
+    Find each community's nearest clinic by road, starting from its first
+    candidates (nearest_clinics, nearest first); route(pairs) returns
+    route_pairs' results for a list of pairs. Each round routes up to
+    candidates_per_round more candidates of every community still searching.
+
+    Returns (closest, closest_dist, routed, stats): each community's closest
+    clinic position, its geodesic distance and its routing result (None for
+    the geodesic fallback), and {'pairs': routed, 'pruned': candidates the
+    bound ruled out when the search came to them, 'capped': communities
+    whose search reached max_candidates, 'fallback': pairs left to the
+    fallback}. Candidates past one that ended a community's search are not
+    counted as pruned.
+    """
+    community_lat = community_df['Latitude'].to_numpy()
+    community_lng = community_df['Longitude'].to_numpy()
+    clinic_lat = clinic_df['Latitude'].to_numpy()
+    clinic_lng = clinic_df['Longitude'].to_numpy()
+
+    n = len(community_df)
+    limit = min(max(max_candidates, 1), len(clinic_df))
+    closest = np.zeros(n, dtype=np.int64)
+    closest_dist = np.zeros(n)
+    routed = [None] * n
+    best = np.full(n, np.inf)
+    # Communities that had a candidate of their last round ruled out
+    ruled_out = np.zeros(n, dtype=bool)
+    stats = {'pairs': 0, 'pruned': 0, 'capped': 0, 'fallback': 0}
+
+    # Candidates of the communities still searching, one row each
+    pending = np.arange(n)
+    idx, dist = candidate_idx[:, :limit], candidate_dist[:, :limit]
+    position = 0
+    while len(pending) and position < limit:
+        # A candidate is ruled out once its lower bound is no less than the
+        # shortest road found; a great-circle distance is at most
+        # SPHERE_TOLERANCE under the geodesic one it is ranked by. Candidates
+        # are in order, so a community is done once its next one is ruled
+        # out, or the last one found so far before looking further out
+        if position:
+            going = dist[:, min(position, idx.shape[1] - 1)] * (1 - SPHERE_TOLERANCE) < best[pending]
+            # A community that stops has its next candidate ruled out, unless its last round already did
+            stats['pruned'] += int(np.count_nonzero(~going & ~ruled_out[pending]))
+            pending, idx, dist = pending[going], idx[going], dist[going]
+            if not len(pending):
+                break
+        stop = min(position + max(candidates_per_round, 1), limit)
+        if stop > idx.shape[1]:
+            idx, dist = nearest_clinics(
+                community_lat[pending], community_lng[pending], clinic_index, k=min(limit, max(2 * position, stop))
+            )
+
+        # Route every searching community to its next candidates in one batch;
+        # a fallback pair's distance is the geodesic one it was ranked by;
+        # candidates of the round the bound already rules out are skipped
+        to_route = dist[:, position:stop] * (1 - SPHERE_TOLERANCE) < best[pending][:, None]
+        stats['pruned'] += int(to_route.size - np.count_nonzero(to_route))
+        ruled_out[pending] = ~to_route.all(axis=1)
+        rows, columns = np.nonzero(to_route)
+        columns += position
+        clinics = idx[rows, columns]
+        results = route(clinic_pairs(
+            community_lat[pending[rows]], community_lng[pending[rows]], clinic_lat, clinic_lng, clinics
+        ))
+        distance = np.array([
+            dist[row, column] if result is None else result[0]
+            for row, column, result in zip(rows, columns, results)
+        ])
+        stats['pairs'] += len(results)
+        stats['fallback'] += sum(result is None for result in results)
+
+        # Keep the closer route, candidate by candidate so the nearer one wins ties
+        for column in range(position, stop):
+            batch = np.flatnonzero(columns == column)
+            batch = batch[distance[batch] < best[pending[rows[batch]]]]
+            found = pending[rows[batch]]
+            best[found] = distance[batch]
+            closest[found] = clinics[batch]
+            closest_dist[found] = dist[rows[batch], column]
+            for pair, i in zip(batch, found):
+                routed[i] = results[pair]
+        position = stop
+
+    # Communities that reached the cap with further clinics not ruled out
+    if len(pending) and limit < len(clinic_df):
+        stats['capped'] = int(np.count_nonzero(dist[:, -1] * (1 - SPHERE_TOLERANCE) < best[pending]))
+    return closest, closest_dist, routed, stats
@@ -0,0 +1,282 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from config import (
+    OSRM_TABLE_MAX_COORDINATES,
+    OSRM_URL,
+    ROAD_NETWORK_SEARCH_NODES,
+    ROAD_NETWORK_SNAP_KM,
+    ROUTING_BACKEND,
+    ROUTING_PROFILE,
+)
+from distance import geodesic_km
+from metrics import metrics
+from road_network import load_road_network
+from route_cache import get_route_cache
+from routing_client import RoutingClient
+
+logger = logging.getLogger(__name__)
+
+# Average speed (km/h) used to estimate duration when routing is unavailable
+FALLBACK_SPEED_KMH = 60.0
+
+
+class RoutingBackend:
+    """
+    Interface for routing engines.
+
+    A backend takes a list of (start_lat, start_lng, end_lat, end_lng) pairs
+    and returns, in the same order, a (distance_km, duration_hours) tuple for
+    each pair it could route and None for each pair it could not.
+    """
+
+    name = 'base'
+    profile = ROUTING_PROFILE
+    # Where the routes come from (e.g. a server's URL), part of the route
+    # cache key; None for the backend's name
+    router = None
+    # Candidate clinics per community routed in each round of the nearest
+    # clinic search (route_search.py): one, where every pair is a call
+    candidates_per_round = 1
+
+    def route_pairs(self, pairs):
+        raise NotImplementedError
+
+    def stats(self):
+        """Counters describing the work done so far, for logging"""
+        return {}
+
+
+class GeodesicBackend(RoutingBackend):
+    """Network-free backend that leaves every pair to the geodesic fallback"""
+
+    name = 'geodesic'
+
+    def route_pairs(self, pairs):
+        return [None] * len(pairs)
+
+
+class OSRMRouteBackend(RoutingBackend):
+    """One OSRM /route request per pair, sent concurrently through the routing client"""
+
+    name = 'osrm-route'
+
+    def __init__(self, base_url=OSRM_URL, profile=ROUTING_PROFILE, client=None):
+        self.base_url = base_url
+        self.router = base_url
+        self.profile = profile
+        self.client = client if client is not None else RoutingClient()
+
+    def route_pairs(self, pairs):
+        urls = [
+            f"{self.base_url}/route/v1/{self.profile}/{start_lng},{start_lat};{end_lng},{end_lat}?overview=false"
+            for start_lat, start_lng, end_lat, end_lng in pairs
+        ]
+        return [self._parse(data) for data in self.client.get_many(urls)]
+
+    def _parse(self, data):
+        if data is None:
+            return None
+        if not data.get('routes'):
+            logger.warning("No route found for coordinates")
+            return None
+        route = data['routes'][0]
+        return route['distance'] / 1000, route['duration'] / 3600
+
+    def stats(self):
+        return self.client.stats()
+
+
+class OSRMTableBackend(RoutingBackend):
+    """
+    Routes pairs through OSRM's /table service.
+
+    Pairs are grouped into chunks whose distinct start and end points fit in
+    one table request; each request returns the full sources x destinations
+    matrix of distances and durations, and the cells for the requested pairs
+    are scattered back. Chunks are fetched concurrently through the routing
+    client.
+    """
+
+    name = 'osrm-table'
+    # A request's size is in coordinates, and a community's candidates share
+    # its coordinate, so routing several together costs little more than one
+    candidates_per_round = 3
+
+    def __init__(self, base_url=OSRM_URL, profile=ROUTING_PROFILE, client=None,
+                 max_coordinates=OSRM_TABLE_MAX_COORDINATES):
+        self.base_url = base_url
+        self.router = base_url
+        self.profile = profile
+        self.client = client if client is not None else RoutingClient()
+        self.max_coordinates = max_coordinates
+
+    def route_pairs(self, pairs):
+        results = [None] * len(pairs)
+        chunks = list(self._chunks(pairs))
+        urls = [self._table_url(sources, destinations) for _, sources, destinations in chunks]
+        for (chunk, _, _), data in zip(chunks, self.client.get_many(urls)):
+            if data is None:
+                continue
+            if data.get('code') != 'Ok' or 'distances' not in data or 'durations' not in data:
+                logger.warning("Table request returned no matrix (%s)", data.get('code'))
+                continue
+            distances, durations = data['distances'], data['durations']
+            for i, (source, destination) in chunk:
+                distance, duration = distances[source][destination], durations[source][destination]
+                if distance is not None and duration is not None:
+                    results[i] = (distance / 1000, duration / 3600)
+        return results
+
+    def stats(self):
+        return self.client.stats()
+
+    def _chunks(self, pairs):
+        """
+        Yield (chunk, sources, destinations) where chunk is a list of
+        (pair position, (source slot, destination slot)).
+
+        Pairs are visited grouped by start point, so a start point is never
+        split across chunks unless its pairs alone exceed the coordinate limit.
+        """
+        by_start = {}
+        for i, (start_lat, start_lng, end_lat, end_lng) in enumerate(pairs):
+            by_start.setdefault((start_lat, start_lng), []).append((i, (end_lat, end_lng)))
+
+        # Neighbouring start points usually share their nearest end point, so
+        # ordering by it lets each chunk reuse the same destinations
+        groups = sorted(by_start.items(), key=lambda item: item[1][0][1])
+
+        chunk, sources, destinations = [], {}, {}
+        for start, ends in groups:
+            new_ends = {end for _, end in ends if end not in destinations}
+            if chunk and len(sources) + len(destinations) + 1 + len(new_ends) > self.max_coordinates:
+                yield chunk, list(sources), list(destinations)
+                chunk, sources, destinations = [], {}, {}
+
+            for i, end in ends:
+                if len(sources) + len(destinations) + (start not in sources) + (end not in destinations) > self.max_coordinates:
+                    yield chunk, list(sources), list(destinations)
+                    chunk, sources, destinations = [], {}, {}
+                source = sources.setdefault(start, len(sources))
+                destination = destinations.setdefault(end, len(destinations))
+                chunk.append((i, (source, destination)))
+
+        if chunk:
+            yield chunk, list(sources), list(destinations)
+
+    def _table_url(self, sources, destinations):
+        coordinates = ';'.join(f"{lng},{lat}" for lat, lng in sources + destinations)
+        source_ids = ';'.join(str(i) for i in range(len(sources)))
+        destination_ids = ';'.join(str(len(sources) + i) for i in range(len(destinations)))
+        return (f"{self.base_url}/table/v1/{self.profile}/{coordinates}"
+                f"?sources={source_ids}&destinations={destination_ids}&annotations=distance,duration")
+
+
+class LocalRoutingBackend(RoutingBackend):
+    """
+    Routes pairs over the road network at ROAD_NETWORK_PATH (road_network.py),
+    without a routing server. Each clinic's search is kept for the backend's
+    lifetime, up to keep_nodes settled nodes in all, so the nearest clinic
+    search's later rounds carry on from where the earlier ones stopped.
+    """
+
+    name = 'local'
+
+    def __init__(self, network=None, snap_km=ROAD_NETWORK_SNAP_KM, keep_nodes=ROAD_NETWORK_SEARCH_NODES):
+        self.network = network if network is not None else load_road_network()
+        self.snap_km = snap_km
+        self.keep_nodes = keep_nodes
+        self.searches = OrderedDict()
+
+    def route_pairs(self, pairs):
+        return self.network.route(pairs, self.searches, self.snap_km, self.keep_nodes)
+
+    def stats(self):
+        return {
+            'searches': len(self.searches),
+            'settled_nodes': sum(len(search.settled) for search in self.searches.values()),
+        }
+
+
+class CachedRoutingBackend(RoutingBackend):
+    """Serves pairs from the persistent route cache and routes only the misses"""
+
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = cache if cache is not None else get_route_cache()
+        self.name = backend.name
+        self.profile = backend.profile
+        self.router = backend.router or backend.name
+        self.candidates_per_round = backend.candidates_per_round
+
+    def route_pairs(self, pairs):
+        results = self.cache.get_many(self.router, self.profile, pairs)
+        missing = [i for i, result in enumerate(results) if result is None]
+        if missing:
+            routed = self.backend.route_pairs([pairs[i] for i in missing])
+            for i, result in zip(missing, routed):
+                results[i] = result
+            self.cache.set_many(
+                self.router, self.profile,
+                [(pairs[i], result) for i, result in zip(missing, routed) if result is not None]
+            )
+        return results
+
+    def stats(self):
+        return dict(self.backend.stats(), cache=self.cache.stats())
+
+
+ROUTING_BACKENDS = {
+    'osrm-table': OSRMTableBackend,
+    'osrm-route': OSRMRouteBackend,
+    'local': LocalRoutingBackend,
+    'geodesic': GeodesicBackend,
+}
+
+# Backends that compute routes faster than the route cache can look them up
+UNCACHED_BACKENDS = ('local', 'geodesic')
+
+
+def get_routing_backend(name=ROUTING_BACKEND, cached=True):
+    """Build the configured routing backend, wrapped in the route cache"""
+    if name not in ROUTING_BACKENDS:
+        raise ValueError(f"Unknown routing backend '{name}'. Choose one of: {', '.join(ROUTING_BACKENDS)}")
+    backend = ROUTING_BACKENDS[name]()
+    if cached and name not in UNCACHED_BACKENDS:
+        backend = CachedRoutingBackend(backend)
+    return backend
+
+
+def route_pairs(backend, pairs):
+    """The backend's results for pairs (None where it could not route one), counted in the routing metrics"""
+    routed = backend.route_pairs(pairs) if pairs else []
+    metrics.inc('routing_pairs_total', len(pairs), backend=backend.name)
+    metrics.inc('routing_fallback_pairs_total', sum(result is None for result in routed), backend=backend.name)
+    return routed
+
+
+def fill_fallback(pairs, routed, geodesic=None):
+    """
+    (distances_km, durations_hours, fallback_mask) arrays from route_pairs'
+    results, with the geodesic fallback for the pairs it could not route.
+    geodesic, if given, holds the pairs' geodesic distances already measured.
+    """
+    distances = np.zeros(len(pairs))
+    durations = np.zeros(len(pairs))
+    fallback = np.array([result is None for result in routed], dtype=bool)
+    for i, result in enumerate(routed):
+        if result is not None:
+            distances[i], durations[i] = result
+
+    # The geodesic distances of all fallback pairs at once, unless already known
+    if geodesic is not None:
+        distances[fallback] = np.asarray(geodesic, dtype=np.float64)[fallback]
+    elif fallback.any():
+        fallback_pairs = np.array([pairs[i] for i in np.flatnonzero(fallback)], dtype=np.float64)
+        start_lat, start_lng, end_lat, end_lng = fallback_pairs.T
+        distances[fallback] = geodesic_km(start_lat, start_lng, end_lat, end_lng)
+    durations[fallback] = distances[fallback] / FALLBACK_SPEED_KMH
+    return distances, durations, fallback
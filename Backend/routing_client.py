@@ -0,0 +1,235 @@
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import (
+    OSRM_BACKOFF_MAX_SECONDS,
+    OSRM_BACKOFF_SECONDS,
+    OSRM_BREAKER_RESET_SECONDS,
+    OSRM_BREAKER_THRESHOLD,
+    OSRM_CONCURRENCY,
+    OSRM_CONNECT_TIMEOUT,
+    OSRM_MAX_RETRIES,
+    OSRM_RATE_LIMIT,
+    OSRM_TIMEOUT,
+)
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Process-wide metric for each per-client counter
+COUNTER_METRICS = {
+    'requests_sent': 'routing_http_requests_total',
+    'retries': 'routing_http_retries_total',
+    'short_circuited': 'routing_short_circuited_total',
+}
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """
+    Process-wide keep-alive session, so connections to the router are reused
+    across requests. Recreated after fork (gunicorn preload_app).
+    """
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(OSRM_CONCURRENCY, 10))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second with bursts up to `burst`"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures. While open every request
+    fails fast; after `reset_timeout` seconds one trial request is let through
+    and the breaker closes again if it succeeds.
+    """
+
+    def __init__(self, threshold=OSRM_BREAKER_THRESHOLD, reset_timeout=OSRM_BREAKER_RESET_SECONDS):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # Half-open: let this request probe the router
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold and self.opened_at is None:
+                self.opened_at = time.monotonic()
+                logger.warning("Router failed %d times in a row, switching to fallback mode", self.failures)
+
+
+class RoutingClient:
+    """
+    HTTP client for the routing service.
+
+    Requests share a pooled keep-alive session and run on a bounded thread
+    pool, are rate limited per host, retried with exponential backoff on
+    429/5xx and connection errors, and short-circuited by a circuit breaker
+    once the router looks down, so the rest of the job uses the fallback
+    without waiting out timeouts.
+    """
+
+    _rate_limiters = {}
+    _rate_limiters_lock = threading.Lock()
+
+    def __init__(self, concurrency=OSRM_CONCURRENCY, rate_limit=OSRM_RATE_LIMIT, timeout=OSRM_TIMEOUT,
+                 connect_timeout=OSRM_CONNECT_TIMEOUT, max_retries=OSRM_MAX_RETRIES,
+                 backoff=OSRM_BACKOFF_SECONDS, backoff_max=OSRM_BACKOFF_MAX_SECONDS,
+                 breaker=None, session=None):
+        self.concurrency = max(1, concurrency)
+        self.rate_limit = rate_limit
+        self.timeout = (connect_timeout, timeout)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        self.session = session
+        self.requests_sent = 0
+        self.retries = 0
+        self.short_circuited = 0
+        self._counter_lock = threading.Lock()
+
+    def _rate_limiter(self, url):
+        # Shared by every client in the process so the limit is per host, not per job
+        host = urlsplit(url).netloc
+        with self._rate_limiters_lock:
+            limiter = self._rate_limiters.get(host)
+            if limiter is None or limiter.rate != self.rate_limit:
+                limiter = self._rate_limiters[host] = RateLimiter(self.rate_limit)
+            return limiter
+
+    def _count(self, name):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + 1)
+        metrics.inc(COUNTER_METRICS[name])
+
+    def _sleep_before_retry(self, attempt, response=None):
+        delay = min(self.backoff_max, self.backoff * (2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after is not None:
+            try:
+                delay = min(self.backoff_max, float(retry_after))
+            except ValueError:
+                pass
+        # Jitter so parallel requests do not retry in lockstep
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def get_json(self, url):
+        """
+        GET the URL and return the decoded JSON body, or None when the router
+        could not answer (after retries) or the breaker is open.
+        """
+        session = self.session or get_session()
+        limiter = self._rate_limiter(url)
+        for attempt in range(self.max_retries + 1):
+            if not self.breaker.allow():
+                self._count('short_circuited')
+                return None
+            limiter.acquire()
+            self._count('requests_sent')
+            try:
+                response = session.get(url, timeout=self.timeout)
+            except requests.RequestException as e:
+                logger.warning("Error getting routing data: %s", e)
+                self.breaker.record_failure()
+                if attempt < self.max_retries:
+                    self._count('retries')
+                    self._sleep_before_retry(attempt)
+                continue
+
+            if response.status_code in RETRY_STATUSES:
+                logger.warning("API request failed with status %d", response.status_code)
+                self.breaker.record_failure()
+                if attempt < self.max_retries:
+                    self._count('retries')
+                    self._sleep_before_retry(attempt, response)
+                continue
+
+            # The router answered, even if with a client error such as NoRoute
+            self.breaker.record_success()
+            if response.status_code != 200:
+                logger.warning("API request failed with status %d", response.status_code)
+                return None
+            try:
+                return response.json()
+            except ValueError:
+                logger.warning("Router returned an invalid JSON body")
+                return None
+        return None
+
+    def get_many(self, urls):
+        """Fetch many URLs with bounded parallelism, returning JSON bodies in order"""
+        if len(urls) <= 1 or self.concurrency == 1:
+            return [self.get_json(url) for url in urls]
+        with ThreadPoolExecutor(max_workers=min(self.concurrency, len(urls))) as executor:
+            return list(executor.map(self.get_json, urls))
+
+    def stats(self):
+        return {
+            'requests': self.requests_sent,
+            'retries': self.retries,
+            'short_circuited': self.short_circuited,
+            'breaker_open': self.breaker.is_open,
+        }
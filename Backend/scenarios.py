@@ -0,0 +1,234 @@
+"""
+Scenario sweeps: one run's routes and encounter counts evaluated under many
+sets of cost parameters (and, optionally, other costs files), returning each
+scenario's summary totals instead of a report.
+
+Routing happens once, and is cached like any run's. The unit-cost model and
+the costs-file equations are then evaluated for a batch of scenarios at a
+time, as arrays with a leading scenario axis, so a sweep costs little more
+than a single run's cost stage per batch.
+"""
+import copy
+import json
+import logging
+import math
+
+import numpy as np
+
+from compact import column_array
+from config import SCENARIO_BATCH_BYTES, SCENARIO_LIMIT
+from cost_model import AGE_GROUP_FIELDS, SERVICE_FIELDS, CostParameters, load_cost_parameters
+from equations import EquationError
+from ingest import InputError
+from metrics import metrics
+from pipeline import (
+    column_totals, compile_equations, distance_frame, merge_encounters, read_charlie, read_costs,
+    run_route_stage, summary_values, travel_costs,
+)
+
+logger = logging.getLogger(__name__)
+
+SCENARIO_KEYS = {'name', 'constants', 'services', 'age_groups', 'costs'}
+
+# The summary metrics, in report column order
+SUMMARY_COLUMNS = list(summary_values(column_totals([], lambda columns: 0)))
+
+# Columns of the sweep table
+SCENARIO_COLUMNS = ['Scenario', 'Costs'] + SUMMARY_COLUMNS
+
+
+def _number(value, scenario, field):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise InputError(f"Scenario '{scenario}': {field} must be a number")
+    return float(value)
+
+
+def _overrides(spec, key, scenario):
+    overrides = spec.get(key, {})
+    if not isinstance(overrides, dict):
+        raise InputError(f"Scenario '{scenario}': {key} must be an object")
+    return overrides
+
+
+def _override_rows(rows, key, fields, overrides, scenario):
+    """Apply {row name or '*': {field: value}} overrides to the services or age groups rows"""
+    names = [row[key] for row in rows]
+    # '*' (every row) first, so overrides of a single row win over it
+    for target, values in sorted(overrides.items(), key=lambda item: item[0] != '*'):
+        if target != '*' and target not in names:
+            raise InputError(f"Scenario '{scenario}': unknown {key.replace('_', ' ')} {target}")
+        if not isinstance(values, dict):
+            raise InputError(f"Scenario '{scenario}': overrides for {target} must be an object")
+        for field, value in values.items():
+            if field not in fields:
+                raise InputError(f"Scenario '{scenario}': unknown field {field}. Use one of: {', '.join(fields)}")
+            value = _number(value, scenario, f"{target}.{field}")
+            for row in rows:
+                if target in ('*', row[key]):
+                    row[field] = value
+
+
+def scenario_parameters(base, spec, scenario):
+    """The cost parameters (from the base parameters' dict) with a scenario's overrides applied"""
+    data = copy.deepcopy(base)
+    for key, value in _overrides(spec, 'constants', scenario).items():
+        if key not in data['constants']:
+            raise InputError(f"Scenario '{scenario}': unknown constant {key}. Use one of: {', '.join(data['constants'])}")
+        data['constants'][key] = _number(value, scenario, key)
+    _override_rows(data['services'], 'service', SERVICE_FIELDS, _overrides(spec, 'services', scenario), scenario)
+    _override_rows(data['age_groups'], 'age_group', AGE_GROUP_FIELDS, _overrides(spec, 'age_groups', scenario), scenario)
+    return CostParameters.from_dict(data)
+
+
+def parse_scenarios(text, base_params=None):
+    """
+    Parse a JSON list of scenarios. Each is an object with an optional name
+    and overrides of the cost parameters: constants ({"WAGE": 35}), services
+    and age_groups ({"MD": {"parking": 0}}, with "*" for all of them), and
+    costs, naming another costs file to use (a form field or a registered
+    costs dataset id). An empty object is the baseline.
+
+    Returns [{'name', 'parameters', 'costs'}]; raises InputError.
+    """
+    try:
+        specs = json.loads(text)
+    except ValueError:
+        raise InputError("scenarios must be a JSON list of scenario objects")
+    if not isinstance(specs, list) or not specs or not all(isinstance(spec, dict) for spec in specs):
+        raise InputError("scenarios must be a JSON list of scenario objects")
+    if len(specs) > SCENARIO_LIMIT:
+        raise InputError(f"At most {SCENARIO_LIMIT} scenarios can be evaluated at once")
+
+    base = (base_params or load_cost_parameters()).to_dict()
+    scenarios = []
+    for i, spec in enumerate(specs):
+        name = str(spec.get('name', f"Scenario {i + 1}"))
+        unknown = sorted(set(spec) - SCENARIO_KEYS)
+        if unknown:
+            raise InputError(f"Scenario '{name}': unknown keys {', '.join(unknown)}")
+        costs = spec.get('costs')
+        if costs is not None and (not isinstance(costs, str) or not costs.strip()):
+            raise InputError(f"Scenario '{name}': costs must name a costs file or dataset")
+        scenarios.append({
+            'name': name,
+            'parameters': scenario_parameters(base, spec, name),
+            'costs': costs.strip() if costs else None,
+        })
+
+    names = [scenario['name'] for scenario in scenarios]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise InputError(f"Scenario names must be unique: {', '.join(duplicates)}")
+    return scenarios
+
+
+def _total(columns, selected):
+    """Per-scenario sum of the selected columns over every row, summed like a DataFrame column by column"""
+    if not selected:
+        return 0.0
+    column_sums = [np.nansum(np.asarray(columns[column], dtype=np.float64), axis=-1) for column in selected]
+    return np.add.reduce(np.stack(np.broadcast_arrays(*column_sums), axis=-1), axis=-1)
+
+
+def used_columns(columns, compiled):
+    """The columns the compiled equations read or the summary totals add up"""
+    used = set()
+    for equation in compiled.values():
+        used.update(equation.variables)
+    column_totals(columns, lambda selected: used.update(selected) or 0)
+    return used
+
+
+def evaluate_scenarios(routes, result_df, rows, parameters, compiled, equation_columns):
+    """
+    Summary values ({metric: array over scenarios}) for a batch of
+    scenarios' cost parameters and one costs file's compiled equations.
+
+    result_df is the distance stage output after the encounter merge, whose
+    row i is routes row rows[i]; its columns that depend on the cost
+    parameters are recomputed with a scenario axis.
+    """
+    n_scenarios, n_rows = len(parameters), len(result_df)
+    columns = {column: column_array(result_df, column) for column in result_df.columns}
+    used = used_columns(list(columns) + list(equation_columns), compiled)
+
+    # Unit costs for every scenario at once, rounded as in the distance stage
+    # output; those nothing reads are dropped rather than rounded and copied
+    for column, values in travel_costs(routes, CostParameters.stack(parameters)).items():
+        if column in used:
+            columns[column] = np.round(values[..., rows], 2)
+        else:
+            del columns[column]
+
+    # Ensure columns exist before assignment, as apply_equations does
+    for column in equation_columns:
+        if column not in columns:
+            columns[column] = np.zeros(n_rows)
+    for column, equation in compiled.items():
+        try:
+            columns[column] = equation.evaluate(columns, shape=(n_scenarios, n_rows))
+        except EquationError as e:
+            raise InputError(
+                "Some equations in the costs file could not be evaluated", equation_errors={column: e.message}
+            )
+
+    totals = column_totals(list(columns), lambda selected: _total(columns, selected))
+    return {
+        column: np.broadcast_to(np.asarray(value, dtype=np.float64), (n_scenarios,))
+        for column, value in summary_values(totals).items()
+    }
+
+
+def run_scenarios(community_file, clinic_file, charlie_file, costs_file, scenarios, costs_files=None, progress=None):
+    """
+    Evaluate scenarios (from parse_scenarios) against one run's inputs.
+    costs_files maps each scenario costs name to its file; scenarios without
+    one use costs_file.
+
+    Returns (table, name_matching): one row per scenario, a dict with the
+    SCENARIO_COLUMNS, and the community name match statistics.
+    """
+    routes = run_route_stage(community_file, clinic_file, progress)
+
+    # Encounter counts are matched once; the row number maps merged rows back to routes
+    result_df = distance_frame(routes)
+    result_df['_route_row'] = np.arange(len(result_df))
+    result_df = merge_encounters(result_df, read_charlie(charlie_file))
+    rows = result_df.pop('_route_row').to_numpy()
+    name_matching = result_df.attrs['name_matching']
+    cost_columns = len(travel_costs(routes.iloc[:0], load_cost_parameters()))
+
+    # Scenarios sharing a costs file are evaluated together
+    groups = {}
+    for i, scenario in enumerate(scenarios):
+        groups.setdefault(scenario['costs'], []).append(i)
+
+    table = [None] * len(scenarios)
+    with metrics.span('scenarios', scenarios=len(scenarios), rows=len(result_df)):
+        for costs_name, indices in groups.items():
+            equation_columns, equations = read_costs(costs_file if costs_name is None else costs_files[costs_name])
+            available = tuple(result_df.columns) + tuple(col for col in equation_columns if col not in result_df.columns)
+            compiled, equation_errors = compile_equations(equation_columns, equations, available)
+            if equation_errors:
+                raise InputError(
+                    f"Some equations in the {costs_name or 'costs'} file could not be compiled",
+                    equation_errors=equation_errors
+                )
+
+            # Batches small enough that their per-row columns fit in SCENARIO_BATCH_BYTES
+            row_bytes = 8 * (len(routes) + len(result_df)) * (cost_columns + len(compiled))
+            batch_size = max(1, SCENARIO_BATCH_BYTES // max(row_bytes, 1))
+            for start in range(0, len(indices), batch_size):
+                batch = indices[start:start + batch_size]
+                values = evaluate_scenarios(
+                    routes, result_df, rows, [scenarios[i]['parameters'] for i in batch], compiled, equation_columns
+                )
+                for j, i in enumerate(batch):
+                    table[i] = {
+                        'Scenario': scenarios[i]['name'],
+                        'Costs': costs_name,
+                        **{column: round(float(values[column][j]), 2) for column in SUMMARY_COLUMNS},
+                    }
+    metrics.inc('scenarios_evaluated_total', len(scenarios))
+    logger.info("Evaluated %d scenarios over %d rows", len(scenarios), len(result_df))
+    return table, name_matching
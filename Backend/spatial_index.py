@@ -0,0 +1,187 @@
+import hashlib
+import logging
+import pickle
+from collections import OrderedDict
+
+import numpy as np
+
+from config import SPATIAL_INDEX_CACHE_DIR, SPATIAL_INDEX_CACHE_MAX_BYTES
+from distance import EARTH_RADIUS_KM, MAX_BLOCK_CELLS, haversine_matrix
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+logger = logging.getLogger(__name__)
+
+INDEX_CACHE_DIR = SPATIAL_INDEX_CACHE_DIR
+
+# Number of built indexes kept in memory per worker
+MEMORY_CACHE_SIZE = 8
+
+_memory_cache = OrderedDict()
+_index_cache = None
+
+
+def to_unit_vectors(lat, lng):
+    """
+    Convert latitude/longitude in degrees to 3D points on the unit sphere.
+    Straight-line (chord) distance between these points grows monotonically
+    with great-circle distance, so nearest neighbours are the same.
+    """
+    lat = np.radians(np.asarray(lat, dtype=np.float64))
+    lng = np.radians(np.asarray(lng, dtype=np.float64))
+    cos_lat = np.cos(lat)
+    return np.column_stack((cos_lat * np.cos(lng), cos_lat * np.sin(lng), np.sin(lat)))
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0.0, 1.0))
+
+
+def km_to_chord(km):
+    return 2 * np.sin(np.minimum(km / (2 * EARTH_RADIUS_KM), np.pi / 2))
+
+
+class ClinicIndex:
+    """
+    KD-tree over clinic locations on the unit sphere.
+
+    Answers k-nearest and radius queries in great-circle km. Falls back to a
+    blocked brute-force scan when scipy is not installed.
+    """
+
+    def __init__(self, clinic_lat, clinic_lng):
+        self.lat = np.asarray(clinic_lat, dtype=np.float64)
+        self.lng = np.asarray(clinic_lng, dtype=np.float64)
+        self.tree = cKDTree(to_unit_vectors(self.lat, self.lng)) if cKDTree is not None and len(self.lat) else None
+
+    def __len__(self):
+        return len(self.lat)
+
+    def query(self, lat, lng, k):
+        """
+        Return (indices, distances) of the k nearest clinics to each point,
+        as (n, k) arrays sorted nearest first, distances in km.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        k = min(k, len(self))
+        if len(lat) == 0 or k == 0:
+            return np.zeros((len(lat), k), dtype=np.int64), np.zeros((len(lat), k))
+
+        if self.tree is None:
+            return self._brute_query(lat, lng, k)
+
+        chord, indices = self.tree.query(to_unit_vectors(lat, lng), k=k)
+        if k == 1:
+            chord, indices = chord[:, None], indices[:, None]
+        return indices.astype(np.int64), chord_to_km(chord)
+
+    def query_radius(self, lat, lng, radius_km):
+        """
+        Return, for each point, an array of clinic indices within radius_km
+        great-circle distance, sorted nearest first.
+        """
+        lat = np.asarray(lat, dtype=np.float64)
+        lng = np.asarray(lng, dtype=np.float64)
+        if len(self) == 0:
+            return [np.zeros(0, dtype=np.int64) for _ in range(len(lat))]
+
+        if self.tree is None:
+            return self._brute_radius(lat, lng, radius_km)
+
+        points = to_unit_vectors(lat, lng)
+        matches = self.tree.query_ball_point(points, km_to_chord(radius_km))
+        results = []
+        for point, found in zip(points, matches):
+            found = np.asarray(found, dtype=np.int64)
+            chord = np.linalg.norm(self.tree.data[found] - point, axis=1)
+            results.append(found[np.argsort(chord, kind='stable')])
+        return results
+
+    def _blocks(self, lat, lng):
+        rows_per_block = max(1, MAX_BLOCK_CELLS // len(self))
+        for start in range(0, len(lat), rows_per_block):
+            stop = min(start + rows_per_block, len(lat))
+            yield start, stop, haversine_matrix(lat[start:stop], lng[start:stop], self.lat, self.lng)
+
+    def _brute_query(self, lat, lng, k):
+        indices = np.zeros((len(lat), k), dtype=np.int64)
+        distances = np.zeros((len(lat), k))
+        for start, stop, block in self._blocks(lat, lng):
+            if k < len(self):
+                part = np.argpartition(block, k - 1, axis=1)[:, :k]
+            else:
+                part = np.broadcast_to(np.arange(len(self)), block.shape)
+            part_dist = np.take_along_axis(block, part, axis=1)
+            order = np.argsort(part_dist, axis=1, kind='stable')
+            indices[start:stop] = np.take_along_axis(part, order, axis=1)
+            distances[start:stop] = np.take_along_axis(part_dist, order, axis=1)
+        return indices, distances
+
+    def _brute_radius(self, lat, lng, radius_km):
+        results = []
+        for _, _, block in self._blocks(lat, lng):
+            for row in block:
+                found = np.flatnonzero(row <= radius_km)
+                results.append(found[np.argsort(row[found], kind='stable')])
+        return results
+
+
+def clinic_data_hash(clinic_lat, clinic_lng):
+    """Content hash of the clinic coordinates, used as the index cache key"""
+    digest = hashlib.sha256()
+    digest.update(np.ascontiguousarray(clinic_lat, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(clinic_lng, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def get_index_cache():
+    """Process-wide on-disk cache of pickled ClinicIndexes"""
+    global _index_cache
+    if _index_cache is None:
+        # Imported here: result_cache depends on road_network, which imports this module
+        from result_cache import ResultCache
+        _index_cache = ResultCache(INDEX_CACHE_DIR, SPATIAL_INDEX_CACHE_MAX_BYTES, suffix='.pkl', name='spatial_index')
+    return _index_cache
+
+
+def _write_index(index, path):
+    with open(path, 'wb') as f:
+        pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def get_clinic_index(clinic_lat, clinic_lng):
+    """
+    Return the ClinicIndex for these clinic coordinates, building it only if
+    it is not already cached in memory or on disk.
+    """
+    key = clinic_data_hash(clinic_lat, clinic_lng)
+
+    index = _memory_cache.get(key)
+    if index is not None:
+        _memory_cache.move_to_end(key)
+        return index
+
+    cache = get_index_cache()
+    path = cache.get(key)
+    if path is not None:
+        try:
+            with open(path, 'rb') as f:
+                index = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            index = None
+    if index is None:
+        index = ClinicIndex(clinic_lat, clinic_lng)
+        if cache.enabled:
+            try:
+                cache.put(key, lambda tmp_path: _write_index(index, tmp_path))
+            except OSError as e:
+                logger.warning("Could not persist spatial index: %s", e)
+
+    _memory_cache[key] = index
+    if len(_memory_cache) > MEMORY_CACHE_SIZE:
+        _memory_cache.popitem(last=False)
+    return index
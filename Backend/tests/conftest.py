@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# Settings are read from the environment when config is imported, so they
+# are set before any test imports the Backend modules
+os.environ.setdefault('CACHE_DIR', tempfile.mkdtemp(prefix='geoffe-tests-'))
+os.environ.setdefault('ROUTING_BACKEND', 'geodesic')
+os.environ.setdefault('NAME_MATCH_FUZZY_THRESHOLD', '0.6')
+os.environ.setdefault('PIPELINE_PROCESSES', '1')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
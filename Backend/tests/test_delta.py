@@ -0,0 +1,68 @@
+import io
+
+import numpy as np
+import pandas as pd
+
+from pipeline import previous_routes, run_delta_pipeline, run_pipeline, save_report
+
+CHARLIE = """community_name,Encounters 0-14,Encounters 15-64,Encounters 65+
+Community 0,5,13,23
+Community 1,6,33,58
+Community 7,1,2,3
+"""
+
+COSTS = """total_encounters,travel_cost
+Encounters 0-14 + Encounters 15-64 + Encounters 65+,Travel Cost ($) * Encounters 65+
+"""
+
+
+def csv_file(df):
+    return io.BytesIO(df.to_csv(index=False).encode())
+
+
+def inputs(communities, clinics):
+    return [csv_file(communities), csv_file(clinics), io.BytesIO(CHARLIE.encode()), io.BytesIO(COSTS.encode())]
+
+
+def report_csv(report):
+    return save_report(report, io.BytesIO()).getvalue()
+
+
+def make_inputs():
+    rng = np.random.default_rng(0)
+    communities = pd.DataFrame({
+        'Title': [f"Community {i}" for i in range(200)],
+        'Latitude': rng.uniform(49, 56, 200),
+        'Longitude': rng.uniform(-128, -118, 200),
+    })
+    clinics = pd.DataFrame({
+        'Facility': [f"Clinic {i}" for i in range(30)],
+        'latitude': rng.uniform(49, 56, 30),
+        'longitude': rng.uniform(-128, -118, 30),
+    })
+    return communities, clinics
+
+
+def test_report_delta_matches_full_run():
+    communities, clinics = make_inputs()
+    previous = report_csv(run_pipeline(*inputs(communities, clinics)))
+
+    # A community moves and a clinic opens
+    communities.loc[3, 'Latitude'] += 0.2
+    clinics = pd.concat([clinics, pd.DataFrame({'Facility': ['Opened'], 'latitude': [52.5], 'longitude': [-123.0]})])
+    expected = report_csv(run_pipeline(*inputs(communities, clinics)))
+
+    report = run_delta_pipeline(
+        *inputs(communities, clinics), report_file=io.BytesIO(previous), delta_base='report:matches-full-run'
+    )
+    assert report.attrs['delta']['reused'] > 100
+    assert report_csv(report) == expected
+
+
+def test_report_written_with_other_cost_parameters_is_not_used():
+    communities, clinics = make_inputs()
+    previous = pd.read_csv(io.BytesIO(report_csv(run_pipeline(*inputs(communities, clinics)))))
+    assert previous_routes(report_file=csv_file(previous)) is not None
+
+    previous.loc[10, 'Travel Cost ($)'] += 0.5
+    assert previous_routes(report_file=csv_file(previous)) is None
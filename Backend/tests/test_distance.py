@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from geopy.distance import geodesic
+
+from distance import geodesic_km, nearest_clinics
+from spatial_index import ClinicIndex
+
+
+def brute_force(community_lat, community_lng, clinic_lat, clinic_lng, k):
+    """The k nearest clinics by geopy's geodesic over every clinic, ties by clinic position"""
+    indices, distances = [], []
+    for lat, lng in zip(community_lat, community_lng):
+        exact = np.array([geodesic((lat, lng), (c_lat, c_lng)).km for c_lat, c_lng in zip(clinic_lat, clinic_lng)])
+        order = np.lexsort((np.arange(len(exact)), exact))[:k]
+        indices.append(order)
+        distances.append(exact[order])
+    return np.array(indices), np.array(distances)
+
+
+def test_geodesic_km_matches_geopy():
+    rng = np.random.default_rng(0)
+    lat1, lat2 = rng.uniform(-90, 90, (2, 2000))
+    lng1, lng2 = rng.uniform(-180, 180, (2, 2000))
+    # Coincident points, the equator, the poles and nearly antipodal points
+    lat1[:5], lng1[:5] = [10, 0, 0, 90, 0], [20, 0, 0, 0, 0]
+    lat2[:5], lng2[:5] = [10, 0, 0, -90, 0.5], [20, 90, 179.7, 0, 179.8]
+
+    expected = [geodesic((a, b), (c, d)).km for a, b, c, d in zip(lat1, lng1, lat2, lng2)]
+    np.testing.assert_allclose(geodesic_km(lat1, lng1, lat2, lng2), expected, rtol=0, atol=1e-6)
+
+
+@pytest.mark.parametrize('k', [1, 3, 5])
+def test_nearest_clinics_matches_geodesic_scan(k):
+    rng = np.random.default_rng(k)
+    clinic_lat = rng.uniform(49, 60, 300)
+    clinic_lng = rng.uniform(-130, -100, 300)
+    # Ties: clinics repeated at the same coordinates, and communities at a clinic
+    clinic_lat[200:260], clinic_lng[200:260] = clinic_lat[:60], clinic_lng[:60]
+    community_lat = rng.uniform(48, 61, 150)
+    community_lng = rng.uniform(-131, -99, 150)
+    community_lat[:20], community_lng[:20] = clinic_lat[:20], clinic_lng[:20]
+
+    indices, distances = nearest_clinics(community_lat, community_lng, ClinicIndex(clinic_lat, clinic_lng), k)
+    expected_indices, expected_distances = brute_force(community_lat, community_lng, clinic_lat, clinic_lng, k)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=0, atol=1e-6)
+
+
+def test_nearest_clinics_widens_shortlist_for_close_calls():
+    # Clinics nearly equidistant from the community, so the tolerance band
+    # holds more of them than the first shortlist
+    angles = np.linspace(0, 2 * np.pi, 40, endpoint=False)
+    clinic_lat = 55 + 0.5 * np.sin(angles)
+    clinic_lng = -115 + 0.5 / np.cos(np.radians(55)) * np.cos(angles)
+
+    indices, distances = nearest_clinics([55.0], [-115.0], ClinicIndex(clinic_lat, clinic_lng), 3)
+    expected_indices, expected_distances = brute_force([55.0], [-115.0], clinic_lat, clinic_lng, 3)
+
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=0, atol=1e-6)
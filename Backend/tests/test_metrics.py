@@ -0,0 +1,83 @@
+import json
+import os
+import subprocess
+import sys
+
+import metrics as metrics_module
+from metrics import AGGREGATE_NAME, Metrics
+
+
+def exited_pid():
+    """The PID of a process that has already exited"""
+    process = subprocess.Popen([sys.executable, '-c', 'pass'])
+    process.wait()
+    return process.pid
+
+
+def write_worker_snapshot(directory, pid, requests, seconds):
+    worker = Metrics(directory)
+    worker.inc('http_requests_total', requests, endpoint='process')
+    worker.observe('http_request_duration_seconds', seconds, endpoint='process')
+    path = os.path.join(directory, f"{pid}-{os.urandom(4).hex()}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(worker.snapshot(), f)
+    return path
+
+
+def totals(metrics):
+    counters, histograms = metrics._merged()
+    requests = sum(value for (name, _), value in counters.items() if name == 'http_requests_total')
+    observed = sum(h['count'] for (name, _), h in histograms.items() if name == 'http_request_duration_seconds')
+    return requests, observed
+
+
+def test_snapshots_of_exited_workers_are_folded_into_the_aggregate(tmp_path):
+    directory = str(tmp_path)
+    for requests in (3, 4, 5):
+        write_worker_snapshot(directory, exited_pid(), requests, 0.2)
+    running = write_worker_snapshot(directory, os.getppid(), 7, 0.2)
+    metrics = Metrics(directory)
+    metrics.inc('http_requests_total', 1, endpoint='process')
+
+    before = metrics.render()
+    assert totals(metrics) == (3 + 4 + 5 + 7 + 1, 4)
+    assert sorted(os.listdir(directory)) == sorted(
+        ['.lock', AGGREGATE_NAME, os.path.basename(running), metrics._snapshot_name]
+    )
+
+    # More workers exiting are added to the aggregate rather than replacing it
+    write_worker_snapshot(directory, exited_pid(), 10, 0.2)
+    assert totals(metrics) == (3 + 4 + 5 + 7 + 1 + 10, 5)
+    assert metrics.render() != before
+    assert len(os.listdir(directory)) == 4
+
+
+def test_flush_is_throttled_until_a_scrape(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_module, 'METRICS_FLUSH_SECONDS', 60)
+    metrics = Metrics(str(tmp_path))
+    metrics.inc('http_requests_total', endpoint='process')
+    metrics.flush()
+    path = os.path.join(str(tmp_path), metrics._snapshot_name)
+    written = os.path.getmtime(path), open(path).read()
+
+    for _ in range(50):
+        metrics.inc('http_requests_total', endpoint='process')
+        metrics.flush()
+    assert (os.path.getmtime(path), open(path).read()) == written
+    assert metrics._flush_timer is not None
+
+    assert 'http_requests_total{endpoint="process"} 51' in metrics.render()
+    assert metrics._flush_timer is None
+
+
+def test_throttled_flush_is_written_once_the_interval_is_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(metrics_module, 'METRICS_FLUSH_SECONDS', 0.2)
+    metrics = Metrics(str(tmp_path))
+    metrics.flush()
+    metrics.inc('http_requests_total', endpoint='process')
+    metrics.flush()
+    path = os.path.join(str(tmp_path), metrics._snapshot_name)
+    assert json.load(open(path))['counters'] == []
+
+    metrics._flush_timer.join(2)
+    assert json.load(open(path))['counters'] == [['http_requests_total', [['endpoint', 'process']], 1]]
@@ -0,0 +1,152 @@
+import re
+import unicodedata
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from name_matching import TrigramIndex, fuzzy_matches, match_names, name_trigrams, normalize_names
+from pipeline import ENCOUNTER_COLUMNS, merge_encounters
+
+NAMES = [
+    'Fort St. John', '  Fort St.   John ', 'Fort\u00a0St. John', 'Fort St.\tJohn\n', 'Ｆｏｒｔ Ｓｔ. Ｊｏｈｎ',
+    'Dawson Creek', 'Dawson \u2013 Creek', 'Dawson\u2014Creek', 'Prince George', 'prince george', 'Smithers',
+    '100 Mile House', '', '   ', 'Stéphane', 'Stéphane', 'Lac La Hache', 'Hope',
+]
+
+
+def norm_name(s):
+    """The per-name normalization the API used before normalize_names"""
+    if pd.isna(s):
+        return s
+    s = str(s)
+    s = unicodedata.normalize("NFKC", s)
+    s = s.replace("\u00A0", " ")
+    s = s.replace("\u2013", "-").replace("\u2014", "-")
+    s = s.strip()
+    s = re.sub(r"\s+", " ", s)
+    return s
+
+
+def dice(a, b):
+    a, b = name_trigrams(a), name_trigrams(b)
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+def brute_force_best(queries, names, threshold):
+    """Each query's most similar name by scoring every pair, ties to the earliest name"""
+    results = []
+    for query in queries:
+        scores = [dice(query, name) for name in names]
+        best = int(np.argmax(scores)) if names else None
+        results.append((names[best], scores[best]) if best is not None and scores[best] >= threshold else (None, 0.0))
+    return results
+
+
+def misspell(rng, name):
+    """name with a character dropped, doubled or swapped for another"""
+    i = int(rng.integers(len(name)))
+    edit = rng.integers(3)
+    if edit == 0:
+        return name[:i] + name[i + 1:]
+    if edit == 1:
+        return name[:i] + name[i] + name[i:]
+    return name[:i] + 'xqz'[int(rng.integers(3))] + name[i + 1:]
+
+
+def random_names(rng, n):
+    syllables = ['ka', 'lo', 'mi', 'ver', 'ton', 'ash', 'bur', 'ny', 'el', 'qu', 'ridge', 'lake', 'fort', 'sun']
+    return [' '.join(''.join(rng.choice(syllables, rng.integers(1, 4))) for _ in range(rng.integers(1, 3)))
+            for _ in range(n)]
+
+
+def test_normalize_names_matches_baseline():
+    names = pd.Series(NAMES + [np.nan, None, 42] + NAMES[::-1], index=range(10, 10 + 2 * len(NAMES) + 3))
+    expected = names.map(norm_name)
+    # Twice: the second call reuses the names normalized by the first
+    for _ in range(2):
+        result = normalize_names(names)
+        assert result.index.equals(names.index)
+        assert result.isna().equals(expected.isna())
+        assert result[expected.notna()].tolist() == [str(name) for name in expected[expected.notna()]]
+
+
+def test_exact_matches_match_baseline_merge_with_duplicate_charlie_names():
+    titles = ['Fort St. John', 'Dawson\u2014Creek', 'Smithers', 'Hope', 'Nowhere', ' prince  george', None]
+    result_df = pd.DataFrame({'Title': titles, 'Population': range(len(titles))})
+    # Smithers and Hope are listed twice in the charlie file
+    charlie_df = pd.DataFrame({
+        'community_name': ['Fort\u00a0St.  John', 'Dawson\u2013Creek', 'Smithers', 'Smithers', 'Hope', 'Hope ', 'Elsewhere'],
+        'Encounters 0-14': [1, 2, 3, 4, 5, 6, 7],
+        'Encounters 15-64': [10, 20, 30, 40, 50, 60, 70],
+        'Encounters 65+': [100, 200, 300, 400, 500, 600, 700],
+    })
+
+    expected = result_df.assign(Title_norm=result_df['Title'].map(norm_name)).merge(
+        charlie_df.assign(community_name_norm=charlie_df['community_name'].map(norm_name))[
+            ['community_name_norm', *ENCOUNTER_COLUMNS]],
+        left_on='Title_norm', right_on='community_name_norm', how='left'
+    ).drop(columns=['community_name_norm'])
+    expected[ENCOUNTER_COLUMNS] = expected[ENCOUNTER_COLUMNS].fillna(0)
+
+    merged = merge_encounters(result_df.copy(), charlie_df.copy(), fuzzy_threshold=0)
+    assert merged['Population'].tolist() == expected['Population'].tolist()
+    for column in ENCOUNTER_COLUMNS:
+        assert merged[column].astype(float).tolist() == expected[column].astype(float).tolist()
+    stats = merged.attrs['name_matching']
+    assert (stats['rows'], stats['exact'], stats['fuzzy'], stats['unmatched']) == (7, 4, 0, 3)
+
+
+@pytest.mark.parametrize('threshold', [0.3, 0.5, 0.6, 0.75, 0.9])
+def test_trigram_index_matches_brute_force(threshold):
+    rng = np.random.default_rng(int(threshold * 100))
+    names = random_names(rng, 400)
+    # Misspelled indexed names, unrelated names and names that are only a prefix or a word of one
+    queries = [misspell(rng, name) for name in rng.choice(names, 150)] + random_names(rng, 100)
+    queries += [name.split()[0] for name in names[:30]] + [name[:4] for name in names[30:50]] + ['', '!!', 'a']
+
+    index = TrigramIndex(names, threshold)
+    # The prefix filter posts only some of each name's trigrams
+    if threshold >= 0.5:
+        assert len(index.posted_names) < len(index.indices)
+    for batch_size in (1, 7, 64):
+        result = index.best_matches(queries, batch_size=batch_size)
+        expected = brute_force_best(queries, names, threshold)
+        assert [match for match, _ in result] == [match for match, _ in expected]
+        np.testing.assert_allclose([score for _, score in result], [score for _, score in expected])
+
+
+def test_names_just_below_the_threshold_do_not_match():
+    names = ['Williams Lake', 'Lake Country', 'Quesnel']
+    query = 'Wiliams Lake'
+    score = dice(query, 'Williams Lake')
+
+    assert fuzzy_matches([query], names, score) == {query: ('Williams Lake', pytest.approx(score))}
+    assert fuzzy_matches([query], names, np.nextafter(score, 1)) == {}
+    assert TrigramIndex(names, np.nextafter(score, 1)).best_matches([query]) == [(None, 0.0)]
+
+
+def test_match_names_stats():
+    titles = pd.Series(['Smithers', 'Smithers', 'Williams Lake', 'Wiliams Lake', 'Quesnell', 'Atlantis', None, 'Hope'])
+    charlie = pd.Series(['Smithers', 'Smithers', 'Williams Lake', 'Quesnel', 'Hope', 'Lytton', None])
+
+    keys, stats = match_names(titles, charlie, fuzzy_threshold=0.6)
+
+    # 'Wiliams Lake' is not offered 'Williams Lake', which a title matches exactly
+    assert keys.tolist()[:6] == ['Smithers', 'Smithers', 'Williams Lake', 'Wiliams Lake', 'Quesnel', 'Atlantis']
+    assert stats['rows'] == 8
+    assert stats['exact'] == 4
+    assert stats['fuzzy'] == 1
+    assert stats['unmatched'] == 3
+    assert stats['match_rate'] == round(5 / 8, 4)
+    assert stats['charlie_names'] == 5
+    assert stats['charlie_names_unused'] == 1
+    assert stats['fuzzy_threshold'] == 0.6
+    assert stats['fuzzy_matches'] == [{'name': 'Quesnell', 'match': 'Quesnel', 'score': round(dice('Quesnell', 'Quesnel'), 3)}]
+    assert stats['unmatched_names'] == ['Wiliams Lake', 'Atlantis']
+
+    # Without fuzzy matching the near misses stay unmatched
+    keys, stats = match_names(titles, charlie)
+    assert (stats['exact'], stats['fuzzy'], stats['unmatched']) == (4, 0, 4)
+    assert stats['fuzzy_matches'] == []
+    assert stats['unmatched_names'] == ['Wiliams Lake', 'Quesnell', 'Atlantis']
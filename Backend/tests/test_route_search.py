@@ -0,0 +1,64 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from distance import SPHERE_TOLERANCE, geodesic_km, nearest_clinics
+from route_search import search_routes
+from spatial_index import ClinicIndex
+
+
+def make_inputs(seed):
+    rng = np.random.default_rng(seed)
+    community_df = pd.DataFrame({'Latitude': rng.uniform(49, 56, 120), 'Longitude': rng.uniform(-128, -118, 120)})
+    clinic_df = pd.DataFrame({'Latitude': rng.uniform(49, 56, 40), 'Longitude': rng.uniform(-128, -118, 40)})
+    # Roads wind more to some clinics than others, so searches go past the first candidate
+    detour = dict(zip(zip(clinic_df['Latitude'], clinic_df['Longitude']), rng.uniform(1.0, 2.5, 40)))
+    return community_df, clinic_df, detour
+
+
+def road(detour):
+    def route(pairs):
+        lat1, lng1, lat2, lng2 = np.array(pairs, dtype=np.float64).reshape(-1, 4).T
+        km = geodesic_km(lat1, lng1, lat2, lng2) * [detour[pair[2:]] for pair in pairs]
+        return [(float(d), float(d) / 80) for d in km]
+    return route
+
+
+@pytest.mark.parametrize('limit', [2, 5, 40])
+def test_pairs_and_pruned_count_what_the_search_did(limit):
+    community_df, clinic_df, detour = make_inputs(limit)
+    index = ClinicIndex(clinic_df['Latitude'], clinic_df['Longitude'])
+    lat, lng = community_df['Latitude'].to_numpy(), community_df['Longitude'].to_numpy()
+    candidate_idx, candidate_dist = nearest_clinics(lat, lng, index, k=3)
+
+    closest, _, _, stats = search_routes(
+        community_df, clinic_df, index, candidate_idx, candidate_dist, road(detour), max_candidates=limit
+    )
+
+    # One community at a time: route candidates nearest first until the next one's bound rules it out
+    order, dist = nearest_clinics(lat, lng, index, k=limit)
+    pairs = pruned = 0
+    for i in range(len(community_df)):
+        best, pick = np.inf, None
+        for clinic, bound in zip(order[i], dist[i]):
+            if bound * (1 - SPHERE_TOLERANCE) >= best:
+                pruned += 1
+                break
+            pairs += 1
+            km = road(detour)([(lat[i], lng[i], clinic_df['Latitude'][clinic], clinic_df['Longitude'][clinic])])[0][0]
+            if km < best:
+                best, pick = km, clinic
+        assert closest[i] == pick
+
+    assert stats['pairs'] == pairs
+    assert stats['pruned'] == pruned
+    assert stats['pruned'] <= len(community_df)
+
+    # Three candidates a round pick the same clinics; a round's candidates the bound rules out are each counted
+    closest3, _, _, stats3 = search_routes(
+        community_df, clinic_df, index, candidate_idx, candidate_dist, road(detour), max_candidates=limit,
+        candidates_per_round=3
+    )
+    np.testing.assert_array_equal(closest3, closest)
+    assert stats3['pairs'] >= stats['pairs']
+    assert stats3['pruned'] <= 3 * len(community_df)
@@ -0,0 +1,113 @@
+from urllib.parse import urlsplit
+
+import numpy as np
+import pytest
+
+from benchmarks.fake_osrm import FakeOSRM, duration_s, road_distance_m
+from distance import geodesic_km
+from routing import FALLBACK_SPEED_KMH, OSRMRouteBackend, OSRMTableBackend, fill_fallback
+from routing_client import CircuitBreaker, RoutingClient
+
+
+class RecordingClient(RoutingClient):
+    """A RoutingClient that keeps the URLs it was asked for"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.urls = []
+
+    def get_many(self, urls):
+        self.urls.extend(urls)
+        return super().get_many(urls)
+
+
+@pytest.fixture(scope='module')
+def router():
+    with FakeOSRM() as fake:
+        yield fake
+
+
+def community_clinic_pairs(communities=12, clinics=5, per_community=3, seed=0):
+    """Pairs from each community to some of a few shared clinics, as the nearest clinic search sends them"""
+    rng = np.random.default_rng(seed)
+    community = rng.uniform([49, -130], [60, -100], (communities, 2)).round(5)
+    clinic = rng.uniform([49, -130], [60, -100], (clinics, 2)).round(5)
+    return [
+        (float(lat), float(lng), float(clinic[j][0]), float(clinic[j][1]))
+        for (lat, lng) in community for j in rng.choice(clinics, per_community, replace=False)
+    ]
+
+
+def expected_route(pair):
+    start_lat, start_lng, end_lat, end_lng = pair
+    distance = road_distance_m(start_lng, start_lat, end_lng, end_lat)
+    return distance / 1000, duration_s(distance) / 3600
+
+
+def table_coordinates(url):
+    return urlsplit(url).path.rsplit('/', 1)[1].split(';')
+
+
+@pytest.mark.parametrize('max_coordinates', [2, 5, 9, 100])
+def test_table_requests_split_at_coordinate_limit(router, max_coordinates):
+    pairs = community_clinic_pairs()
+    client = RecordingClient(max_retries=0)
+    backend = OSRMTableBackend(base_url=router.url, client=client, max_coordinates=max_coordinates)
+
+    results = backend.route_pairs(pairs)
+
+    assert all(len(table_coordinates(url)) <= max_coordinates for url in client.urls)
+    if max_coordinates < 12 + 5:
+        assert len(client.urls) > 1
+    else:
+        assert len(client.urls) == 1
+    # Every pair gets the matrix cell of its own community and clinic
+    for pair, result in zip(pairs, results):
+        assert result == pytest.approx(expected_route(pair), rel=1e-9)
+
+
+def test_route_backend_routes_each_pair(router):
+    pairs = community_clinic_pairs(communities=4)
+    client = RecordingClient(max_retries=0)
+
+    results = OSRMRouteBackend(base_url=router.url, client=client).route_pairs(pairs)
+
+    assert len(client.urls) == len(pairs)
+    for pair, result in zip(pairs, results):
+        assert result == pytest.approx(expected_route(pair), rel=1e-9)
+
+
+@pytest.mark.parametrize('backend_class', [OSRMTableBackend, OSRMRouteBackend])
+def test_pairs_without_a_route_fall_back_to_geodesic(router, backend_class):
+    pairs = community_clinic_pairs(communities=6)
+    # A community and a clinic the fake router has no road to
+    unroutable = {1, 4, 7}
+    pairs[1] = (-70.0, 10.0) + pairs[1][2:]
+    pairs[4] = pairs[4][:2] + (-75.0, 20.0)
+    pairs[7] = (-70.0, 10.0, -75.0, 20.0)
+
+    routed = backend_class(base_url=router.url, client=RoutingClient(max_retries=0)).route_pairs(pairs)
+    distances, durations, fallback = fill_fallback(pairs, routed)
+
+    assert [i for i, result in enumerate(routed) if result is None] == sorted(unroutable)
+    assert np.flatnonzero(fallback).tolist() == sorted(unroutable)
+    for i, pair in enumerate(pairs):
+        if i in unroutable:
+            assert distances[i] == pytest.approx(float(geodesic_km(*pair)), rel=1e-12)
+            assert durations[i] == pytest.approx(distances[i] / FALLBACK_SPEED_KMH)
+        else:
+            assert (distances[i], durations[i]) == pytest.approx(expected_route(pair), rel=1e-9)
+
+
+def test_failed_requests_fall_back_to_geodesic():
+    pairs = community_clinic_pairs(communities=6)
+    client = RoutingClient(max_retries=0, breaker=CircuitBreaker(threshold=1000))
+    with FakeOSRM(failure_rate=1.0) as failing:
+        routed = OSRMTableBackend(base_url=failing.url, client=client, max_coordinates=6).route_pairs(pairs)
+
+    distances, durations, fallback = fill_fallback(pairs, routed)
+
+    assert routed == [None] * len(pairs)
+    assert fallback.all()
+    np.testing.assert_allclose(distances, [geodesic_km(*pair) for pair in pairs], rtol=1e-12)
+    np.testing.assert_allclose(durations, distances / FALLBACK_SPEED_KMH)
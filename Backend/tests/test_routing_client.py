@@ -0,0 +1,113 @@
+import threading
+import time
+
+import pytest
+import requests
+
+from benchmarks.fake_osrm import FakeOSRM
+from routing_client import CircuitBreaker, RoutingClient
+
+ROUTE_PATH = '/route/v1/driving/-123.1,49.2;-122.9,49.3'
+
+
+class CountingSession:
+    """A requests session that records the most requests it had in flight at once"""
+
+    def __init__(self):
+        self.session = requests.Session()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+
+    def get(self, url, **kwargs):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            return self.session.get(url, **kwargs)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+
+def never_opening_breaker():
+    return CircuitBreaker(threshold=1000)
+
+
+@pytest.mark.parametrize('status', [429, 500, 503])
+def test_retries_with_backoff_then_gives_up(status):
+    with FakeOSRM(failure_rate=1.0, failure_status=status) as router:
+        client = RoutingClient(max_retries=3, backoff=0.05, backoff_max=1, breaker=never_opening_breaker())
+        start = time.monotonic()
+        assert client.get_json(router.url + ROUTE_PATH) is None
+        elapsed = time.monotonic() - start
+        assert router.stats()['requests'] == 4
+
+    assert client.stats()['requests'] == 4
+    assert client.stats()['retries'] == 3
+    # Backoff doubles from 0.05 s, with up to half taken off as jitter: at least (0.05 + 0.1 + 0.2) / 2
+    assert elapsed >= 0.175
+
+
+def test_retries_until_the_router_answers():
+    with FakeOSRM(failure_rate=0.5, seed=1) as router:
+        client = RoutingClient(concurrency=1, max_retries=10, backoff=0.001, breaker=never_opening_breaker())
+        results = client.get_many([router.url + ROUTE_PATH] * 10)
+        stats = router.stats()
+
+    assert all(result is not None and result['code'] == 'Ok' for result in results)
+    assert stats['failures'] > 0
+    assert client.stats()['retries'] == stats['failures']
+
+
+@pytest.mark.parametrize('concurrency', [1, 3])
+def test_concurrency_cap(concurrency):
+    session = CountingSession()
+    with FakeOSRM(latency=0.1) as router:
+        client = RoutingClient(concurrency=concurrency, session=session)
+        results = client.get_many([router.url + ROUTE_PATH] * 9)
+
+    assert all(result is not None for result in results)
+    assert session.max_in_flight == concurrency
+
+
+def test_rate_limit():
+    with FakeOSRM() as router:
+        client = RoutingClient(concurrency=4, rate_limit=20)
+        start = time.monotonic()
+        client.get_many([router.url + ROUTE_PATH] * 6)
+        elapsed = time.monotonic() - start
+
+    # One request right away, then one every 1/20 s
+    assert elapsed >= 5 / 20 * 0.9
+
+
+def test_breaker_opens_after_threshold_failures_and_fails_fast():
+    # Each request would take a second; the client gives up on it after 0.1 s
+    with FakeOSRM(latency=1.0) as router:
+        client = RoutingClient(concurrency=1, max_retries=0, timeout=0.1, breaker=CircuitBreaker(threshold=3))
+        start = time.monotonic()
+        results = client.get_many([router.url + ROUTE_PATH] * 20)
+        elapsed = time.monotonic() - start
+
+    assert results == [None] * 20
+    stats = client.stats()
+    assert stats['breaker_open']
+    assert stats['requests'] == 3
+    assert stats['short_circuited'] == 17
+    # Only the requests before the breaker opened waited for their timeout
+    assert elapsed < 1.0
+
+
+def test_breaker_lets_a_trial_request_through_after_reset_timeout():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=0.1)
+    with FakeOSRM() as router:
+        client = RoutingClient(breaker=breaker)
+        breaker.record_failure()
+        breaker.record_failure()
+        assert client.get_json(router.url + ROUTE_PATH) is None
+        time.sleep(0.15)
+        assert client.get_json(router.url + ROUTE_PATH)['code'] == 'Ok'
+
+    assert not breaker.is_open
+    assert client.stats()['short_circuited'] == 1
@@ -0,0 +1,41 @@
+import io
+
+from pipeline import run_pipeline, save_report, stream_pipeline
+
+COMMUNITIES = """Title,Latitude,Longitude
+Fort Smith,60.005,-111.88
+Hay River,60.816,-115.79
+Fort Smithe,60.01,-111.9
+Hay Rivers,60.82,-115.8
+Enterprise,60.6,-116.13
+"""
+
+CLINICS = """Facility,latitude,longitude
+Clinic A,60.0,-111.9
+Clinic B,60.8,-115.8
+"""
+
+CHARLIE = """community_name,Encounters 0-14,Encounters 15-64,Encounters 65+
+Fort Smith,5,13,23
+Hay River,6,33,58
+Enterprize,1,2,3
+"""
+
+COSTS = """total_encounters,travel_cost
+Encounters 0-14 + Encounters 15-64 + Encounters 65+,Travel Cost ($) * Encounters 65+
+"""
+
+
+def files():
+    return [io.BytesIO(text.encode()) for text in (COMMUNITIES, CLINICS, CHARLIE, COSTS)]
+
+
+def test_streamed_report_matches_whole_run_with_fuzzy_matching():
+    report = run_pipeline(*files())
+    # Fuzzy matching leaves "Fort Smith" to its exact match, even when that is in another chunk
+    assert report.attrs['name_matching']['fuzzy'] == 1
+    expected = save_report(report, io.BytesIO()).getvalue().decode()
+
+    for chunk_rows in (1, 2, 5):
+        streamed = ''.join(stream_pipeline(*files(), chunk_rows=chunk_rows))
+        assert streamed == expected